@@ -0,0 +1,290 @@
+'''Timing and quality benchmarks for the search algorithms
+
+Every matrix is generated from a seed, so runs are repeatable and need no
+access to Google Maps. Results are written as JSON so that runs from
+different commits can be compared.
+
+Solvers which work from the positions of the stops, such as decompose.py,
+are run on the kinds of matrix made from points. The full matrix is only
+built when a solver which needs it is run, so these solvers can be tried
+on sizes too large for a full matrix.
+
+Usage:
+python benchmark.py --sizes 6 10 14 40 --output results.json
+python benchmark.py --compare old_results.json
+python benchmark.py --sizes 2000 5000 --kinds euclidean clustered \
+    --solvers solve decompose
+python benchmark.py --sizes 50000 --kinds euclidean --solvers decompose
+'''
+import argparse
+import json
+import platform
+import subprocess
+from time import perf_counter, strftime
+
+import numpy as np
+
+import decompose
+import search
+
+# The solvers to benchmark, with the largest size each is run on
+SOLVERS = [
+    ("brute_force", search.brute_force, 8),
+    ("parallel_brute_force", search.parallel_brute_force, 9),
+    ("held_karp", search.held_karp, 16),
+    ("branch_and_bound", lambda m: search.branch_and_bound(m, time_limit=10), 25),
+    ("nearest_neighbour", search.nearest_neighbour, None),
+    ("local_search",
+     lambda m: search.local_search(m, search.nearest_neighbour(m)[1]),
+     None),
+    ("solve", lambda m: search.solve(m, time_budget=1), None),
+    ]
+
+# Solvers given the points and a function returning the distance matrix
+# between any of them, with the largest size each is run on
+POINT_SOLVERS = [
+    ("decompose",
+     lambda points, matrix_for: decompose.solve(
+         points, matrix_for, time_budget=1),
+     None),
+    ]
+
+# The solver whose result is treated as the true optimum
+EXACT_SOLVER = "held_karp"
+
+DEFAULT_SIZES = [5, 8, 12, 16, 25, 50, 100, 200]
+DEFAULT_KINDS = ["euclidean", "clustered", "asymmetric"]
+
+
+def euclidean_points(size, seed):
+    '''Return random points spread evenly over a square
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    '''
+    return np.random.default_rng(seed).uniform(0, 10000, (size, 2))
+
+def euclidean_matrix(size, seed):
+    '''Return the matrix of straight line distances between random points
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    '''
+    return _distances(euclidean_points(size, seed))
+
+def clustered_points(size, seed):
+    '''Return random points in tight groups
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    '''
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(0, 10000, (max(1, size//10), 2))
+    points = centres[rng.integers(len(centres), size=size)]
+    return points+rng.normal(0, 300, (size, 2))
+
+def clustered_matrix(size, seed):
+    '''Return the matrix of distances between points in tight groups
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    '''
+    return _distances(clustered_points(size, seed))
+
+def asymmetric_matrix(size, seed):
+    '''Return a matrix of distances where each direction has its own cost
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    '''
+    rng = np.random.default_rng(seed)
+    matrix = euclidean_matrix(size, seed)
+    matrix = matrix*rng.uniform(0.8, 1.5, (size, size))
+    np.fill_diagonal(matrix, 0)
+    return matrix
+
+def _distances(points):
+    '''Return the matrix of straight line distances between points
+
+    Parameters:
+    points             Array of x, y coordinates
+    '''
+    return np.sqrt(((points[:, None, :]-points[None, :, :])**2).sum(axis=2))
+
+GENERATORS = {
+    "euclidean": euclidean_matrix,
+    "clustered": clustered_matrix,
+    "asymmetric": asymmetric_matrix,
+    }
+
+# The kinds of matrix which are made from points, and their points
+POINT_GENERATORS = {
+    "euclidean": euclidean_points,
+    "clustered": clustered_points,
+    }
+
+
+def run(sizes, kinds, seeds, solvers=None, repeat=1):
+    '''Time every solver on every generated matrix and return the records
+
+    Each record holds the time taken and the cost found, along with the
+    ratio of that cost to the reference. The reference is the exact optimum
+    when the exact solver ran, and otherwise the best cost any solver found.
+    The point solvers only run on kinds made from points, and the full
+    matrix is only built when a matrix solver runs.
+
+    Parameters:
+    sizes              The numbers of locations to try
+    kinds              The names of the matrix generators to use
+    seeds              The seeds to generate matrices from
+    solvers            The names of the solvers to run, all if not given
+    repeat             Times each solver is run, the fastest being kept
+    '''
+    candidates = (
+        [solver+(False,) for solver in SOLVERS]
+        +[solver+(True,) for solver in POINT_SOLVERS]
+        )
+
+    records = []
+    for kind in kinds:
+        for size in sizes:
+            for seed in seeds:
+                chosen = [
+                    (name, solver, uses_points)
+                    for name, solver, limit, uses_points in candidates
+                    if (solvers is None or name in solvers)
+                    and (limit is None or size <= limit)
+                    and (not uses_points or kind in POINT_GENERATORS)
+                    ]
+                if any(not uses_points for _, _, uses_points in chosen):
+                    matrix = GENERATORS[kind](size, seed)
+                if any(uses_points for _, _, uses_points in chosen):
+                    points = POINT_GENERATORS[kind](size, seed)
+                    matrix_for = lambda indexes: _distances(points[indexes])
+
+                found = []
+                for name, solver, uses_points in chosen:
+                    # Keep the fastest of the repeated runs
+                    seconds = float("inf")
+                    for _ in range(repeat):
+                        start = perf_counter()
+                        if uses_points:
+                            result = solver(points, matrix_for)
+                        else:
+                            result = solver(matrix)
+                        seconds = min(seconds, perf_counter()-start)
+
+                    found.append({
+                        "kind": kind,
+                        "size": size,
+                        "seed": seed,
+                        "solver": name,
+                        "seconds": seconds,
+                        "cost": float(result[0]),
+                        })
+
+                if not found:
+                    continue
+
+                # Compare every cost to the best available reference
+                exact = [r["cost"] for r in found if r["solver"] == EXACT_SOLVER]
+                reference = exact[0] if exact else min(r["cost"] for r in found)
+                for record in found:
+                    record["reference"] = reference
+                    record["reference_exact"] = bool(exact)
+                    record["ratio"] = (
+                        record["cost"]/reference if reference else 1.0
+                        )
+                records.extend(found)
+
+    return records
+
+def environment():
+    '''Return details of the machine and code the benchmark ran on
+
+    '''
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "time": strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        }
+
+def compare(old_records, new_records):
+    '''Return lines describing how each result changed between two runs
+
+    Parameters:
+    old_records        Records from the earlier run
+    new_records        Records from the later run
+    '''
+    key = lambda r: (r["kind"], r["size"], r["seed"], r["solver"])
+    old = {key(r): r for r in old_records}
+
+    lines = []
+    for record in new_records:
+        before = old.get(key(record))
+        if before is None:
+            continue
+        lines.append(
+            "%-10s %5d %3d %-22s time x%.2f  cost x%.4f" % (
+                key(record)+(
+                    record["seconds"]/before["seconds"]
+                    if before["seconds"] else float("inf"),
+                    record["cost"]/before["cost"]
+                    if before["cost"] else 1.0,
+                    )
+                )
+            )
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--kinds", nargs="+", default=DEFAULT_KINDS,
+                        choices=sorted(GENERATORS))
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--solvers", nargs="+",
+                        choices=[name for name, _, _ in
+                                 SOLVERS+POINT_SOLVERS])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="PREVIOUS",
+                        help="results file to compare this run against")
+    args = parser.parse_args(argv)
+
+    records = run(args.sizes, args.kinds, args.seeds, args.solvers, args.repeat)
+    with open(args.output, "w") as file:
+        json.dump({"environment": environment(), "results": records},
+                  file, indent=1)
+
+    for record in records:
+        print("%-10s %5d %3d %-22s %10.4fs  x%.4f" % (
+            record["kind"], record["size"], record["seed"], record["solver"],
+            record["seconds"], record["ratio"]
+            ))
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            previous = json.load(file)["results"]
+        print()
+        print("\n".join(compare(previous, records)))
+
+
+if __name__ == "__main__":
+    main()
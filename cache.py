@@ -0,0 +1,320 @@
+'''Caches which keep results from Google Maps between runs
+
+'''
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+
+def normalise(user_input):
+    '''Return the form of a user's input used as a cache key
+
+    Parameters:
+    user_input         The input to be normalised
+    '''
+    return " ".join(user_input.lower().split())
+
+
+class GeocodeCache:
+    '''A cache of geocoded locations kept in an SQLite file
+
+    The most recently used entries are also held in memory so that repeat
+    lookups do not touch the file. Their access times are written back to
+    the file together, at most every write_interval seconds and before any
+    entry is removed. Entries older than the time to live are treated as
+    missing, and the least recently used entries are removed once the file
+    holds more than max_entries. The file is only opened when it is first
+    needed.
+
+    Attributes:
+    path               The SQLite file holding the cache
+    max_entries        Most entries kept in the file
+    ttl                Seconds an entry stays valid, forever if None
+    memory_size        Most entries kept in memory
+    write_interval     Most seconds before lookups answered from memory are
+                       written back to the file
+    hits               Number of lookups answered from the cache
+    misses             Number of lookups not in the cache
+
+    Methods:
+    get                Return the latitude and longitude stored for an input
+    put                Store the latitude and longitude for an input
+    clear              Remove every entry
+    stats              Return the counters and size of the cache
+    '''
+    def __init__(self, path, max_entries=100000, ttl=30*24*3600,
+                 memory_size=1024, write_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.write_interval = write_interval
+        self.hits = 0
+        self.misses = 0
+
+        # Front layer of the most recently used entries, oldest first
+        self._memory = OrderedDict()
+
+        # Times of lookups answered from memory, not yet in the file
+        self._accessed = {}
+        self._written = time()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Open the file and create the table the first time it is used
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+                )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocode ("
+                "key TEXT PRIMARY KEY, lat REAL, lon REAL, "
+                "created REAL, accessed REAL)"
+                )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS geocode_accessed "
+                "ON geocode (accessed)"
+                )
+        return self._connection
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now-created > self.ttl
+
+    def _write_accessed(self, connection, now):
+        # Write the access times of memory hits to the file in one go, for
+        # the caller to commit
+        if self._accessed:
+            connection.executemany(
+                "UPDATE geocode SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()]
+                )
+            self._accessed.clear()
+        self._written = now
+
+    def _remember(self, key, entry):
+        # Add to the front layer, dropping the least recently used entry
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, user_input):
+        '''Return the latitude and longitude stored for an input, or None
+
+        Parameters:
+        user_input         The input which was geocoded
+        '''
+        key = normalise(user_input)
+        now = time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[2], now):
+                self._memory.move_to_end(key)
+                self._accessed[key] = now
+                if now-self._written >= self.write_interval:
+                    connection = self._connect()
+                    self._write_accessed(connection, now)
+                    connection.commit()
+                self.hits += 1
+                return entry[0], entry[1]
+
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT lat, lon, created FROM geocode WHERE key = ?", (key,)
+                ).fetchone()
+
+            # Missing and expired entries both count as misses
+            if row is None or self._expired(row[2], now):
+                if row is not None:
+                    connection.execute(
+                        "DELETE FROM geocode WHERE key = ?", (key,)
+                        )
+                    connection.commit()
+                self._memory.pop(key, None)
+                self._accessed.pop(key, None)
+                self.misses += 1
+                return None
+
+            connection.execute(
+                "UPDATE geocode SET accessed = ? WHERE key = ?", (now, key)
+                )
+            connection.commit()
+            self._remember(key, row)
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, user_input, lat, lon):
+        '''Store the latitude and longitude for an input
+
+        Parameters:
+        user_input         The input which was geocoded
+        lat                The latitude it resolved to
+        lon                The longitude it resolved to
+        '''
+        key = normalise(user_input)
+        now = time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)",
+                (key, lat, lon, now, now)
+                )
+            self._accessed.pop(key, None)
+
+            # Remove the least recently used entries over the limit, once
+            # the file knows which were used from memory
+            self._write_accessed(connection, now)
+            size = connection.execute(
+                "SELECT COUNT(*) FROM geocode"
+                ).fetchone()[0]
+            if size > self.max_entries:
+                for (old_key,) in connection.execute(
+                        "SELECT key FROM geocode ORDER BY accessed LIMIT ?",
+                        (size-self.max_entries,)
+                        ).fetchall():
+                    connection.execute(
+                        "DELETE FROM geocode WHERE key = ?", (old_key,)
+                        )
+                    self._memory.pop(old_key, None)
+                    self._accessed.pop(old_key, None)
+
+            connection.commit()
+            self._remember(key, (lat, lon, now))
+
+    def clear(self):
+        '''Remove every entry from the cache
+
+        '''
+        with self._lock:
+            self._memory.clear()
+            self._accessed.clear()
+            connection = self._connect()
+            connection.execute("DELETE FROM geocode")
+            connection.commit()
+
+    def stats(self):
+        '''Return the hit and miss counts and the number of entries
+
+        '''
+        with self._lock:
+            size = self._connect().execute(
+                "SELECT COUNT(*) FROM geocode"
+                ).fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": size,
+                "in_memory": len(self._memory),
+                }
+
+
+class MatrixCache:
+    '''Travel times between locations kept in an SQLite file
+
+    Several processes may use the same file at once, so travel times fetched
+    by one are found by the others. The file is only opened when it is
+    first needed, separately in each process.
+
+    Attributes:
+    path               The SQLite file holding the cache
+    ttl                Seconds an entry stays valid, forever if None
+
+    Methods:
+    get                Return the stored travel times from some origins
+    put                Store a block of travel times
+    clear              Remove every entry
+    '''
+    # Most origins looked up in one query, within SQLite's parameter limit
+    _QUERY_SIZE = 500
+
+    def __init__(self, path, ttl=7*24*3600):
+        self.path = path
+        self.ttl = ttl
+
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections cannot be sent to another process
+        return {"path": self.path, "ttl": self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["ttl"])
+
+    def _connect(self):
+        # Open the file and create the table the first time it is used
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+                )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS duration ("
+                "mode TEXT, origin TEXT, destination TEXT, "
+                "seconds REAL, created REAL, "
+                "PRIMARY KEY (mode, origin, destination))"
+                )
+        return self._connection
+
+    def get(self, mode, origins, destinations):
+        '''Return the stored travel times from origins to destinations, as
+        a dictionary by origin then destination
+
+        Parameters:
+        mode               The transport mode, as used by Google Maps
+        origins            The standardised locations to travel from
+        destinations       The standardised locations to travel to
+        '''
+        origins = list(origins)
+        wanted = set(destinations)
+        oldest = None if self.ttl is None else time()-self.ttl
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(origins), self._QUERY_SIZE):
+                chunk = origins[start:start+self._QUERY_SIZE]
+                rows = connection.execute(
+                    "SELECT origin, destination, seconds, created "
+                    "FROM duration WHERE mode = ? AND origin IN ("
+                    +",".join("?"*len(chunk))+")",
+                    [mode]+chunk
+                    )
+                for origin, destination, seconds, created in rows:
+                    if destination in wanted and (
+                            oldest is None or created >= oldest):
+                        found.setdefault(origin, {})[destination] = seconds
+        return found
+
+    def put(self, mode, origins, destinations, durations):
+        '''Store a block of travel times
+
+        Parameters:
+        mode               The transport mode, as used by Google Maps
+        origins            The standardised locations travelled from
+        destinations       The standardised locations travelled to
+        durations          The travel times, with a row for each origin
+        '''
+        now = time()
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO duration VALUES (?, ?, ?, ?, ?)",
+                (
+                    (mode, origin, destination, float(seconds), now)
+                    for origin, row in zip(origins, durations)
+                    for destination, seconds in zip(destinations, row)
+                    )
+                )
+            connection.commit()
+
+    def clear(self):
+        '''Remove every entry from the cache
+
+        '''
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM duration")
+            connection.commit()
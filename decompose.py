@@ -0,0 +1,434 @@
+'''Planning of very large routes by splitting the stops into clusters
+
+A route through thousands of stops is too large for a full distance matrix,
+so the stops are grouped by position with k-means and the clusters are put
+in order. Each cluster is entered at the stop nearest the cluster before
+it and left at the stop nearest the cluster after it, so the routes of the
+clusters join up, and each is then searched on its own in a worker process.
+Finally the stops either side of each join are improved together.
+
+Travel times are only asked for within each cluster and around each join,
+which is roughly n*cluster_size elements rather than the n^2 of a full
+matrix.
+
+Usage:
+points = decompose.project(lats, lons)
+cost, route, details = decompose.solve(points, matrix_for, time_budget=30)
+'''
+import math
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from time import time
+
+import numpy as np
+
+import distance
+import metrics
+import search
+
+# Stops in each cluster, on average
+DEFAULT_CLUSTER_SIZE = 300
+
+# Stops either side of a join which are improved together
+DEFAULT_REPAIR_LENGTH = 8
+
+# Rounds of k-means used to place the clusters
+_KMEANS_ITERATIONS = 10
+
+# Clusters larger than this many times the cluster size are cut in two
+_OVERSIZE = 1.5
+
+# Largest cluster, counting its two fixed ends, searched exactly
+_EXACT_SIZE = 12
+
+# Largest number of elements worked on at once when placing the clusters
+_BLOCK_ELEMENTS = 2**22
+
+# Shares of the time budget given to ordering and to searching the clusters
+_ORDER_SHARE = 0.05
+_CLUSTER_SHARE = 0.8
+
+
+def project(lats, lons):
+    '''Return the positions of points in metres on a flat map centred on
+    them, with a row for each point
+
+    Distances on the map are close to those on the ground for stops within
+    a few hundred kilometres of each other, which is all the clustering
+    needs.
+
+    Parameters:
+    lats               The latitudes of the points in degrees
+    lons               The longitudes of the points in degrees
+    '''
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    centre = lats.mean() if len(lats) else 0.0
+
+    # Longitudes wrap around, so they are measured from the first point
+    turns = (lons-(lons[0] if len(lons) else 0.0)+180) % 360-180
+    x = np.radians(turns)*math.cos(math.radians(centre))
+    y = np.radians(lats-centre)
+    return np.stack([x, y], axis=1)*distance.EARTH_RADIUS
+
+def _distances(origins, destinations):
+    # Straight line distances between two sets of points
+    return np.sqrt(
+        ((origins[:, None, :]-destinations[None, :, :])**2).sum(axis=2)
+        )
+
+def _path_cost(costs, route):
+    # Total cost of the steps along a route
+    route = np.asarray(route, dtype=np.intp)
+    return float(costs[route[:-1], route[1:]].sum())
+
+def _nearest_centre(points, centres):
+    # The index of the closest centre to each point, a block at a time
+    labels = np.empty(len(points), dtype=np.intp)
+    norms = (centres**2).sum(axis=1)
+    rows = max(1, _BLOCK_ELEMENTS//len(centres))
+    for start in range(0, len(points), rows):
+        values = points[start:start+rows]@centres.T
+        values *= -2
+        values += norms
+        labels[start:start+rows] = values.argmin(axis=1)
+    return labels
+
+def _bisect(points, indexes, limit):
+    # Cut a cluster across its widest side until every part fits the limit
+    parts = []
+    waiting = [indexes]
+    while waiting:
+        part = waiting.pop()
+        if len(part) <= limit:
+            parts.append(part)
+            continue
+        axis = int(np.ptp(points[part], axis=0).argmax())
+        order = part[np.argsort(points[part, axis], kind="stable")]
+        waiting.extend(np.array_split(order, 2))
+    return parts
+
+def partition(points, cluster_size=DEFAULT_CLUSTER_SIZE, seed=0):
+    '''Group points by position and return the indexes of each group
+
+    The groups are found with k-means, starting from randomly chosen
+    points, and any group which ends up much larger than cluster_size is
+    cut in two.
+
+    Parameters:
+    points             The positions of the points, with a row for each
+    cluster_size       The number of points in each group, on average
+    seed               The seed used to choose the starting centres
+    '''
+    points = np.asarray(points, dtype=float)
+    size = len(points)
+    if size <= cluster_size:
+        return [np.arange(size)]
+
+    count = math.ceil(size/cluster_size)
+    rng = np.random.default_rng(seed)
+    centres = points[rng.choice(size, count, replace=False)]
+
+    # Move each centre to the middle of its points, dropping those left empty
+    for _ in range(_KMEANS_ITERATIONS):
+        labels = _nearest_centre(points, centres)
+        counts = np.bincount(labels, minlength=len(centres))
+        sums = np.stack([
+            np.bincount(labels, points[:, axis], minlength=len(centres))
+            for axis in range(points.shape[1])
+            ], axis=1)
+        kept = counts > 0
+        centres = sums[kept]/counts[kept, None]
+
+    labels = _nearest_centre(points, centres)
+    order = np.argsort(labels, kind="stable")
+    bounds = np.flatnonzero(np.diff(labels[order]))+1
+
+    clusters = []
+    for cluster in np.split(order, bounds):
+        clusters.extend(
+            _bisect(points, cluster, int(cluster_size*_OVERSIZE))
+            )
+    return clusters
+
+def order_clusters(points, clusters, time_budget=None):
+    '''Return the order to visit clusters in, as a route between their
+    centres
+
+    Parameters:
+    points             The positions of the points, with a row for each
+    clusters           The indexes of the points in each cluster
+    time_budget        Seconds the search may take, no limit if not given
+    '''
+    if len(clusters) < 3:
+        return list(range(len(clusters)))
+    centres = np.array([points[cluster].mean(axis=0) for cluster in clusters])
+    return list(search.solve(_distances(centres, centres), time_budget)[1])
+
+def _joins(points, clusters):
+    '''Return where each cluster is entered and left, as positions within
+    the cluster, choosing the closest pair of stops across each join
+
+    The first cluster may be entered anywhere and the last left anywhere,
+    which is shown by None.
+
+    Parameters:
+    points             The positions of the points, with a row for each
+    clusters           The indexes of the points in each cluster, in order
+    '''
+    firsts = [None]*len(clusters)
+    lasts = [None]*len(clusters)
+    for position in range(len(clusters)-1):
+        here, after = clusters[position], clusters[position+1]
+        gaps = _distances(points[here], points[after])
+
+        # A cluster must be left from a different stop to its entrance
+        if len(here) > 1 and firsts[position] is not None:
+            gaps[firsts[position]] = np.inf
+        leave, enter = divmod(int(gaps.argmin()), len(after))
+        lasts[position] = leave
+        firsts[position+1] = enter
+    return firsts, lasts
+
+def _fixed_ends(costs, first, last):
+    '''Return the matrix with a start and an end location added, so the
+    best route from the start to the end runs from first to last
+
+    The start leads only to first and the end is only reached from last.
+    Any other step to or from them costs more than a whole route, so no
+    search will move them. A first or last of None leaves that end free.
+
+    Parameters:
+    costs              Distance matrix as an array
+    first              The location the route must begin at, or None
+    last               The location the route must finish at, or None
+    '''
+    size = len(costs)
+    finite = np.isfinite(costs)
+    longest = costs[finite].max() if finite.any() else 0.0
+    big = (abs(longest)+1)*(size+2)
+
+    augmented = np.full((size+2, size+2), big)
+    augmented[:size, :size] = np.where(finite, costs, big)
+    if first is None:
+        augmented[size, :size] = 0
+    else:
+        augmented[size, first] = 0
+    if last is None:
+        augmented[:size, size+1] = 0
+    else:
+        augmented[last, size+1] = 0
+    return augmented
+
+def _greedy_path(costs, first, last):
+    '''Return a route from first to last built by nearest_neighbour
+
+    Parameters:
+    costs              Distance matrix as an array
+    first              The location the route must begin at, or None
+    last               The location the route must finish at, or None
+    '''
+    size = len(costs)
+    if size == 1:
+        return [0]
+
+    # A fixed finish alone is a fixed start on the reversed route
+    if first is None and last is not None:
+        return _greedy_path(costs.T, last, None)[::-1]
+
+    others = [node for node in range(size) if node != last]
+    starts = None if first is None else [others.index(first)]
+    _, route = search.nearest_neighbour(
+        costs[np.ix_(others, others)], starts=starts
+        )
+    path = [others[node] for node in route]
+    if last is not None:
+        path.append(last)
+    return path
+
+def solve_cluster(costs, first=None, last=None, time_limit=None):
+    '''Return the cost and the best route found through one cluster, from
+    first to last
+
+    Small clusters are searched exactly with held_karp. Larger ones are
+    built with nearest_neighbour and improved with local_search.
+
+    Parameters:
+    costs              Distance matrix of the cluster
+    first              The location the route must begin at, or None
+    last               The location the route must finish at, or None
+    time_limit         Most seconds to spend improving, no limit if not given
+    '''
+    costs = np.asarray(costs, dtype=float)
+    size = len(costs)
+    if size == 1:
+        return 0.0, [0]
+    if first is None and last is None:
+        cost, route, _ = search.solve(costs, time_limit)
+        return float(cost), list(route)
+
+    augmented = _fixed_ends(costs, first, last)
+    if size+2 <= _EXACT_SIZE:
+        _, route = search.held_karp(augmented)
+    else:
+        route = [size]+_greedy_path(costs, first, last)+[size+1]
+        _, route = search.local_search(augmented, route,
+                                       time_limit=time_limit)
+    route = [int(node) for node in route[1:-1]]
+    return _path_cost(costs, route), route
+
+def _solve_clusters(clusters, firsts, lasts, matrix_for, time_limit, workers,
+                    stop):
+    '''Return the cost and route of each cluster, with the routes given as
+    indexes of the points
+
+    The matrices are fetched here and the clusters searched on a pool of
+    processes. Once stop is set, clusters already being searched are
+    finished and the rest are given their greedy route instead.
+
+    Parameters:
+    clusters           The indexes of the points in each cluster, in order
+    firsts             Where each cluster is entered, or None
+    lasts              Where each cluster is left, or None
+    matrix_for         Function returning the distance matrix between points
+    time_limit         Most seconds to spend on each cluster
+    workers            The number of processes, searched here if 1
+    stop               An event which stops the search early once set
+    '''
+    matrices = [
+        np.asarray(matrix_for(cluster.tolist()), dtype=float)
+        for cluster in clusters
+        ]
+    jobs = list(zip(matrices, firsts, lasts))
+
+    if workers == 1:
+        found = []
+        for costs, first, last in jobs:
+            if stop is not None and stop.is_set():
+                path = _greedy_path(costs, first, last)
+                found.append((_path_cost(costs, path), path))
+            else:
+                found.append(solve_cluster(costs, first, last, time_limit))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(solve_cluster, costs, first, last, time_limit)
+                for costs, first, last in jobs
+                ]
+            found = []
+            for future, (costs, first, last) in zip(futures, jobs):
+                if stop is not None and stop.is_set():
+                    future.cancel()
+                if future.cancelled():
+                    path = _greedy_path(costs, first, last)
+                    found.append((_path_cost(costs, path), path))
+                else:
+                    found.append(future.result())
+
+    return [
+        (cost, cluster[path].tolist())
+        for (cost, path), cluster in zip(found, clusters)
+        ]
+
+def _repair(route, lengths, matrix_for, repair_length, stop):
+    '''Improve the stops either side of each join between clusters in
+    place, and return the cost of the joins plus the change made
+
+    Each side of a join uses at most half of its cluster, so the stops
+    moved at one join are never moved at the next. The stops just beyond
+    each side are held in place.
+
+    Parameters:
+    route              The joined up route, changed in place
+    lengths            The number of stops in each cluster, in order
+    matrix_for         Function returning the distance matrix between points
+    repair_length      Most stops on each side of a join to improve
+    stop               An event which stops the improvement early once set
+    '''
+    added = 0.0
+    join = 0
+    for before, after in zip(lengths, lengths[1:]):
+        join += before
+        left = min(repair_length, max(0, (before-2)//2))
+        right = min(repair_length, max(0, (after-2)//2))
+        low, high = join-left-1, join+right+1
+        window = route[low:high]
+
+        costs = np.asarray(matrix_for(window), dtype=float)
+        old = _path_cost(costs, range(len(window)))
+        added += costs[left, left+1]-old
+
+        # The stops held in place stay at the ends of the window
+        order = list(range(len(window)))
+        if len(window) > 3 and not (stop is not None and stop.is_set()):
+            augmented = _fixed_ends(costs, 0, len(window)-1)
+            _, order = search.local_search(
+                augmented, [len(window)]+order+[len(window)+1]
+                )
+            order = [int(node) for node in order[1:-1]]
+        added += _path_cost(costs, order)
+        route[low:high] = [window[node] for node in order]
+    return added
+
+def solve(points, matrix_for, cluster_size=DEFAULT_CLUSTER_SIZE,
+          time_budget=None, workers=None, stop=None,
+          repair_length=DEFAULT_REPAIR_LENGTH):
+    '''Split the stops into clusters, search each, and return the cost,
+    route and details of the joined up route in the form search.solve
+    returns
+
+    No bound is known, so the bound and gap are None. Stops which fit in
+    one cluster are handed to search.solve as they are.
+
+    Parameters:
+    points             The positions of the stops, such as from project
+    matrix_for         Function returning the distance matrix between a
+                       list of stops, given by their indexes
+    cluster_size       The number of stops in each cluster, on average
+    time_budget        Seconds the search should take, no limit if not given
+    workers            The number of processes, one per core if not given
+    stop               An event which stops the search early once set
+    repair_length      Most stops on each side of a join to improve
+    '''
+    start = time()
+    points = np.asarray(points, dtype=float)
+    size = len(points)
+    if size <= cluster_size:
+        cost, route, details = search.solve(
+            matrix_for(list(range(size))), time_budget, stop=stop
+            )
+        return cost, list(route), details
+
+    workers = workers or cpu_count() or 1
+    clusters = partition(points, cluster_size)
+    order_budget = cluster_limit = None
+    if time_budget is not None:
+        order_budget = time_budget*_ORDER_SHARE
+        cluster_limit = (time_budget*_CLUSTER_SHARE
+                         *min(workers, len(clusters))/len(clusters))
+
+    # Put the clusters in order and choose where to cross between them
+    clusters = [
+        clusters[index]
+        for index in order_clusters(points, clusters, order_budget)
+        ]
+    firsts, lasts = _joins(points, clusters)
+
+    found = _solve_clusters(clusters, firsts, lasts, matrix_for,
+                            cluster_limit, workers, stop)
+    cost = sum(cluster_cost for cluster_cost, _ in found)
+    route = [stop_index for _, path in found for stop_index in path]
+    cost += _repair(route, [len(cluster) for cluster in clusters],
+                    matrix_for, repair_length, stop)
+
+    details = {
+        "algorithm": "decompose",
+        "bound": None,
+        "gap": None,
+        "elapsed": time()-start,
+        "final": True,
+        "clusters": len(clusters),
+        }
+    metrics.observe("search", details["elapsed"], algorithm="decompose")
+    metrics.count("decompose_clusters", len(clusters))
+    return cost, route, details
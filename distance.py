@@ -0,0 +1,570 @@
+'''Fetching and storage of the travel times between locations
+
+'''
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic, sleep
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import numpy as np
+
+import location
+import metrics
+
+
+class MatrixFetchError(Exception):
+    '''Raised when travel times could not be fetched
+
+    '''
+
+
+class _RetryableError(Exception):
+    '''Raised for responses which may succeed if sent again
+
+    '''
+
+
+def google_request(origins, destinations, mode):
+    '''Send one Distance Matrix request through the googlemaps client and
+    return the response
+
+    Parameters:
+    origins            The locations to travel from
+    destinations       The locations to travel to
+    mode               The transport mode, as used by Google Maps
+    '''
+    return location.client().distance_matrix(origins, destinations, mode=mode)
+
+def http_request(base_url, key=None, timeout=10):
+    '''Return a function which sends Distance Matrix requests to base_url
+
+    This talks to anything serving the Distance Matrix JSON format, such as
+    a local stand-in for testing.
+
+    Parameters:
+    base_url           The server to send requests to
+    key                The API key to send, if any
+    timeout            Seconds to wait for each response
+    '''
+    def request(origins, destinations, mode):
+        query = {
+            "origins": "|".join(origins),
+            "destinations": "|".join(destinations),
+            "mode": mode,
+            }
+        if key is not None:
+            query["key"] = key
+        url = base_url.rstrip("/")+"/maps/api/distancematrix/json?"
+        with urlopen(url+urlencode(query), timeout=timeout) as response:
+            return json.load(response)
+    return request
+
+
+class ChunkedFetcher:
+    '''Fetch travel times in blocks small enough for the API, several at once
+
+    The matrix is split into blocks within the limits on origins,
+    destinations and elements per request. Blocks are sent from a pool of
+    threads, no faster than the rate limit, and a block which fails for a
+    temporary reason is retried with a doubling wait. Elements with no
+    route are given an infinite travel time.
+
+    Attributes:
+    request            Function which sends one request and returns the reply
+    max_origins        Most origins in one request
+    max_destinations   Most destinations in one request
+    max_elements       Most origin and destination pairs in one request
+    workers            Most requests waiting on a reply at once
+    rate               Most requests sent each second
+    retries            Times a failed block is sent again
+    backoff            Seconds waited before the first retry
+    '''
+    def __init__(self, request=google_request, max_origins=25,
+                 max_destinations=25, max_elements=100, workers=8, rate=50,
+                 retries=4, backoff=0.5):
+        self.request = request
+        self.max_origins = max_origins
+        self.max_destinations = max_destinations
+        self.max_elements = max_elements
+        self.workers = workers
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+
+        # Earliest time the next request may be sent
+        self._next_send = monotonic()
+        self._lock = threading.Lock()
+
+    def _wait_for_turn(self):
+        # Space requests evenly to keep under the rate limit
+        with self._lock:
+            now = monotonic()
+            send = max(now, self._next_send)
+            self._next_send = send+1/self.rate
+        sleep(send-now)
+
+    def _transient_errors(self):
+        # Errors worth retrying, including the googlemaps client's own
+        errors = (OSError, _RetryableError)
+        try:
+            from googlemaps import exceptions
+        except ImportError:
+            return errors
+        return errors+(
+            exceptions.TransportError,
+            exceptions.Timeout,
+            exceptions.HTTPError
+            )
+
+    def _fetch_block(self, origins, destinations, mode):
+        # Fetch one block, retrying temporary failures
+        transient = self._transient_errors()
+        for attempt in range(self.retries+1):
+            self._wait_for_turn()
+            try:
+                with metrics.timer("matrix_request", mode=mode):
+                    response = self.request(origins, destinations, mode)
+                status = response.get("status", "OK")
+                if status in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+                    raise _RetryableError(status)
+                if status != "OK":
+                    raise MatrixFetchError(
+                        "Distance Matrix request failed with "+status
+                        )
+                return [
+                    [element["duration"]["value"]
+                     if element.get("status", "OK") == "OK"
+                     else float("inf")
+                     for element in row["elements"]]
+                    for row in response["rows"]
+                    ]
+            except transient as error:
+                if attempt == self.retries:
+                    metrics.count("matrix_request_failures", mode=mode)
+                    raise MatrixFetchError(
+                        "Distance Matrix request failed after "
+                        +str(attempt+1)+" attempts"
+                        ) from error
+                metrics.count("matrix_request_retries", mode=mode)
+                sleep(self.backoff*2**attempt)
+            except location.lookup_errors() as error:
+                # No key, a key which is refused, or an error from the API
+                # will not succeed if sent again
+                metrics.count("matrix_request_failures", mode=mode)
+                raise MatrixFetchError(
+                    "Distance Matrix request failed with "
+                    +type(error).__name__+": "+str(error)
+                    ) from error
+
+    def blocks(self, origins, destinations):
+        '''Return the row and column slices which tile the matrix
+
+        Parameters:
+        origins            The locations to travel from
+        destinations       The locations to travel to
+        '''
+        rows = max(1, min(self.max_origins, len(origins), self.max_elements))
+        columns = max(1, min(
+            self.max_destinations, len(destinations), self.max_elements//rows
+            ))
+        return [
+            (slice(row, row+rows), slice(column, column+columns))
+            for row in range(0, len(origins), rows)
+            for column in range(0, len(destinations), columns)
+            ]
+
+    def __call__(self, origins, destinations, mode):
+        '''Fetch the travel times between locations and return as an array,
+        with a row for each origin
+
+        Parameters:
+        origins            The locations to travel from
+        destinations       The locations to travel to
+        mode               The transport mode, as used by Google Maps
+        '''
+        origins = list(origins)
+        destinations = list(destinations)
+        durations = np.empty((len(origins), len(destinations)))
+        if not origins or not destinations:
+            return durations
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {
+                pool.submit(
+                    self._fetch_block,
+                    origins[rows], destinations[columns], mode
+                    ): (rows, columns)
+                for rows, columns in self.blocks(origins, destinations)
+                }
+            for future, (rows, columns) in futures.items():
+                durations[rows, columns] = future.result()
+
+        return durations
+
+
+# Mean radius of the Earth in metres
+EARTH_RADIUS = 6371008.8
+
+# Typical speed in metres per second for each transport mode, and how much
+# longer the route taken is than the great circle between the ends
+SPEED_PROFILES = {
+    "walking": (1.35, 1.3),
+    "bicycling": (4.2, 1.3),
+    "driving": (11.1, 1.35),
+    "transit": (6.9, 1.4),
+    }
+
+# Most elements worked on at once when computing distances
+_GEODESIC_BLOCK_ELEMENTS = 2**22
+
+
+def _unit_vectors(lats, lons):
+    # Points on a sphere of radius one, with a row for each point
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    cos_lats = np.cos(lats)
+    return np.stack(
+        [cos_lats*np.cos(lons), cos_lats*np.sin(lons), np.sin(lats)], axis=1
+        )
+
+def geodesic_blocks(lats, lons, dest_lats=None, dest_lons=None):
+    '''Yield the great circle distances in metres between points, a block of
+    rows at a time, along with the slice of rows each block covers
+
+    Distances are on a sphere of the Earth's mean radius, which is within
+    0.5% of the distance on the ellipsoid. The angle between two points is
+    found from the dot product of their positions, so each block is one
+    matrix product, and blocks are sized so memory stays bounded however
+    many points there are. Rounding makes distances up to a few centimetres
+    out, which is far below the accuracy of any travel time estimate.
+
+    Parameters:
+    lats               The latitudes of the origins in degrees
+    lons               The longitudes of the origins in degrees
+    dest_lats          The latitudes of the destinations, the origins if not given
+    dest_lons          The longitudes of the destinations
+    '''
+    origins = _unit_vectors(lats, lons)
+    if dest_lats is None:
+        destinations = origins
+    else:
+        destinations = _unit_vectors(dest_lats, dest_lons)
+
+    rows = max(1, _GEODESIC_BLOCK_ELEMENTS//max(1, len(destinations)))
+    for start in range(0, len(origins), rows):
+        block = slice(start, start+rows)
+
+        # The haversine of the angle between each pair of points
+        values = origins[block]@destinations.T
+        np.subtract(1, values, out=values)
+        values *= 0.5
+        np.clip(values, 0, 1, out=values)
+
+        np.sqrt(values, out=values)
+        np.arcsin(values, out=values)
+        values *= 2*EARTH_RADIUS
+
+        # Rounding leaves points a little way from themselves
+        if destinations is origins:
+            rows_in_block = np.arange(values.shape[0])
+            values[rows_in_block, rows_in_block+start] = 0
+        yield block, values
+
+def geodesic_matrix(lats, lons, dest_lats=None, dest_lons=None,
+                    dtype=np.float64):
+    '''Return the great circle distances in metres between points, with a
+    row for each origin
+
+    Parameters:
+    lats               The latitudes of the origins in degrees
+    lons               The longitudes of the origins in degrees
+    dest_lats          The latitudes of the destinations, the origins if not given
+    dest_lons          The longitudes of the destinations
+    dtype              The type of the array, float32 halves the memory used
+    '''
+    columns = len(lats) if dest_lats is None else len(dest_lats)
+    distances = np.empty((len(lats), columns), dtype=dtype)
+    for block, values in geodesic_blocks(lats, lons, dest_lats, dest_lons):
+        distances[block] = values
+    return distances
+
+def estimate_durations(lats, lons, mode, dest_lats=None, dest_lons=None,
+                       dtype=np.float64):
+    '''Return estimated travel times in seconds between points, with a row
+    for each origin
+
+    The great circle distance is lengthened to allow for the route not being
+    straight, then divided by the typical speed of the transport mode.
+
+    Parameters:
+    lats               The latitudes of the origins in degrees
+    lons               The longitudes of the origins in degrees
+    mode               The transport mode, as used by Google Maps
+    dest_lats          The latitudes of the destinations, the origins if not given
+    dest_lons          The longitudes of the destinations
+    dtype              The type of the array, float32 halves the memory used
+    '''
+    speed, detour = SPEED_PROFILES[mode]
+    columns = len(lats) if dest_lats is None else len(dest_lats)
+    durations = np.empty((len(lats), columns), dtype=dtype)
+    for block, values in geodesic_blocks(lats, lons, dest_lats, dest_lons):
+        values *= detour/speed
+        durations[block] = values
+    return durations
+
+def estimate_fetch(origins, destinations, mode):
+    '''Estimate the travel times between standardised locations and return
+    as an array, with a row for each origin
+
+    This takes the same arguments as ChunkedFetcher, so it can be used by a
+    DistanceMatrixStore which must work without Google Maps.
+
+    Parameters:
+    origins            The locations to travel from, as "lat,lon"
+    destinations       The locations to travel to, as "lat,lon"
+    mode               The transport mode, as used by Google Maps
+    '''
+    origins = np.array(
+        [location.parse_lat_lon(origin) for origin in origins]
+        ).reshape(-1, 2)
+    destinations = np.array(
+        [location.parse_lat_lon(destination) for destination in destinations]
+        ).reshape(-1, 2)
+    return estimate_durations(
+        origins[:, 0], origins[:, 1], mode,
+        destinations[:, 0], destinations[:, 1]
+        )
+
+def nearest_candidates(lats, lons, count):
+    '''Return the indexes of the nearest other points to each point, closest
+    first, with a row for each point
+
+    Only these pairs need exact travel times when building a sparse
+    matrix, since good routes rarely join points far apart.
+
+    Parameters:
+    lats               The latitudes of the points in degrees
+    lons               The longitudes of the points in degrees
+    count              The number of neighbours to find for each point
+    '''
+    count = min(count, len(lats)-1)
+    nearest = np.empty((len(lats), max(count, 0)), dtype=np.intp)
+    if count <= 0:
+        return nearest
+
+    for block, values in geodesic_blocks(lats, lons):
+        rows = np.arange(values.shape[0])
+        values[rows, rows+block.start] = np.inf
+
+        # Pick the closest without sorting the whole row, then sort those
+        closest = np.argpartition(values, count-1, axis=1)[:, :count]
+        order = np.argsort(values[rows[:, None], closest], axis=1)
+        nearest[block] = closest[rows[:, None], order]
+    return nearest
+
+
+class DistanceMatrixStore:
+    '''Travel times between pairs of locations, kept between searches
+
+    Only the travel times which are not already known are fetched, so adding
+    one location to n others costs 2n elements rather than n^2. Travel
+    times are kept separately for each transport mode. With a MatrixCache,
+    travel times are also kept on disk and shared with other processes.
+
+    Attributes:
+    fetch              Function used to fetch travel times
+    cache              The cache.MatrixCache shared between processes, if any
+    estimated          Whether fetch only estimates travel times
+    durations          Travel times by mode, then origin, then destination
+
+    Methods:
+    matrix             Return the distance matrix for a list of locations
+    estimate           Return estimated travel times for a list of locations
+    discard            Forget every travel time to or from a location
+    clear              Forget every travel time
+    '''
+    def __init__(self, fetch=None, cache=None, estimated=False):
+        self.fetch = ChunkedFetcher() if fetch is None else fetch
+        self.cache = cache
+        self.estimated = estimated
+        self.durations = {}
+
+        # Searches may run on another thread to the one removing locations,
+        # and the lock is only held while the tables are read or changed so
+        # that fetches for different searches run at once
+        self._lock = threading.RLock()
+
+        # Futures of the travel times being fetched, by mode then origin and
+        # destination, so that no travel time is fetched twice at once
+        self._pending = {}
+
+    def _store(self, origins, destinations, mode):
+        # Fetch a block of travel times and add them to the table
+        with metrics.timer("matrix_fetch", mode=mode):
+            rows = self.fetch(origins, destinations, mode)
+        metrics.count("matrix_elements_fetched",
+                      len(origins)*len(destinations), mode=mode)
+        if self.cache is not None:
+            self.cache.put(mode, origins, destinations, rows)
+        with self._lock:
+            table = self.durations.setdefault(mode, {})
+            for origin, row in zip(origins, rows):
+                known = table.setdefault(origin, {})
+                for destination, duration in zip(destinations, row):
+                    known[destination] = duration
+
+    def _load(self, unique, mode):
+        # Look on disk for travel times not held in memory
+        with self._lock:
+            table = self.durations.setdefault(mode, {})
+            incomplete = [
+                origin for origin in unique
+                if origin not in table
+                or any(loc not in table[origin] for loc in unique)
+                ]
+        if not incomplete:
+            return
+        found = self.cache.get(mode, incomplete, unique)
+        with self._lock:
+            for origin, known in found.items():
+                table.setdefault(origin, {}).update(known)
+                metrics.count("matrix_cache_elements", len(known), mode=mode)
+
+    def _claim(self, table, unique, mode):
+        # Split the travel times not known into blocks for this thread to
+        # fetch and the futures of those another thread is fetching
+        pending = self._pending.setdefault(mode, {})
+        missing = {}
+        waiting = set()
+        for origin in unique:
+            known = table.get(origin, {})
+            for destination in unique:
+                if destination in known:
+                    continue
+                future = pending.get((origin, destination))
+                if future is None:
+                    missing.setdefault(origin, []).append(destination)
+                else:
+                    waiting.add(future)
+
+        # Origins missing the same destinations share a request, so a new
+        # location's row and column take two blocks
+        grouped = {}
+        for origin, destinations in missing.items():
+            grouped.setdefault(tuple(destinations), []).append(origin)
+        blocks = []
+        for destinations, origins in grouped.items():
+            future = Future()
+            for origin in origins:
+                for destination in destinations:
+                    pending[origin, destination] = future
+            blocks.append((origins, list(destinations), future))
+        return blocks, waiting
+
+    def _release(self, mode, origins, destinations, future, error=None):
+        # Let threads waiting on a block know it is done
+        with self._lock:
+            pending = self._pending[mode]
+            for origin in origins:
+                for destination in destinations:
+                    if pending.get((origin, destination)) is future:
+                        del pending[origin, destination]
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def _fetch_blocks(self, blocks, mode):
+        # Fetch each claimed block, passing any failure to those waiting
+        for index, (origins, destinations, future) in enumerate(blocks):
+            try:
+                self._store(origins, destinations, mode)
+            except BaseException as error:
+                for origins, destinations, future in blocks[index:]:
+                    self._release(mode, origins, destinations, future, error)
+                raise
+            self._release(mode, origins, destinations, future)
+
+    def matrix(self, locations, mode):
+        '''Return the distance matrix between locations, fetching only the
+        travel times not already known
+
+        Travel times already being fetched for another search are waited
+        for rather than fetched again.
+
+        Parameters:
+        locations          The standardised locations, in matrix order
+        mode               The transport mode, as used by Google Maps
+        '''
+        unique = list(dict.fromkeys(locations))
+        if self.cache is not None:
+            self._load(unique, mode)
+
+        # Travel times may be discarded while waiting, so check again after
+        while True:
+            with self._lock:
+                table = self.durations.setdefault(mode, {})
+                blocks, waiting = self._claim(table, unique, mode)
+                if not blocks and not waiting:
+                    return [
+                        [table[origin][destination]
+                         for destination in locations]
+                        for origin in locations
+                        ]
+            self._fetch_blocks(blocks, mode)
+            for future in waiting:
+                future.result()
+
+    def estimate(self, locations, mode, coordinates=None):
+        '''Return estimated travel times between locations without using
+        the network, for previews and for when fetching fails
+
+        Travel times which are already known are used in place of the
+        estimates.
+
+        Parameters:
+        locations          The standardised locations, in matrix order
+        mode               The transport mode, as used by Google Maps
+        coordinates        Array with a row of latitude and longitude for
+                           each location, parsed from them if not given
+        '''
+        if coordinates is None:
+            coordinates = [location.parse_lat_lon(place) for place in locations]
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        durations = estimate_durations(
+            coordinates[:, 0], coordinates[:, 1], mode
+            )
+
+        # Positions of each location, which may appear more than once
+        positions = {}
+        for index, place in enumerate(locations):
+            positions.setdefault(place, []).append(index)
+
+        with self._lock:
+            table = self.durations.get(mode, {})
+            for origin, rows in positions.items():
+                for destination, duration in table.get(origin, {}).items():
+                    for column in positions.get(destination, []):
+                        durations[rows, column] = duration
+        return durations.tolist()
+
+    def discard(self, place):
+        '''Forget every travel time to or from a location
+
+        Parameters:
+        place              The standardised location to forget
+        '''
+        with self._lock:
+            for table in self.durations.values():
+                table.pop(place, None)
+                for known in table.values():
+                    known.pop(place, None)
+
+    def clear(self):
+        '''Forget every travel time
+
+        '''
+        with self._lock:
+            self.durations.clear()
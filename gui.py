@@ -2,14 +2,17 @@
 
 '''
 
+import math
+import queue
+import threading
 import tkinter as tk
-from time import time
-
-from PIL import ImageTk
-from goompy import GooMPy
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+import distance
 import location
-import search
+import planner
+import tiles
 
 class RoutePlanGUI:
     '''The GUI for the Route Planning System
@@ -23,22 +26,39 @@ class RoutePlanGUI:
         #max_width
     transport_mode     Transport mode setting 
     locations          List of all the current locations
+    matrix_store       Travel times between locations fetched so far
     location_view      Index of what can currently be viewed
     VIEW_SIZE          A limit of how many items can be viewed at one time to ensure they fit on screen
+    SEARCH_TIME        The number of seconds a search is allowed to take
     latitude           The current latitude  of the device running the system
     longitude          The cyrrent longitude of the device running the system
     zoom               The zoom level of the tiles
     map_width          The width  of the displayed map
     map_height         The height of the displayed map
-    goompy             A goompy object to act as the API to download the map tiles
+    tile_map           The map view, drawn from cached tiles
+    image_tk           The Tk image the map is drawn on, reused between redraws
 
     Methods:
     _draw_UI           Creates the UI features and places them in the correct location
     _redraw_map        Redraws the map
+    _map_zoom          Zooms the map in or out
     _add_location      Adds a location to the list of locations
+    _location_found    Adds a location made in the background to the list
+    _import_locations  Adds every location listed in a file
+    _locations_imported Adds locations imported in the background to the list
+    _show_location     Adds a location to the list and shows it to the user
     _remove_location   Removes a location from the list of locations
     _move_boxes        Moves the displayed list of locations
     _search            Runs the search algorithm after fetching and passing it data
+    _plan              Fetches the distance matrix and searches it in the background
+    _route_found       Tells the user the route found in the background
+    _show_best         Shows the best route found so far by a running search
+    _accept            Stops the search and uses the best route found so far
+    _show_route        Tells the user which route is best
+    _in_background     Runs work on a background thread and hands back the result
+    _show_progress     Shows the progress and best route of background work
+    _cancel            Stops the search which is running
+    _close             Stops any background work and closes the window
     '''
 
     def __init__(self, root):
@@ -52,7 +72,8 @@ class RoutePlanGUI:
 
 ##        self.root.bind("<Key>", self.user_input)
 ##        self.root.bind("<Button>", self.user_input)
-        self.root.bind("<Escape>", lambda e: self.root.destroy())
+        self.root.bind("<Escape>", lambda e: self._close())
+        self.root.protocol("WM_DELETE_WINDOW", self._close)
         
         # The user is able to select differnt modes of transportation
         # They are diffined here, as well as the mechanism for storing them
@@ -60,8 +81,11 @@ class RoutePlanGUI:
         self.transport_mode.set("Walking")
         self.transport_modes = ["Walking", "Bicycling", "Driving", "Transit"] 
 
-        # All the locations the user is using, stored in a list
-        self.locations = []
+        # All the locations the user is using, with their coordinates in arrays
+        self.locations = location.LocationStore()
+
+        # Travel times already fetched, kept between searches
+        self.matrix_store = distance.DistanceMatrixStore()
 
         # The index used to calualate which locations are currently visable
         self.location_view = 0
@@ -70,12 +94,26 @@ class RoutePlanGUI:
         # than possible
         self.VIEW_SIZE = 10
 
+        # The number of seconds a search is allowed to take
+        self.SEARCH_TIME = 5
+
+        # Geocoding and searching run on background threads, one job at a
+        # time each, so the window stays responsive while they work
+        self.location_executor = ThreadPoolExecutor(max_workers=1)
+        self.search_executor   = ThreadPoolExecutor(max_workers=1)
+        self.searching = False
+        self.stop_search = threading.Event()
+
+        # The best route found by a running search
+        self.best_route = None
+        self.accepted = False
+
+        # Milliseconds between checks on background work
+        self.POLL_TIME = 100
+
         # The coordinates of the current location of the user
-        self.latitude  = float(
-            location.CURRENT_LOCATION[:location.CURRENT_LOCATION.find(",")]
-            )
-        self.longitude = float(
-            location.CURRENT_LOCATION[location.CURRENT_LOCATION.find(",")+1:]
+        self.latitude, self.longitude = location.parse_lat_lon(
+            location.current_location()
             )
 
         # The zoom level on the map
@@ -85,10 +123,19 @@ class RoutePlanGUI:
         self.map_width  = 500
         self.map_height = 500
 
-        # GooMPy object to act as an API
-        self.goompy = GooMPy(self.map_width, self.map_height, self.latitude, self.longitude, self.zoom, "roadmap")
+        # The map view, whose tiles are cached in memory and on disk and
+        # fetched in the background, so drawing never waits on the network
+        self.tile_map = tiles.TileMap(
+            self.map_width,
+            self.map_height,
+            self.latitude,
+            self.longitude,
+            self.zoom,
+            "roadmap"
+            )
+        self.image_tk = None
 
-        self.live = False
+        self.live = True
 
         # Starts the system
         self._draw_UI()
@@ -146,7 +193,16 @@ class RoutePlanGUI:
             command=self._add_location
             )
 
+        # Import button, for adding many locations from a file at once
+        self.import_button = tk.Button(
+            self.frame,
+            text="Import",
+            bg="yellow",
+            command=self._import_locations
+            )
+
         # Configureation of the widgets just defined
+        self.import_button.grid(row=1, column=2, sticky="e")
         self.entry_box.grid(row=2, column=0, columnspan=4, sticky="ew")
         self.entry_button.grid(row=2, column=4)
         self.go_button.grid(row=1, column=3, columnspan=2, sticky="e")
@@ -165,7 +221,29 @@ class RoutePlanGUI:
         self.zoom_in_button  = tk.Button(self.canvas, text="+", width=1, command=lambda:self._map_zoom(+1))
         self.zoom_out_button = tk.Button(self.canvas, text="-", width=1, command=lambda:self._map_zoom(-1))
 
-        # Packing of the two layout features
+        # Status of any background work, and a button to stop a search
+        self.status_frame = tk.Frame(self.root)
+        self.status = tk.StringVar()
+        tk.Label(
+            self.status_frame,
+            textvariable=self.status,
+            anchor="w"
+            ).pack(side="left", fill="x", expand=True)
+        self.cancel_button = tk.Button(
+            self.status_frame,
+            text="Cancel",
+            bg="red",
+            command=self._cancel
+            )
+        self.accept_button = tk.Button(
+            self.status_frame,
+            text="Accept",
+            bg="green",
+            command=self._accept
+            )
+
+        # Packing of the layout features
+        self.status_frame.pack(side="bottom", fill="x")
         self.frame.pack(side="left", fill="y")
         self.canvas.pack(side="right", expand=True, fill="both")
 
@@ -181,17 +259,22 @@ class RoutePlanGUI:
 
         
     def _redraw_map(self):
-        '''Fetch a new tile and place that on the map
+        '''Draw the map from the cached tiles
 
+        Tiles not yet fetched are drawn blank, and the map is drawn again
+        once they arrive.
         '''
 ##        print("redrawing")
-        # Get the tile that goompy has been told to fetch
-        self.goompy._fetch_and_update()
-        self.image = self.goompy.getImage()
-
-        # Load the image tile onto the map
-        self.image_tk = ImageTk.PhotoImage(self.image)
-        self.label['image'] = self.image_tk
+        # Draw whatever tiles are already held
+        self.image, loading = self.tile_map.render()
+
+        # Load the image onto the map, reusing the Tk image once it exists
+        if self.image_tk is None:
+            from PIL import ImageTk
+            self.image_tk = ImageTk.PhotoImage(self.image)
+            self.label['image'] = self.image_tk
+        else:
+            self.image_tk.paste(self.image)
         self.label.place(
             x=0,
             y=0,
@@ -199,26 +282,194 @@ class RoutePlanGUI:
             height=self.map_height
             )
 
+        # Redraw once the missing tiles have arrived, unless the view moved
+        if loading:
+            view = self._map_view()
+            def check():
+                if view != self._map_view():
+                    return
+                if all(future.done() for future in loading):
+                    self._redraw_map()
+                else:
+                    self.root.after(self.POLL_TIME, check)
+            self.root.after(self.POLL_TIME, check)
+
+    def _map_view(self):
+        # The position and zoom which the map is showing
+        return self.tile_map.lat, self.tile_map.lon, self.tile_map.zoom
+
+    def _map_zoom(self, change):
+        '''Zoom the map in or out
+
+        '''
+        self.zoom = min(max(self.zoom+change, tiles.MIN_ZOOM), tiles.MAX_ZOOM)
+        self.tile_map.zoom = self.zoom
+        self._reload()
+
     def _reload(self):
         self.coords = None
         if self.live:
             self._redraw_map()
 
 
+    def _in_background(self, executor, work, done, progress=None,
+                       improvements=None):
+        '''Run work on a background thread, then pass its future to done back
+        on the UI thread
+
+        Parameters:
+        executor           The executor to run the work on
+        work               A function taking no arguments
+        done               A function taking the finished future
+        progress           A queue the work puts messages on, or None
+        improvements       A queue the work puts better routes on, or None
+
+        Each task has its own queues, so one task's poll never takes the
+        messages or routes of another.
+        '''
+        future = executor.submit(work)
+
+        def check():
+            # A failure showing progress must not stop the polling, or done
+            # would never be called
+            try:
+                self._show_progress(future, progress, improvements)
+            except Exception:
+                traceback.print_exc()
+
+            if future.done():
+                done(future)
+            else:
+                self.root.after(self.POLL_TIME, check)
+
+        self.root.after(self.POLL_TIME, check)
+
+    def _show_progress(self, future, progress=None, improvements=None):
+        '''Show the latest progress message and best route of background
+        work which has not finished
+
+        '''
+        # Show the latest progress message, if there is one
+        message = None
+        while progress is not None and not progress.empty():
+            message = progress.get_nowait()
+        if message is not None:
+            self.status.set(message)
+
+        # Show the best route a search has found so far
+        improvement = None
+        while improvements is not None and not improvements.empty():
+            improvement = improvements.get_nowait()
+        if improvement is not None and not future.done():
+            self._show_best(*improvement)
+
+    def _cancel(self):
+        '''Stop the search which is running
+
+        '''
+        self.stop_search.set()
+        self.status.set("Stopping search")
+
+    def _close(self):
+        '''Stop any background work and close the window
+
+        '''
+        self.stop_search.set()
+        self.location_executor.shutdown(wait=False, cancel_futures=True)
+        self.search_executor.shutdown(wait=False, cancel_futures=True)
+        self.tile_map.cache.shutdown()
+        self.root.destroy()
+
     def _add_location(self, event=None):
         '''Make the user's input a Location and add to the list of locations
 
+        The input may need geocoding over the network, so the Location is
+        made on a background thread and added once it is ready.
         '''
-        # The details of the new location
         user_input = self.entry_box.get()
-        new_location = location.Location(user_input)
+
+        # Reset the text in the entry box
+        self.entry_box.delete(0, "end")
+        self.entry_box.insert("end", "Add Location")
+
+        self.status.set("Finding "+user_input)
+        self._in_background(
+            self.location_executor,
+            lambda: location.Location(user_input),
+            lambda future: self._location_found(user_input, future)
+            )
+
+    def _location_found(self, user_input, future):
+        '''Add a Location made in the background to the list of locations
+
+        '''
+        if future.exception() is not None:
+            self.status.set("Could not find "+user_input)
+            return
+        self.status.set("")
+        self._show_location(future.result())
+
+    def _import_locations(self):
+        '''Add every location listed in a file chosen by the user
+
+        The file is read and converted on a background thread, and the
+        locations are added once they are all ready.
+        '''
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(
+            title="Import Locations",
+            filetypes=[("Text and CSV", "*.txt *.csv"), ("All files", "*")]
+            )
+        if not path:
+            return
+
+        # Inputs which could not be converted
+        failed = []
+
+        self.status.set("Importing "+path)
+        self._in_background(
+            self.location_executor,
+            lambda: list(location.import_locations(
+                location.read_rows(path),
+                on_error=lambda user_input, error: failed.append(user_input)
+                )),
+            lambda future: self._locations_imported(future, failed)
+            )
+
+    def _locations_imported(self, future, failed):
+        '''Add the locations imported in the background to the list
+
+        '''
+        if future.exception() is not None:
+            self.status.set("Import failed: "+str(future.exception()))
+            return
+
+        # Only the last location moves the map
+        new_locations = future.result()
+        for index, new_location in enumerate(new_locations):
+            self._show_location(
+                new_location,
+                redraw=index == len(new_locations)-1
+                )
+
+        message = "Imported "+str(len(new_locations))+" locations"
+        if failed:
+            message += ", could not find "+", ".join(failed)
+        self.status.set(message)
+
+    def _show_location(self, new_location, redraw=True):
+        '''Add a Location to the list of locations and show it to the user
+
+        '''
+        # The details of the new location
+        user_input = new_location.user_input
         self.locations.append(new_location)
-        precise = new_location.location
 
-        # goompy loading a new tile as per the location
-        self.goompy.lat = float(precise[:precise.find(",")])
-        self.goompy.lon = float(precise[precise.find(",")+1:])
-        self._reload()
+        # Centre the map on the location
+        if redraw:
+            self.tile_map.lat = new_location.lat
+            self.tile_map.lon = new_location.lon
+            self._reload()
 
 
         # Differnt actions depending on how many locations currently exist
@@ -262,17 +513,17 @@ class RoutePlanGUI:
                 command=lambda: self._remove_location(len(self.locations))
                 ).grid(row=row, column=4, sticky="ew")
 
-        # Reset the text in the entry box
-        self.entry_box.delete(0, "end")
-        self.entry_box.insert("end", "Add Location")
-
         
     def _remove_location(self, row):
         '''Remove the location selected by the user by visualy and from list
 
         '''
         # Remove the location from the location list
-        self.locations.pop(row+self.location_view-1)
+        removed = self.locations.pop(row+self.location_view-1)
+
+        # Forget its travel times unless another entry is the same place
+        if removed.location not in [x.location for x in self.locations]:
+            self.matrix_store.discard(removed.location)
 
         # Marker to indicate if the locations below should move up
         move = False
@@ -341,39 +592,116 @@ class RoutePlanGUI:
     def _search(self):
         '''Calculate and return the most efficent route
 
+        The travel times are fetched and searched on a background thread.
+        Each better route is shown as it is found, and the Accept button
+        takes the best so far straight away. The search can also be stopped
+        with the Cancel button, in which case the best route found so far is
+        shown once the search has stopped.
         '''
-        # Using the Latitude and Longitude, calculate the distance matrix
-        precise_locations = [l.location for l in self.locations]
-        distance_matrix_info = location.GM.distance_matrix(
-            precise_locations, precise_locations,
-            mode=self.transport_mode.get().lower()
+        if self.searching or not self.locations:
+            return
+        self.searching = True
+        self.stop_search.clear()
+        self.cancel_button.pack(side="right")
+
+        # The locations and mode as they were when the search started
+        locations = location.LocationStore(self.locations)
+        mode = self.transport_mode.get().lower()
+        self.search_locations = locations
+        self.best_route = None
+        self.accepted = False
+
+        # Fresh queues, so nothing left from an earlier search is shown
+        progress = queue.Queue()
+        improvements = queue.Queue()
+
+        self._in_background(
+            self.search_executor,
+            lambda: self._plan(locations, mode, progress, improvements),
+            lambda future: self._route_found(locations, future),
+            progress,
+            improvements
             )
-        self.distance_matrix = []
-        for origin in distance_matrix_info["rows"]:
-            self.distance_matrix.append(
-                [dest["duration"]["value"] for dest in origin["elements"]]
-                )
 
-########################################################################################################################
-        t = time()
-        _time, _route = search.nearest_neighbour(self.distance_matrix)
-        print("nn time")
-        print(time()-t)
-        t2 = time()
-        _time2, _route2 = search.brute_force(self.distance_matrix)
-        print("bf time")
-        print(time()-t2)
-        print(_time)
-        print(_route)
-########################################################################################################################
+    def _plan(self, locations, mode, progress, improvements):
+        '''Fetch the distance matrix and search it, on a background thread
+
+        Progress messages and better routes are put on the given queues.
+        '''
+        return planner.plan(
+            locations,
+            mode,
+            self.matrix_store,
+            time_budget=self.SEARCH_TIME,
+            stop=self.stop_search,
+            progress=progress.put,
+            report=lambda *result: improvements.put(result)
+            )
+
+    def _route_found(self, locations, future):
+        '''Tell the user the route found by a background search
+
+        '''
+        self.searching = False
+        self.cancel_button.pack_forget()
+        self.accept_button.pack_forget()
+
+        # An accepted route has already been shown
+        if self.accepted:
+            return
+
+        if future.exception() is not None:
+            self.status.set("Search failed: "+str(future.exception()))
+            return
+        if future.result() is None:
+            self.status.set("Search cancelled")
+            return
+        self.status.set("")
+
+        self.distance_matrix, result = future.result()
+        _time, _route, self.search_details = result
+        self._show_route(locations, _route)
 
+    def _show_best(self, cost, route, details):
+        '''Show the best route found so far by the running search
+
+        '''
+        self.best_route = route
+        stops = [self.search_locations[loc].user_input for loc in route]
+        if len(stops) > 4:
+            stops = stops[:3]+["...", stops[-1]]
+        # Routes between stops with no way between them cost infinity
+        if math.isfinite(cost):
+            summary = "Best so far, "+str(round(cost/60))+" minutes: "
+        else:
+            summary = "Best so far, some stops cannot be reached: "
+        self.status.set(summary+" then ".join(stops))
+        self.accept_button.pack(side="right")
+
+    def _accept(self):
+        '''Stop the search and use the best route it has found so far
+
+        '''
+        if self.best_route is None:
+            return
+        self.accepted = True
+        self.stop_search.set()
+        self.cancel_button.pack_forget()
+        self.accept_button.pack_forget()
+        self.status.set("")
+        self._show_route(self.search_locations, self.best_route)
+
+    def _show_route(self, locations, _route):
+        '''Tell the user which route is best in a message box
+
+        '''
         # Write message to the user about the best route
         msg = "The best route to visit every location in the minimun amount of time is "
         for loc in _route[:-1]:
-            msg += self.locations[loc].user_input
+            msg += locations[loc].user_input
             msg += ", then "
         msg += "and then finally "
-        msg += self.locations[_route[-1]].user_input
+        msg += locations[_route[-1]].user_input
         
         # Set up the message to tell the user which route is best
         self.route_box = tk.Toplevel(master=self.root)
@@ -1,28 +1,125 @@
 '''Creation of a Location class, as well as all tools needed for location.
 
+The googlemaps API client and the current location are only created when
+first used, so importing this module never touches the network.
 '''
+import csv
+import json
 import re
-from time import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
+import numpy as np
+
+import cache
+import metrics
 import standardise
-import googlemaps
 
-from key import key
+# File keeping the last known current location for use when offline
+LOCATION_FILE = "current_location.txt"
 
-# Create a googlemaps API client
-GM = googlemaps.Client(key=key)
+# Used as the current location when it can be found no other way
+DEFAULT_LOCATION = "51.5074,-0.1278" # Central London
 
-# Using the googlemaps API client, get the current locaiton
-current_location_data = GM.geolocate(consider_ip=True)["location"]
-CURRENT_LOCATION = (
-    str(current_location_data["lat"])
-    +","
-    +str(current_location_data["lng"])
-    )
+# The googlemaps API client and current location, once they are known
+_client = None
+_current_location = None
+
+
+def client():
+    '''Return the googlemaps API client, creating it the first time
+
+    '''
+    global _client
+    if _client is None:
+        import googlemaps
+        from key import key
+        _client = googlemaps.Client(key=key)
+    return _client
+
+def lookup_errors():
+    '''Return the errors raised when the googlemaps API client cannot be
+    made or cannot be reached, as a tuple to catch
+
+    '''
+    errors = (ImportError, OSError, ValueError, KeyError)
+    try:
+        from googlemaps import exceptions
+    except ImportError:
+        return errors
+    return errors+(
+        exceptions.ApiError,
+        exceptions.HTTPError,
+        exceptions.Timeout,
+        exceptions.TransportError
+        )
+
+def current_location():
+    '''Return the current location as a string, finding it the first time
+
+    The location is found using the googlemaps API client and saved to
+    LOCATION_FILE. When that fails the saved location is used instead, or
+    DEFAULT_LOCATION if there is none.
+    '''
+    global _current_location
+    if _current_location is not None:
+        return _current_location
+
+    # Using the googlemaps API client, get the current locaiton
+    try:
+        current_location_data = client().geolocate(consider_ip=True)["location"]
+    except lookup_errors():
+        current_location_data = None
+
+    if current_location_data is not None:
+        set_current_location(
+            str(current_location_data["lat"])
+            +","
+            +str(current_location_data["lng"])
+            )
+    else:
+        # Fall back to the last location which was found
+        try:
+            with open(LOCATION_FILE, "r") as file:
+                _current_location = file.read().strip() or DEFAULT_LOCATION
+        except OSError:
+            _current_location = DEFAULT_LOCATION
+
+    return _current_location
+
+def set_current_location(lat_lon):
+    '''Set the current location and save it for use when offline
+
+    Parameters:
+    lat_lon            The current location as "lat,lon"
+    '''
+    global _current_location
+    _current_location = lat_lon
+    try:
+        with open(LOCATION_FILE, "w") as file:
+            file.write(lat_lon)
+    except OSError:
+        pass
+
+def __getattr__(name):
+    # GM and CURRENT_LOCATION are created when they are first asked for
+    if name == "GM":
+        return client()
+    if name == "CURRENT_LOCATION":
+        return current_location()
+    raise AttributeError("module 'location' has no attribute "+repr(name))
 
 # The datum currently in use by the system
 datum = "Airy 1830" # Default is the UK datum
 
+# Results of earlier geocoding, so repeated inputs use no API quota
+geocode_cache = cache.GeocodeCache("geocode_cache.db")
+
+# Server to geocode with instead of Google Maps, such as a local stand-in
+maps_url = None
+
 ########## Possibly move to class, but defo talk about it later
 
 
@@ -44,6 +141,82 @@ EA_NO_RE = re.compile(
     "[\d]+[\s*,][\d]+$"
     )
 
+# The forms an input can take, in the order they are checked
+LAT_LON_D = "lat_lon_d"
+LAT_LON_M = "lat_lon_m"
+GRID_REF  = "grid_ref"
+EA_NO     = "ea_no"
+FREE_TEXT = "free_text"
+FORMS = [
+    (LAT_LON_D, LAT_LON_D_RE),
+    (LAT_LON_M, LAT_LON_M_RE),
+    (GRID_REF,  GRID_REF_RE),
+    (EA_NO,     EA_NO_RE),
+    ]
+
+
+def classify(user_input):
+    '''Return the form of the user's input
+
+    Parameters:
+    user_input         The input to be classified
+    '''
+    # Perform comparisions with Regex until a match
+    for form, pattern in FORMS:
+        if re.match(pattern, user_input):
+            return form
+    return FREE_TEXT
+
+def _geocode_request(user_input, timeout=10):
+    # Send the request to maps_url when it is set, otherwise to Google Maps
+    if maps_url is None:
+        return client().geocode(user_input)
+    url = maps_url.rstrip("/")+"/maps/api/geocode/json?"
+    query = urlencode({"address": user_input})
+    with urlopen(url+query, timeout=timeout) as response:
+        reply = json.load(response)
+    if reply["status"] not in ("OK", "ZERO_RESULTS"):
+        raise ValueError("Geocoding request failed with "+reply["status"])
+    return reply["results"]
+
+def geocode(user_input):
+    '''Return the latitude and longitude of a free text input as a tuple
+
+    The input is sent to maps_url if it is set, otherwise to Google Maps.
+
+    Parameters:
+    user_input         The input to be geocoded
+    '''
+    # Only geocode inputs which have not been seen recently
+    cached = geocode_cache.get(user_input)
+    if cached is None:
+        metrics.count("geocode_cache", result="miss")
+        with metrics.timer("geocode"):
+            response = _geocode_request(user_input)
+        lat_lon_data = response[0]["geometry"]["location"]
+        cached = (lat_lon_data["lat"], lat_lon_data["lng"])
+        geocode_cache.put(user_input, *cached)
+    else:
+        metrics.count("geocode_cache", result="hit")
+    return cached
+
+
+def parse_lat_lon(lat_lon):
+    '''Return the latitude and longitude in a "lat,lon" string as floats
+
+    Degree and minute marks are ignored, so inputs in the decimal degree
+    form are accepted as well as standardised locations.
+
+    Parameters:
+    lat_lon            The location as "lat,lon"
+    '''
+    lat, lon = re.split("[\\s,]+", lat_lon.replace("°", "").replace("'", ""))
+    return float(lat), float(lon)
+
+
+# Source of Location IDs, which always increase and never repeat
+_ids = count()
+
 
 class Location:
     '''Allows for abtraction of data about a given point to a single location
@@ -51,20 +224,47 @@ class Location:
     By collecting all the needed data about a user's input and then
     standadising the input, the specifics of the location can be abstacted
     away. Every location will have the data in the same form that can be used
-    by a system.
+    by a system. The coordinates are kept as floats so they can be used
+    without being parsed again.
 
     Attributes:
     user_input         Initlization variable
+    lat                The latitude of the location in degrees
+    lon                The longitude of the location in degrees
     location           A standadised version of what the user has inputted
     ID                 Unquie ID for the object
 
     Methods:
     standardise    Calculates a standard form of the user's inputted value
+    from_standardised  Creates a Location from an already standard form
     '''
+    __slots__ = ("user_input", "lat", "lon", "ID")
+
     def __init__(self, user_input):
         self.user_input = user_input
-        self.location = self.standardise(user_input)
-        self.ID = time()
+        self.lat, self.lon = parse_lat_lon(self.standardise(user_input))
+        self.ID = next(_ids)
+
+    @classmethod
+    def from_standardised(cls, user_input, lat, lon):
+        '''Create a Location whose coordinates have already been found
+
+        Parameters:
+        user_input         The user's original input
+        lat                The latitude of the input in degrees
+        lon                The longitude of the input in degrees
+        '''
+        new_location = cls.__new__(cls)
+        new_location.user_input = user_input
+        new_location.lat = float(lat)
+        new_location.lon = float(lon)
+        new_location.ID = next(_ids)
+        return new_location
+
+    @property
+    def location(self):
+        # The standard "lat,lon" form used by Google Maps and as a key
+        return str(self.lat)+","+str(self.lon)
 
     def __repr__(self):
         return self.location
@@ -76,19 +276,301 @@ class Location:
         user_input         The input to be standadised
         '''
 
-        # Perform comparisions with Regex until a match and then convert
-        if re.match(LAT_LON_D_RE, user_input):
+        # Convert according to the form of the input
+        form = classify(user_input)
+        metrics.count("standardise", form=form)
+        if form == LAT_LON_D:
             return user_input
-        elif re.match(LAT_LON_M_RE, user_input):
-            return standadise.degrees_min_to_degrees_dec(user_input)
-        elif re.match(GRID_REF_RE, user_input):
-            return standadise.map_ref_convert(user_input, datum)
-        elif re.match(EA_NO_RE, user_input):
-            return standadise.northing_easting_to_degrees(user_input, datum)
+        elif form == LAT_LON_M:
+            return standardise.degrees_min_to_degrees_dec(user_input)
+        elif form == GRID_REF:
+            return standardise.map_ref_convert(user_input, datum)
+        elif form == EA_NO:
+            return standardise.northing_easting_to_degrees(user_input, datum)
         else:
-            lat_lon_data = GM.geocode(user_input)[0]["geometry"]["location"]
-            lat = str(lat_lon_data["lat"])
-            lon = str(lat_lon_data["lng"])
+            lat_lon_data = geocode(user_input)
+            lat = str(lat_lon_data[0])
+            lon = str(lat_lon_data[1])
             lat_lon = lat+","+lon
             return lat_lon
 
+
+class LocationStore:
+    '''A list of Locations which also keeps their coordinates in arrays
+
+    The latitudes and longitudes are held in one contiguous float64 array,
+    in the same order as the Locations, so code working on many stops can
+    read every coordinate at once. The array grows by doubling, so adding a
+    Location takes constant time on average.
+
+    Attributes:
+    lats               Array of the latitude of each Location
+    lons               Array of the longitude of each Location
+    coordinates        Array with a row of latitude and longitude for each
+
+    Methods:
+    append             Add a Location to the end
+    extend             Add several Locations to the end
+    pop                Remove and return the Location at an index
+    clear              Remove every Location
+    '''
+    def __init__(self, locations=(), capacity=16):
+        self._locations = []
+        self._coordinates = np.empty((max(1, capacity), 2))
+        self.extend(locations)
+
+    @property
+    def coordinates(self):
+        return self._coordinates[:len(self._locations)]
+
+    @property
+    def lats(self):
+        return self.coordinates[:, 0]
+
+    @property
+    def lons(self):
+        return self.coordinates[:, 1]
+
+    def _reserve(self, size):
+        # Grow the array to hold at least size rows
+        if size > len(self._coordinates):
+            capacity = max(size, 2*len(self._coordinates))
+            grown = np.empty((capacity, 2))
+            grown[:len(self._locations)] = self.coordinates
+            self._coordinates = grown
+
+    def append(self, new_location):
+        '''Add a Location to the end of the store
+
+        Parameters:
+        new_location       The Location to add
+        '''
+        size = len(self._locations)
+        self._reserve(size+1)
+        self._coordinates[size] = new_location.lat, new_location.lon
+        self._locations.append(new_location)
+
+    def extend(self, new_locations):
+        '''Add several Locations to the end of the store
+
+        Parameters:
+        new_locations      The Locations to add, in order
+        '''
+        new_locations = list(new_locations)
+        size = len(self._locations)
+        self._reserve(size+len(new_locations))
+        for index, new_location in enumerate(new_locations, size):
+            self._coordinates[index] = new_location.lat, new_location.lon
+        self._locations.extend(new_locations)
+
+    def pop(self, index=-1):
+        '''Remove and return the Location at an index
+
+        Parameters:
+        index              The position of the Location, the last if not given
+        '''
+        size = len(self._locations)
+        removed = self._locations.pop(index)
+        if index < 0:
+            index += size
+        self._coordinates[index:size-1] = self._coordinates[index+1:size]
+        return removed
+
+    def clear(self):
+        '''Remove every Location from the store
+
+        '''
+        self._locations.clear()
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __getitem__(self, index):
+        return self._locations[index]
+
+    def __iter__(self):
+        return iter(self._locations)
+
+    def __repr__(self):
+        return "LocationStore("+repr(self._locations)+")"
+
+
+########## Bulk import
+
+
+def read_rows(path, column=None):
+    '''Yield each input in a text or CSV file, one at a time
+
+    Without a column every non-blank line is one input. With a column the
+    file is read as CSV and the input is taken from that column, given
+    either as a number or as the name in the header row.
+
+    Parameters:
+    path               The file to read
+    column             The CSV column holding the inputs, if any
+    '''
+    with open(path, "r", newline="") as file:
+        if column is None:
+            rows = ([line] for line in file)
+            column = 0
+        elif isinstance(column, str):
+            rows = csv.DictReader(file)
+        else:
+            rows = csv.reader(file)
+
+        for row in rows:
+            try:
+                user_input = row[column].strip()
+            except (IndexError, KeyError):
+                continue
+            if user_input:
+                yield user_input
+
+# Errors raised by an input which cannot be parsed or converted, including
+# a datum file which cannot be read
+_CONVERSION_ERRORS = (ValueError, IndexError, OSError)
+
+def import_locations(rows, batch_size=500, workers=8, on_error=None):
+    '''Turn a stream of inputs into Locations, yielding them in order
+
+    Inputs are handled a batch at a time so memory stays flat however long
+    the stream is. Within a batch, coordinates are converted together
+    through standardise, and only free text is geocoded. Each free text
+    input is geocoded once per batch, with the lookups made at the same
+    time on a pool of threads.
+
+    Parameters:
+    rows               The inputs, such as from read_rows
+    batch_size         Number of inputs handled together
+    workers            Most geocoding requests made at once
+    on_error           Called with the input and error for an input which
+                       cannot be converted, errors are raised if not given
+    '''
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for user_input in rows:
+            batch.append(user_input)
+            if len(batch) == batch_size:
+                yield from _import_batch(batch, pool, on_error)
+                batch = []
+        if batch:
+            yield from _import_batch(batch, pool, on_error)
+
+def _convert_together(indexes, results, fail, convert):
+    '''Store the latitudes and longitudes from a batch conversion, or pass
+    its error on for every input in it
+
+    Parameters:
+    indexes            The positions in the batch of the inputs converted
+    results            The results of the batch, by position
+    fail               Called with the position and error of a failed input
+    convert            Returns arrays of latitude and longitude, in order
+    '''
+    if not indexes:
+        return
+    try:
+        lats, lons = convert()
+    except _CONVERSION_ERRORS as error:
+        for index in indexes:
+            fail(index, error)
+        return
+    for index, lat, lon in zip(indexes, lats, lons):
+        results[index] = lat, lon
+
+def _import_batch(batch, pool, on_error):
+    '''Yield a Location for each input in a batch
+
+    Parameters:
+    batch              The inputs to convert
+    pool               Thread pool used for geocoding
+    on_error           Called with the input and error of a failed input
+    '''
+    results = [None]*len(batch)
+
+    def fail(index, error):
+        if on_error is None:
+            raise error
+        results[index] = error
+
+    # Group the inputs by their form
+    forms = {}
+    for index, user_input in enumerate(batch):
+        forms.setdefault(classify(user_input), []).append(index)
+    for form, indexes in forms.items():
+        metrics.count("standardise", len(indexes), form=form)
+
+    # Coordinates in degrees are parsed one by one so a bad one fails alone
+    for index in forms.get(LAT_LON_D, []):
+        try:
+            results[index] = parse_lat_lon(batch[index])
+        except _CONVERSION_ERRORS as error:
+            fail(index, error)
+    for index in forms.get(LAT_LON_M, []):
+        try:
+            results[index] = parse_lat_lon(
+                standardise.degrees_min_to_degrees_dec(batch[index])
+                )
+        except _CONVERSION_ERRORS as error:
+            fail(index, error)
+
+    # Grid References are checked one by one so a bad one fails alone
+    grid_refs = []
+    for index in forms.get(GRID_REF, []):
+        try:
+            standardise.grid_ref_to_northing_easting(
+                batch[index].lower().replace(" ", ""), datum
+                )
+        except _CONVERSION_ERRORS as error:
+            fail(index, error)
+        else:
+            grid_refs.append(index)
+    _convert_together(
+        grid_refs, results, fail,
+        lambda: standardise.map_ref_convert_batch(
+            [batch[index] for index in grid_refs], datum
+            )
+        )
+
+    # Eastings and Northings are parsed one by one, then converted together
+    ea_no = []
+    eastings = []
+    northings = []
+    for index in forms.get(EA_NO, []):
+        try:
+            pair = re.split("[\\s*,]", batch[index])
+            easting, northing = float(pair[0]), float(pair[1])
+        except _CONVERSION_ERRORS as error:
+            fail(index, error)
+        else:
+            ea_no.append(index)
+            eastings.append(easting)
+            northings.append(northing)
+    _convert_together(
+        ea_no, results, fail,
+        lambda: standardise.northing_easting_to_degrees_batch(
+            eastings, northings, datum
+            )
+        )
+
+    # Free text is geocoded once for each distinct input
+    waiting = {}
+    for index in forms.get(FREE_TEXT, []):
+        waiting.setdefault(cache.normalise(batch[index]), []).append(index)
+    lookups = {
+        key: pool.submit(geocode, batch[indexes[0]])
+        for key, indexes in waiting.items()
+        }
+    for key, future in lookups.items():
+        for index in waiting[key]:
+            try:
+                lat, lon = future.result()
+            except lookup_errors()+(IndexError,) as error:
+                fail(index, error)
+            else:
+                results[index] = lat, lon
+
+    for user_input, result in zip(batch, results):
+        if isinstance(result, Exception):
+            on_error(user_input, result)
+        else:
+            yield Location.from_standardised(user_input, *result)
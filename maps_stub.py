@@ -0,0 +1,222 @@
+'''A local stand-in for the Google Maps Distance Matrix and Geocoding APIs
+
+Replies are in the same JSON format as Google's, so the planner and the
+service can be run against it with --maps-url, without a key or a
+network. Travel times are the estimates of distance.py rounded to whole
+seconds, as Google gives them. Free text is geocoded to a point near
+CENTRE found from a hash of the text, so the same input always lands in
+the same place. Requests over the Distance Matrix limits are refused as
+Google would refuse them.
+
+Usage:
+python maps_stub.py --port 8765
+python planner.py jobs.jsonl --maps-url http://127.0.0.1:8765
+'''
+import argparse
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import cache
+import distance
+import location
+
+# Free text is geocoded to within SPREAD degrees of this point
+CENTRE = (51.5074, -0.1278) # Central London
+SPREAD = 0.05
+
+# Most origins, destinations and elements in one Distance Matrix request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Answer one request to the StubServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {
+            name: values[0]
+            for name, values in parse_qs(url.query).items()
+            }
+        if url.path == "/maps/api/distancematrix/json":
+            reply = self.server.distance_matrix(query)
+        elif url.path == "/maps/api/geocode/json":
+            reply = self.server.geocode(query)
+        else:
+            self.send_error(404)
+            return
+
+        sleep(self.server.delay)
+        body = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    '''A server which answers Distance Matrix and Geocoding requests
+
+    Attributes:
+    url                The base URL to give as --maps-url
+    places             Free text inputs with the latitude and longitude to
+                       geocode them to, others are placed by a hash
+    delay              Seconds to wait before each reply
+    requests           Number of requests answered by each API
+    elements           Number of travel times sent
+
+    Methods:
+    distance_matrix    Return the reply to a Distance Matrix request
+    geocode            Return the reply to a Geocoding request
+    start              Answer requests on a background thread
+    stop               Stop answering requests
+    '''
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, places=None, delay=0):
+        super().__init__((host, port), _Handler)
+        self.url = "http://%s:%d" % self.server_address[:2]
+        self.places = {
+            cache.normalise(user_input): lat_lon
+            for user_input, lat_lon in (places or {}).items()
+            }
+        self.delay = delay
+        self.requests = {"distancematrix": 0, "geocode": 0}
+        self.elements = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _count(self, api, elements=0):
+        with self._lock:
+            self.requests[api] += 1
+            self.elements += elements
+
+    def distance_matrix(self, query):
+        '''Return the reply to a Distance Matrix request as a dictionary
+
+        Parameters:
+        query              The parameters of the request
+        '''
+        origins = query.get("origins", "").split("|")
+        destinations = query.get("destinations", "").split("|")
+        mode = query.get("mode", "driving")
+        if (not all(origins) or not all(destinations)
+                or mode not in distance.SPEED_PROFILES):
+            self._count("distancematrix")
+            return {"status": "INVALID_REQUEST", "rows": []}
+        if (len(origins) > MAX_ORIGINS
+                or len(destinations) > MAX_DESTINATIONS
+                or len(origins)*len(destinations) > MAX_ELEMENTS):
+            self._count("distancematrix")
+            return {"status": "MAX_ELEMENTS_EXCEEDED", "rows": []}
+        self._count("distancematrix", len(origins)*len(destinations))
+
+        # Places which are not a latitude and longitude are not found
+        points = {}
+        for place in origins+destinations:
+            try:
+                points[place] = location.parse_lat_lon(place)
+            except ValueError:
+                points[place] = (np.nan, np.nan)
+        origin_points = np.array([points[place] for place in origins])
+        destination_points = np.array(
+            [points[place] for place in destinations]
+            )
+        durations = distance.estimate_durations(
+            origin_points[:, 0], origin_points[:, 1], mode,
+            destination_points[:, 0], destination_points[:, 1]
+            )
+
+        rows = []
+        for row in durations:
+            elements = []
+            for duration in row:
+                if np.isnan(duration):
+                    elements.append({"status": "NOT_FOUND"})
+                else:
+                    elements.append({
+                        "status": "OK",
+                        "duration": {"value": int(round(duration))},
+                        })
+            rows.append({"elements": elements})
+        return {
+            "status": "OK",
+            "origin_addresses": origins,
+            "destination_addresses": destinations,
+            "rows": rows,
+            }
+
+    def geocode(self, query):
+        '''Return the reply to a Geocoding request as a dictionary
+
+        Parameters:
+        query              The parameters of the request
+        '''
+        self._count("geocode")
+        address = cache.normalise(query.get("address", ""))
+        if not address:
+            return {"status": "ZERO_RESULTS", "results": []}
+        if address in self.places:
+            lat, lon = self.places[address]
+        else:
+            digest = hashlib.sha256(address.encode()).digest()
+            lat = CENTRE[0]+SPREAD*(digest[0]/255*2-1)
+            lon = CENTRE[1]+SPREAD*(digest[1]/255*2-1)
+        return {
+            "status": "OK",
+            "results": [{
+                "formatted_address": query["address"],
+                "geometry": {"location": {"lat": lat, "lng": lon}},
+                }],
+            }
+
+    def start(self):
+        '''Answer requests on a background thread and return the server
+
+        '''
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop answering requests and close the socket
+
+        '''
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0,
+                        help="seconds to wait before each reply")
+    args = parser.parse_args(argv)
+
+    server = StubServer(args.host, args.port, delay=args.delay)
+    print("Listening on "+server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
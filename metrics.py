@@ -0,0 +1,289 @@
+'''Timers and counters for the busy parts of the planner
+
+Metrics are off until enable is called, and while off every timer and
+counter returns at once, so the calls can stay in the hot paths. Once on,
+each metric is kept by its name and labels, and can be exported as JSON or
+in the Prometheus text format.
+
+Searches can also be profiled with cProfile by setting a directory for the
+profiles with enable_profiling.
+
+Usage:
+metrics.enable()
+with metrics.timer("geocode"):
+    ...
+metrics.count("geocode_cache", result="hit")
+print(metrics.to_prometheus())
+'''
+import cProfile
+import json
+import os
+import threading
+from itertools import count as _counter, groupby
+from time import perf_counter, strftime
+
+# Prefix for every metric in the Prometheus format
+PREFIX = "route_planner_"
+
+# Whether metrics are being kept, and where profiles are saved
+enabled = False
+profile_directory = None
+
+_counters = {}
+_timers = {}
+_lock = threading.Lock()
+_profile_numbers = _counter(1)
+
+
+class _NullTimer:
+    '''A timer which does nothing, used while metrics are off
+
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    '''Times the code inside a with block and records it when it ends
+
+    '''
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *error):
+        _record(self.key, perf_counter()-self.start)
+        return False
+
+
+def enable():
+    '''Start keeping metrics
+
+    '''
+    global enabled
+    enabled = True
+
+def disable():
+    '''Stop keeping metrics, leaving those already kept
+
+    '''
+    global enabled
+    enabled = False
+
+def reset():
+    '''Forget every metric kept so far
+
+    '''
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def count(name, value=1, **labels):
+    '''Add to a counter
+
+    Parameters:
+    name               The name of the counter
+    value              The amount to add
+    labels             Labels which tell apart counters of the same name
+    '''
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0)+value
+
+def timer(name, **labels):
+    '''Return a context manager which times the code inside it
+
+    Parameters:
+    name               The name of the timer
+    labels             Labels which tell apart timers of the same name
+    '''
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(_key(name, labels))
+
+def observe(name, seconds, **labels):
+    '''Record a time measured elsewhere
+
+    Parameters:
+    name               The name of the timer
+    seconds            The time taken
+    labels             Labels which tell apart timers of the same name
+    '''
+    if not enabled:
+        return
+    _record(_key(name, labels), seconds)
+
+def _record(key, seconds):
+    # Keep the count, total, shortest and longest of each timer
+    with _lock:
+        stats = _timers.get(key)
+        if stats is None:
+            _timers[key] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+
+def _snapshot():
+    # The metrics as plain dictionaries, called with the lock held
+    return {
+        "counters": [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+            ],
+        "timers": [
+            {"name": name, "labels": dict(labels), "count": stats[0],
+             "seconds": stats[1], "min": stats[2], "max": stats[3]}
+            for (name, labels), stats in sorted(_timers.items())
+            ],
+        }
+
+def snapshot():
+    '''Return every metric kept so far as a dictionary
+
+    '''
+    with _lock:
+        return _snapshot()
+
+def take():
+    '''Return every metric kept so far as a dictionary and forget them, so
+    metrics kept in another process can be sent back to be merged
+
+    '''
+    with _lock:
+        taken = _snapshot()
+        _counters.clear()
+        _timers.clear()
+    return taken
+
+def merge(taken):
+    '''Add metrics returned by snapshot or take to those kept here
+
+    Parameters:
+    taken              The metrics to add
+    '''
+    with _lock:
+        for counter in taken["counters"]:
+            key = _key(counter["name"], counter["labels"])
+            _counters[key] = _counters.get(key, 0)+counter["value"]
+        for timer in taken["timers"]:
+            key = _key(timer["name"], timer["labels"])
+            stats = _timers.get(key)
+            if stats is None:
+                _timers[key] = [timer["count"], timer["seconds"],
+                                timer["min"], timer["max"]]
+            else:
+                stats[0] += timer["count"]
+                stats[1] += timer["seconds"]
+                stats[2] = min(stats[2], timer["min"])
+                stats[3] = max(stats[3], timer["max"])
+
+def to_json():
+    '''Return every metric kept so far as JSON text
+
+    '''
+    return json.dumps(snapshot(), indent=1)
+
+def _labels(labels, extra=()):
+    # Labels in the Prometheus format, such as {mode="driving"}
+    pairs = list(labels)+list(extra)
+    if not pairs:
+        return ""
+    return "{"+",".join(
+        name+'="'+str(value).replace("\\", "\\\\").replace('"', '\\"')+'"'
+        for name, value in pairs
+        )+"}"
+
+def to_prometheus():
+    '''Return every metric kept so far in the Prometheus text format
+
+    Counters become counters with a _total suffix, and timers become
+    summaries in seconds along with a gauge of the longest time.
+    '''
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        timers = sorted((key, list(stats)) for key, stats in _timers.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+        metric = PREFIX+name+"_total"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append("# TYPE "+metric+" counter")
+        lines.append(metric+_labels(labels)+" "+repr(float(value)))
+
+    # Each family's samples must follow its own TYPE line, so the summary
+    # of a timer comes before the gauge of its longest time
+    for name, group in groupby(timers, key=lambda timer: timer[0][0]):
+        group = list(group)
+        metric = PREFIX+name+"_seconds"
+        lines.append("# TYPE "+metric+" summary")
+        for (_, labels), (number, total, _, _) in group:
+            lines.append(metric+"_count"+_labels(labels)+" "+str(number))
+            lines.append(metric+"_sum"+_labels(labels)+" "+repr(total))
+        lines.append("# TYPE "+metric+"_max gauge")
+        for (_, labels), (_, _, _, longest) in group:
+            lines.append(metric+"_max"+_labels(labels)+" "+repr(longest))
+
+    return "\n".join(lines)+"\n"
+
+
+def enable_profiling(directory):
+    '''Save a cProfile profile of every search to a directory, or stop
+    profiling if directory is None
+
+    Parameters:
+    directory          The folder to save profiles in
+    '''
+    global profile_directory
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    profile_directory = directory
+
+class profiling:
+    '''Profile the code inside a with block when profiling is on
+
+    The profile is saved to the profile directory in the pstats format,
+    named after the block, the time it ended and the process.
+
+    Attributes:
+    name               Used to name the saved profile
+    path               The file the profile was saved to, if any
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+        self._profile = None
+
+    def __enter__(self):
+        if profile_directory is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *error):
+        if self._profile is not None:
+            self._profile.disable()
+            self.path = os.path.join(
+                profile_directory,
+                self.name+"-"+strftime("%Y%m%d-%H%M%S")+"-"+str(os.getpid())
+                +"-"+str(next(_profile_numbers))+".prof"
+                )
+            self._profile.dump_stats(self.path)
+        return False
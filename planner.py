@@ -0,0 +1,435 @@
+'''Planning of routes without the GUI
+
+Each job is one line of JSON giving the stops to visit and, optionally,
+the transport mode, an ID and the seconds the search may take. A stop is
+anything a user could type into the GUI, or a latitude and longitude pair:
+
+{"id": "van 1", "stops": ["SW1A 1AA", "TQ 300 800", [51.5, -0.12]]}
+
+Jobs are planned in parallel on a pool of processes, which share the
+geocode and travel time caches through their SQLite files. Each result is
+written as a line of JSON as soon as it is ready, so results may come out
+in a different order to the jobs. Jobs with more than DECOMPOSE_SIZE stops
+are split into clusters by decompose.py, so no full distance matrix is
+needed for them.
+
+Usage:
+python planner.py jobs.jsonl --output routes.jsonl --workers 4
+python planner.py jobs.jsonl --offline
+python planner.py jobs.jsonl --maps-url http://localhost:8765
+python planner.py jobs.jsonl --metrics metrics.json --profile profiles
+'''
+import argparse
+import json
+import math
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from os import cpu_count
+
+import cache
+import decompose
+import distance
+import location
+import metrics
+import search
+
+# Used for jobs which do not give their own
+DEFAULT_MODE = "walking"
+DEFAULT_TIME_BUDGET = 5
+
+# Most stops planned with one distance matrix, larger jobs are clustered
+DECOMPOSE_SIZE = 1000
+
+# Files shared between the worker processes
+GEOCODE_CACHE = "geocode_cache.db"
+MATRIX_CACHE = "matrix_cache.db"
+
+# The travel times of this worker process, shared by its jobs
+_store = None
+
+
+def travel_times(store, places, mode, fallback=True, progress=None,
+                 coordinates=None):
+    '''Return the distance matrix between places and whether it had to be
+    estimated because Google Maps could not be reached
+
+    A store which only estimates has nothing to fetch, so its travel times
+    are estimated straight away.
+
+    Parameters:
+    store              The DistanceMatrixStore to fetch through
+    places             The standardised locations, in matrix order
+    mode               The transport mode, as used by Google Maps
+    fallback           Whether to estimate when fetching fails
+    progress           Called with messages about how work is going
+    coordinates        Array with a row of latitude and longitude for each
+                       place, to estimate from without parsing the places
+    '''
+    if store.estimated:
+        return store.estimate(places, mode, coordinates), True
+    try:
+        return store.matrix(places, mode), False
+    except distance.MatrixFetchError:
+        if not fallback:
+            raise
+        if progress is not None:
+            progress("Google Maps unavailable, estimating travel times")
+        return store.estimate(places, mode, coordinates), True
+
+def plan(locations, mode, store, time_budget=None, stop=None, progress=None,
+         fallback=True, report=None, workers=None, solve=None):
+    '''Fetch the travel times between Locations and search for the best route
+
+    Returns the distance matrix along with the cost, route and details found
+    by search.solve, or None if stopped before the search began. The
+    details also say whether the travel times were estimated. While the
+    search runs, report is given each better route as it is found.
+
+    More than DECOMPOSE_SIZE Locations are planned with decompose.solve
+    instead, which fetches only the travel times it needs. There is then no
+    distance matrix to return, so None is returned in its place, and no
+    routes are reported before the end.
+
+    Parameters:
+    locations          The Locations to visit, in a LocationStore or a list
+    mode               The transport mode, as used by Google Maps
+    store              The DistanceMatrixStore to fetch through
+    time_budget        Seconds the search may take, no limit if None
+    stop               Event which ends the work early when set
+    progress           Called with messages about how work is going
+    fallback           Whether to estimate when fetching fails
+    report             Called with the cost, route and details of each
+                       better route found before the search ends
+    workers            Processes to search clusters on, one per core if not
+                       given
+    solve              Called with the distance matrix and time budget to
+                       search in place of search.anytime, such as on
+                       another process, in which case report is not used
+    '''
+    if progress is None:
+        progress = lambda message: None
+    if not isinstance(locations, location.LocationStore):
+        locations = location.LocationStore(locations)
+    if len(locations) > DECOMPOSE_SIZE:
+        return _plan_clusters(locations, mode, store, time_budget, stop,
+                              progress, fallback, workers)
+
+    # Only travel times not fetched before are requested
+    progress("Fetching travel times")
+    distance_matrix, estimated = travel_times(
+        store, [l.location for l in locations], mode, fallback, progress,
+        locations.coordinates
+        )
+    if stop is not None and stop.is_set():
+        return None
+
+    # Let the search module pick an algorithm to fit the time allowed
+    progress("Searching for the best route")
+    if solve is not None:
+        cost, route, details = solve(distance_matrix, time_budget)
+        details["estimated"] = estimated
+        return distance_matrix, (cost, route, details)
+    with metrics.profiling("search"):
+        for cost, route, details in search.anytime(
+                distance_matrix, time_budget=time_budget, stop=stop):
+            if report is not None and not details["final"]:
+                report(cost, route, details)
+    details["estimated"] = estimated
+    return distance_matrix, (cost, route, details)
+
+
+def _plan_clusters(locations, mode, store, time_budget, stop, progress,
+                   fallback, workers):
+    '''Plan a route through many Locations by splitting them into clusters,
+    returning None in place of the distance matrix
+
+    Parameters:
+    locations          The LocationStore of the Locations to visit
+    mode               The transport mode, as used by Google Maps
+    store              The DistanceMatrixStore to fetch through
+    time_budget        Seconds the search may take, no limit if None
+    stop               Event which ends the work early when set
+    progress           Called with messages about how work is going
+    fallback           Whether to estimate when fetching fails
+    workers            Processes to search clusters on
+    '''
+    places = [l.location for l in locations]
+    coordinates = locations.coordinates
+    estimated = False
+
+    def matrix_for(indexes):
+        nonlocal estimated
+        distance_matrix, was_estimated = travel_times(
+            store, [places[index] for index in indexes], mode, fallback,
+            coordinates=coordinates[indexes]
+            )
+        estimated = estimated or was_estimated
+        return distance_matrix
+
+    progress("Splitting the stops into clusters and searching each")
+    points = decompose.project(locations.lats, locations.lons)
+    with metrics.profiling("search"):
+        cost, route, details = decompose.solve(
+            points, matrix_for, time_budget=time_budget, workers=workers,
+            stop=stop
+            )
+    if estimated:
+        progress("Google Maps unavailable, some travel times were estimated")
+    details["estimated"] = estimated
+    return None, (cost, route, details)
+
+def make_store(matrix_path=MATRIX_CACHE, offline=False, maps_url=None):
+    '''Return a DistanceMatrixStore which keeps its travel times in a file
+
+    Estimates are kept in memory only, so an offline run never leaves them
+    in the shared cache for later runs to take as fetched travel times.
+
+    Parameters:
+    matrix_path        The SQLite file of the shared travel time cache
+    offline            Whether to estimate every travel time
+    maps_url           Server to fetch travel times from instead of Google
+    '''
+    if offline:
+        return distance.DistanceMatrixStore(
+            distance.estimate_fetch, estimated=True
+            )
+    if maps_url is not None:
+        fetch = distance.ChunkedFetcher(distance.http_request(maps_url))
+    else:
+        fetch = None
+    return distance.DistanceMatrixStore(fetch, cache.MatrixCache(matrix_path))
+
+def _start_worker(geocode_path, matrix_path, offline, maps_url,
+                  keep_metrics=False, profile_path=None):
+    # Give each worker process its own connections to the shared caches
+    global _store
+    location.geocode_cache = cache.GeocodeCache(geocode_path)
+    location.maps_url = maps_url
+    _store = make_store(matrix_path, offline, maps_url)
+    if keep_metrics:
+        metrics.enable()
+    if profile_path is not None:
+        metrics.enable_profiling(profile_path)
+
+def _number(value):
+    # JSON has no infinity, so numbers without a value are written as null
+    if value is None:
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+def _stop_location(stop):
+    # A stop given as a latitude and longitude pair needs no conversion
+    lat, lon = stop
+    return location.Location.from_standardised(
+        str(lat)+","+str(lon), lat, lon
+        )
+
+def stop_locations(stops):
+    '''Return the Locations of a job's stops, along with the stops which
+    could not be found
+
+    Parameters:
+    stops              The stops, as inputs or latitude and longitude pairs
+    '''
+    failed = []
+    locations = location.LocationStore(
+        _stop_location(stop) for stop in stops if not isinstance(stop, str)
+        )
+    locations.extend(location.import_locations(
+        [stop for stop in stops if isinstance(stop, str)],
+        on_error=lambda user_input, error: failed.append(user_input)
+        ))
+    if not locations:
+        raise ValueError("none of the stops could be found")
+    return locations, failed
+
+def describe(locations, failed, cost, route, details):
+    '''Return a route found by plan as a dictionary which can be sent as
+    JSON
+
+    Parameters:
+    locations          The Locations which were planned
+    failed             The stops which could not be found
+    cost               The total travel time of the route
+    route              The order to visit the Locations in
+    details            The details of the search
+    '''
+    return {
+        "route": [locations[index].user_input for index in route],
+        "coordinates": [
+            [locations[index].lat, locations[index].lon] for index in route
+            ],
+        "cost": _number(cost),
+        "not_found": failed,
+        "algorithm": details["algorithm"],
+        "bound": _number(details["bound"]),
+        "gap": _number(details["gap"]),
+        "elapsed": details["elapsed"],
+        "estimated": details["estimated"],
+        }
+
+def run_job(job, time_budget=DEFAULT_TIME_BUDGET):
+    '''Plan the route for one job and return the result as a dictionary
+
+    Stops which cannot be found are listed in the result rather than
+    failing the job. Any other error is returned as the result's error.
+
+    Parameters:
+    job                The job, with its stops and optionally a mode, ID and
+                       time budget
+    time_budget        Seconds the search may take if the job gives none
+    '''
+    result = {"id": job.get("id")}
+    try:
+        locations, failed = stop_locations(job["stops"])
+        distance_matrix, (cost, route, details) = plan(
+            locations,
+            job.get("mode", DEFAULT_MODE).lower(),
+            _store,
+            time_budget=job.get("time_budget", time_budget),
+            workers=1
+            )
+    except Exception as error:
+        result["error"] = type(error).__name__+": "+str(error)
+        return result
+
+    result.update(describe(locations, failed, cost, route, details))
+    return result
+
+def _run_job_with_metrics(job, time_budget):
+    # Send this worker's metrics back with each result to be merged
+    result = run_job(job, time_budget)
+    return result, metrics.take()
+
+def read_jobs(lines):
+    '''Yield each job in lines of JSON, numbering those without an ID
+
+    A line which is not a valid job is yielded as a result holding the
+    error, so one bad line does not stop the rest.
+
+    Parameters:
+    lines              The lines to read, such as an open file
+    '''
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict) or not isinstance(
+                    job.get("stops"), list):
+                raise ValueError("a job must be an object with a stops list")
+        except ValueError as error:
+            yield {"id": number, "error": "ValueError: "+str(error)}
+            continue
+        job.setdefault("id", number)
+        yield job
+
+def run(jobs, output, workers=None, time_budget=DEFAULT_TIME_BUDGET,
+        geocode_path=GEOCODE_CACHE, matrix_path=MATRIX_CACHE, offline=False,
+        maps_url=None, profile_path=None):
+    '''Plan every job on a pool of processes, writing each result to output
+    as a line of JSON as soon as it is ready
+
+    Only a few jobs per worker are read ahead, so any number of jobs can be
+    planned in bounded memory. Returns the number of jobs which failed. If
+    metrics are enabled, those kept by the workers are merged into this
+    process.
+
+    Parameters:
+    jobs               The jobs, such as from read_jobs
+    output             The file to write results to
+    workers            The number of processes, one per core if not given
+    time_budget        Seconds each search may take if the job gives none
+    geocode_path       The SQLite file of the shared geocode cache
+    matrix_path        The SQLite file of the shared travel time cache
+    offline            Whether to estimate every travel time
+    maps_url           Server to geocode and fetch travel times from instead
+                       of Google Maps
+    profile_path       Folder to save a profile of each search in, if any
+    '''
+    workers = workers or cpu_count() or 1
+    failures = 0
+
+    def write(result, taken=None):
+        nonlocal failures
+        if taken is not None:
+            metrics.merge(taken)
+        failures += "error" in result
+        output.write(json.dumps(result)+"\n")
+        output.flush()
+
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_start_worker,
+            initargs=(geocode_path, matrix_path, offline, maps_url,
+                      metrics.enabled, profile_path)
+            ) as pool:
+        running = set()
+        for job in jobs:
+            if "error" in job:
+                write(job)
+                continue
+            running.add(pool.submit(_run_job_with_metrics, job, time_budget))
+
+            # Wait for a job to finish before reading too far ahead
+            if len(running) >= 2*workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(*future.result())
+
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                write(*future.result())
+
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("jobs", help="JSON Lines file of jobs, - for stdin")
+    parser.add_argument("--output", default="-",
+                        help="file to write results to, - for stdout")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--time-budget", type=float,
+                        default=DEFAULT_TIME_BUDGET)
+    parser.add_argument("--geocode-cache", default=GEOCODE_CACHE)
+    parser.add_argument("--matrix-cache", default=MATRIX_CACHE)
+    parser.add_argument("--offline", action="store_true",
+                        help="estimate travel times instead of fetching them")
+    parser.add_argument("--maps-url",
+                        help="server to geocode and fetch travel times from "
+                             "instead of Google Maps, such as maps_stub.py")
+    parser.add_argument("--metrics",
+                        help="file to write timings and counts to as JSON, "
+                             "merged from every worker process")
+    parser.add_argument("--profile",
+                        help="folder to save a cProfile profile of each "
+                             "search in")
+    args = parser.parse_args(argv)
+
+    if args.metrics is not None:
+        metrics.enable()
+
+    jobs = sys.stdin if args.jobs == "-" else open(args.jobs, "r")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        failures = run(
+            read_jobs(jobs), output, args.workers, args.time_budget,
+            args.geocode_cache, args.matrix_cache, args.offline,
+            args.maps_url, args.profile
+            )
+    finally:
+        if jobs is not sys.stdin:
+            jobs.close()
+        if output is not sys.stdout:
+            output.close()
+        if args.metrics is not None:
+            with open(args.metrics, "w") as file:
+                file.write(metrics.to_json())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
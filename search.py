@@ -1,52 +1,285 @@
 '''All the algorithms to calculate the shortest route
 
 '''
-from copy import deepcopy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from itertools import permutations
+from math import perm
+from multiprocessing import shared_memory
+from os import cpu_count
+from time import time
 
-def nearest_neighbour(matrix):
+import numpy as np
+
+import metrics
+
+# Largest number of matrix elements the greedy search gathers in one step
+_NN_BLOCK_ELEMENTS = 2**22
+
+# Longest run of locations an Or-opt move will shift
+_OR_OPT_LENGTH = 3
+
+# Smallest relative gain counted as an improvement, to ignore rounding
+_EPSILON = 1e-9
+
+# Shards of the exhaustive search handed to each worker process
+_SHARDS_PER_WORKER = 8
+
+# The distance matrix as seen by a worker process
+_worker_matrix = None
+
+# Rough speeds used by solve to judge what fits in a time budget
+_HELD_KARP_RATE = 1e8           # Table updates per second
+_NEAREST_NEIGHBOUR_RATE = 2e8   # Matrix elements scanned per second
+
+# Largest Held-Karp table solve will build, in bytes
+_HELD_KARP_MEMORY = 2**28
+
+# Rounds of subgradient ascent used to weight the branch_and_bound bound,
+# per location, and the rounds without progress before the step is halved
+_PENALTY_ROUNDS = 10
+_PENALTY_PATIENCE = 10
+
+# Rounds of ascent which refine the penalties of each partial route
+# before it is branched on
+_REFINE_ROUNDS = 15
+
+# Most locations solve will hand to branch_and_bound
+_BRANCH_AND_BOUND_LIMIT = 30
+_BRANCH_AND_BOUND_ASYMMETRIC_LIMIT = 20
+
+# Share of the time budget solve gives to building the first route
+_CONSTRUCTION_SHARE = 0.25
+
+# Fewest seconds between the routes reported by anytime
+_ANYTIME_INTERVAL = 0.1
+
+def solve(matrix, time_budget=None, max_gap=0.0, stop=None):
+    '''Pick a search to suit the matrix and budget, and return its result
+
+    Small problems are solved exactly with held_karp when its table fits the
+    budget. Medium problems use branch_and_bound, which stops early at the
+    budget or max_gap. Anything larger is built with nearest_neighbour and
+    then improved with local_search for the rest of the budget.
+
+    Returns the cost, the route and a dictionary of details holding the
+    algorithm used, the seconds taken, a lower bound on the best cost and
+    the gap between the two. The bound and gap are None when unknown.
+
+    Parameters:
+    matrix             Distance matrix
+    time_budget        Seconds the search should take, no limit if not given
+    max_gap            The gap which is good enough to stop searching
+    stop               An event which stops the search early once set
+    '''
+    for result in anytime(matrix, time_budget, max_gap, stop, interval=None):
+        pass
+    return result
+
+def anytime(matrix, time_budget=None, max_gap=0.0, stop=None,
+            interval=_ANYTIME_INTERVAL):
+    '''Search as solve does, yielding each better route as it is found
+
+    Each item is the cost, route and details in the form solve returns,
+    with details["final"] set only on the last item, which is the result
+    solve would give. Setting stop ends the search, and the last item is
+    then the best route found so far. A usable route is yielded as soon as
+    the greedy search has built one, so the caller can show it while the
+    search goes on.
+
+    Parameters:
+    matrix             Distance matrix
+    time_budget        Seconds the search should take, no limit if not given
+    max_gap            The gap which is good enough to stop searching
+    stop               An event which stops the search early once set
+    interval           Fewest seconds between yielded routes, other than the
+                       last, so fast improvements are not all reported
+    '''
+    start = time()
+    size = len(matrix)
+    costs = np.asarray(matrix, dtype=float).reshape(size, size)
+    symmetric = bool(np.allclose(costs, costs.T))
+
+    # Estimated cost of the exact dynamic programme, whose time is only
+    # worked out once the table fits, as it is too large for a float
+    # on big matrices
+    table_bytes = size*2**size*9
+    exact_fits = (table_bytes <= _HELD_KARP_MEMORY and
+                  (time_budget is None or
+                   size**2*2**size/_HELD_KARP_RATE <= time_budget))
+
+    if size < 3 or exact_fits:
+        algorithm = "held_karp"
+        steps = _exact_steps(matrix, stop)
+
+    elif size <= (_BRANCH_AND_BOUND_LIMIT if symmetric else
+                  _BRANCH_AND_BOUND_ASYMMETRIC_LIMIT):
+        algorithm = "branch_and_bound"
+        steps = _branch_and_bound(matrix, time_budget, stop, max_gap)
+
+    else:
+        algorithm = "nearest_neighbour+local_search"
+        steps = _greedy_steps(matrix, costs, time_budget, stop, start)
+
+    # Report improvements no more often than the interval allows, and
+    # take the gap of the final route from the end of the steps
+    reported = None
+    last_report = None
+    improvements = 0
+    while True:
+        try:
+            shortest, route = next(steps)
+        except StopIteration as finished:
+            gap = finished.value
+            break
+        improvements += 1
+        now = time()
+        if reported is not None and shortest >= reported:
+            continue
+        if (interval is not None and last_report is not None
+                and now-last_report < interval):
+            continue
+        reported, last_report = shortest, now
+        details = {
+            "algorithm": algorithm,
+            "bound": None,
+            "gap": None,
+            "elapsed": now-start,
+            "final": False,
+            }
+        yield _matrix_cost(matrix, route), type(route)(route), details
+
+    # The cost is summed from the original matrix to keep its type
+    shortest = _matrix_cost(matrix, route)
+    details = {
+        "algorithm": algorithm,
+        "bound": None if gap is None else shortest*(1-gap),
+        "gap": gap,
+        "elapsed": time()-start,
+        "final": True,
+        }
+    metrics.observe("search", details["elapsed"], algorithm=algorithm)
+    metrics.count("search_improvements", improvements, algorithm=algorithm)
+    yield shortest, route, details
+
+def _exact_steps(matrix, stop):
+    '''Yield the nearest_neighbour route then the route found by
+    held_karp, and return its gap of 0, in the same way as the steps of the
+    other searches
+
+    If stop is set before the table is finished, the nearest_neighbour
+    route is the last and no gap is known, so None is returned.
+
+    Parameters:
+    matrix             Distance matrix
+    stop               An event which stops the search early once set
+    '''
+    if len(matrix) < 3:
+        yield held_karp(matrix)
+        return 0.0
+
+    # A route to show while the table is built
+    yield nearest_neighbour(matrix)
+    exact = held_karp(matrix, stop)
+    if exact is None:
+        return None
+    yield exact
+    return 0.0
+
+def _greedy_steps(matrix, costs, time_budget, stop, start):
+    '''Build a route with nearest_neighbour then improve it, yielding the
+    cost and route after each step
+
+    The route is changed in place between steps. No gap is known, so None
+    is returned.
+
+    Parameters:
+    matrix             Distance matrix
+    costs              Distance matrix as an array
+    time_budget        Seconds the search should take, no limit if None
+    stop               An event which stops the search early once set
+    start              The time the search began
+    '''
+    size = len(costs)
+
+    # Only try as many greedy starts as fit in part of the budget
+    starts = None
+    if time_budget is not None:
+        affordable = (time_budget*_CONSTRUCTION_SHARE
+                      *_NEAREST_NEIGHBOUR_RATE/size**2)
+        starts = range(max(1, min(size, int(affordable))))
+    shortest, route = nearest_neighbour(costs, starts=starts)
+    route = list(route)
+    yield shortest, route
+
+    time_limit = None
+    if time_budget is not None:
+        time_limit = max(0.0, time_budget-(time()-start))
+    for shortest in _improve(matrix, route, 8, None, time_limit, stop):
+        yield shortest, route
+    return None
+
+def nearest_neighbour(matrix, starts=None):
     '''Calculate the shortest route using a greedy search
 
+    The greedy search is run from every starting row at once. Each run keeps
+    a mask which adds infinity to the locations it has visited, and every
+    step moves all the runs forward together. The runs are processed in
+    blocks to bound the memory used on large matrices.
+
     Parameters:
     matrix             Distance matrix
+    starts             The rows to start from, every row if not given
     '''
 
     # Intialise varibles and fill them with dud values
     shortest = float("inf")
     best_route = None
 
-    # Peform the nearest neighbour algorithm starting from every row
-    for row_index in range(len(matrix)):
-        current_row = row_index
-        temp_matrix = deepcopy(matrix)
-
-        # 0 distance routes aren't allowed
-        for row in range(len(temp_matrix)):
-            temp_matrix[row][row] = float("inf")
-
-        # Values for the current run
-        test_time = 0
-        route = [current_row]
-
-        # Nearest neighbour algorithm
-        while len(route) != len(matrix):
-            lowest = min(temp_matrix[current_row])
-            index  = temp_matrix[current_row].index(lowest)
-            test_time += lowest
-            route.append(index)
-
-            #Ensures that a node is never visited more than once
-            for i in range(len(temp_matrix)):
-                temp_matrix[i][current_row] = float("inf")
-                temp_matrix[current_row][i] = float("inf")
-            
-            current_row = index
+    size = len(matrix)
+    if size == 0:
+        return shortest, best_route
+
+    costs = _finite_costs(np.asarray(matrix, dtype=float))
+    if starts is None:
+        starts = range(size)
+    starts = np.asarray(list(starts), dtype=np.intp)
+
+    # Number of runs that fit in one block
+    block_size = max(1, _NN_BLOCK_ELEMENTS // size)
+
+    for first in range(0, len(starts), block_size):
+        current = starts[first:first+block_size]
+        runs = np.arange(len(current))
+
+        # Values for the current block of runs, visited nodes cost infinity
+        visited = np.zeros((len(current), size))
+        visited[runs, current] = np.inf
+        routes = np.empty((len(current), size), dtype=np.intp)
+        routes[:, 0] = current
+        test_times = np.zeros(len(current))
+
+        # Nearest neighbour algorithm, with visited nodes never chosen again
+        for step in range(1, size):
+            rows = costs[current]
+            rows += visited
+            current = rows.argmin(axis=1)
+            test_times += rows[runs, current]
+            visited[runs, current] = np.inf
+            routes[:, step] = current
+
+        # The best route is saved, earlier starts winning ties
+        best = int(test_times.argmin())
+        if shortest > test_times[best]:
+            shortest = test_times[best]
+            best_route = routes[best].tolist()
+
+    # The cost is summed from the original matrix to keep its type
+    if best_route is not None:
+        shortest = 0
+        for index in range(size-1):
+            shortest += matrix[best_route[index]][best_route[index+1]]
 
-        # The best route is saved
-        if shortest > test_time:
-            shortest = test_time
-            best_route = route
-            
     return shortest, best_route
 
 def brute_force(matrix):
@@ -73,3 +306,696 @@ def brute_force(matrix):
             best_route = order
 
     return shortest, best_route
+
+def parallel_brute_force(matrix, workers=None, prefix_length=None):
+    '''Iterate though all possible routes using several processes
+
+    The routes are split up by their first few locations, and each split is
+    searched by a worker process. The matrix is placed in shared memory once
+    rather than being sent with every split. Splits are reduced in the same
+    order brute_force visits them, so the same route is returned.
+
+    Parameters:
+    matrix             Distance matrix
+    workers            Number of worker processes, one per CPU if not given
+    prefix_length      Locations fixed by each split, chosen if not given
+    '''
+    size = len(matrix)
+    if size < 3:
+        return brute_force(matrix)
+
+    if workers is None:
+        workers = cpu_count() or 1
+
+    # Use the shortest prefix which gives every worker several splits
+    if prefix_length is None:
+        prefix_length = 1
+        while (prefix_length < size-1 and
+               perm(size, prefix_length) < workers*_SHARDS_PER_WORKER):
+            prefix_length += 1
+    prefix_length = min(prefix_length, size-1)
+    prefixes = permutations(range(size), prefix_length)
+    chunksize = max(1, perm(size, prefix_length)//(workers*_SHARDS_PER_WORKER))
+
+    # Intialise varibles and fill them with dud values
+    shortest = float("inf")
+    best_route = None
+
+    costs = np.asarray(matrix, dtype=float)
+    shared = shared_memory.SharedMemory(create=True, size=costs.nbytes)
+    try:
+        np.ndarray(costs.shape, dtype=float, buffer=shared.buf)[:] = costs
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_attach_matrix,
+                initargs=(shared.name, costs.shape)
+                ) as pool:
+            # The best route from each split, in order
+            for total_time, route in pool.map(
+                    _best_with_prefix, prefixes, chunksize=chunksize):
+                if total_time < shortest:
+                    shortest = total_time
+                    best_route = route
+    finally:
+        shared.close()
+        shared.unlink()
+
+    # The cost is summed from the original matrix to keep its type
+    shortest = 0
+    for index in range(size-1):
+        shortest += matrix[best_route[index]][best_route[index+1]]
+
+    return shortest, best_route
+
+def _attach_matrix(name, shape):
+    '''Read the distance matrix from shared memory into a worker process
+
+    Parameters:
+    name               The name of the shared memory block
+    shape              The shape of the distance matrix
+    '''
+    global _worker_matrix
+    shared = shared_memory.SharedMemory(name=name)
+    _worker_matrix = np.ndarray(shape, dtype=float, buffer=shared.buf).tolist()
+    shared.close()
+
+def _best_with_prefix(prefix):
+    '''Return the best route which starts with prefix, in a worker process
+
+    Routes are visited in the same order as permutations, and their cost is
+    built up one step at a time rather than summed from scratch.
+
+    Parameters:
+    prefix             The locations every route in this split starts with
+    '''
+    matrix = _worker_matrix
+    path = list(prefix)
+    best = [float("inf"), None]
+
+    def extend(so_far, left):
+        row = matrix[path[-1]]
+
+        # The last two locations are tried in both orders directly
+        if len(left) == 2:
+            first, second = left
+            for one, two in ((first, second), (second, first)):
+                total_time = so_far+row[one]+matrix[one][two]
+                if total_time < best[0]:
+                    best[0] = total_time
+                    best[1] = tuple(path)+(one, two)
+            return
+
+        for index, node in enumerate(left):
+            path.append(node)
+            extend(so_far+row[node], left[:index]+left[index+1:])
+            path.pop()
+
+    # Cost along the fixed prefix
+    so_far = 0
+    for index in range(len(prefix)-1):
+        so_far += matrix[prefix[index]][prefix[index+1]]
+
+    left = sorted(set(range(len(matrix)))-set(prefix))
+    if len(left) == 1:
+        best = [so_far+matrix[prefix[-1]][left[0]], tuple(path+left)]
+    else:
+        extend(so_far, left)
+    return best[0], best[1]
+
+def held_karp(matrix, stop=None):
+    '''Find the best route exactly using the Held-Karp dynamic programme
+
+    Every subset of locations is stored as a bitmask, and for each subset
+    the table holds the cheapest path that visits exactly that subset and
+    ends at each location. This takes O(n^2*2^n) time rather than the
+    O(n!*n) of brute_force. Costs are always read from origin to
+    destination, so asymmetric matrices are handled. Setting stop ends the
+    search before the next subset size, and None is then returned.
+
+    Parameters:
+    matrix             Distance matrix
+    stop               An event which stops the search early once set
+    '''
+    size = len(matrix)
+
+    # Trivial routes need no table
+    if size < 2:
+        return 0, tuple(range(size))
+
+    costs = np.asarray(matrix, dtype=float)
+    full  = 1 << size
+
+    # best[mask, node] is the cheapest path over mask ending at node and
+    # parent[mask, node] is the node visited just before it
+    best   = np.full((full, size), np.inf)
+    parent = np.full((full, size), -1, dtype=np.int8 if size < 128 else np.int16)
+
+    # A path can start from any location for free
+    singles = 1 << np.arange(size)
+    best[singles, np.arange(size)] = 0
+
+    # Masks grouped by how many locations they contain
+    masks = np.arange(full)
+    counts = np.zeros(full, dtype=np.int8)
+    for node in range(size):
+        counts += (masks >> node) & 1
+
+    # Build up the table one subset size at a time
+    for visited in range(2, size+1):
+        if stop is not None and stop.is_set():
+            return None
+        layer = masks[counts == visited]
+        for node in range(size):
+            # Subsets which end at this node, and the subsets before it
+            ending   = layer[(layer >> node) & 1 == 1]
+            previous = ending ^ (1 << node)
+
+            # Extend every earlier path by the move to this node
+            options = best[previous] + costs[:, node]
+            options[:, node] = np.inf
+            choice = options.argmin(axis=1)
+            best[ending, node]   = options[np.arange(len(ending)), choice]
+            parent[ending, node] = choice
+
+    # With a location that cannot be reached every route costs infinity and
+    # the parents do not form a path, so any order is as good as another
+    mask = full - 1
+    if not np.isfinite(best[mask]).any():
+        return _matrix_cost(matrix, range(size)), tuple(range(size))
+
+    # Walk the parents back from the cheapest complete path
+    node = int(best[mask].argmin())
+    route = []
+    while node != -1:
+        route.append(node)
+        mask, node = mask ^ (1 << node), int(parent[mask, node])
+    route.reverse()
+
+    # The cost is summed from the original matrix to keep its type
+    shortest = 0
+    for index in range(size-1):
+        shortest += matrix[route[index]][route[index+1]]
+
+    return shortest, tuple(route)
+
+def local_search(matrix, route, neighbours=8, max_iterations=None,
+                 time_limit=None, stop=None):
+    '''Improve a route using 2-opt and Or-opt moves and return the result
+
+    Only moves which join a location to one of its closest neighbours are
+    tried. A location whose moves have all failed is skipped until one of
+    the edges next to it changes. Running totals of the route cost in both
+    directions let each move be priced in constant time, including
+    reversals on asymmetric matrices.
+
+    Parameters:
+    matrix             Distance matrix
+    route              The starting route, such as from nearest_neighbour
+    neighbours         How many of the closest locations are tried for each
+    max_iterations     Most improving moves to make, no limit if not given
+    time_limit         Most seconds to spend improving, no limit if not given
+    stop               An event which stops the improvement once set
+    '''
+    route = list(route)
+    size = len(route)
+
+    if size > 2:
+        for _ in _improve(matrix, route, neighbours, max_iterations,
+                          time_limit, stop):
+            pass
+
+    return _matrix_cost(matrix, route), route
+
+def _candidates(costs, neighbours):
+    '''Return the closest locations to each location, in either direction
+
+    Parameters:
+    costs              Distance matrix as an array
+    neighbours         How many locations to keep for each location
+    '''
+    closest = np.minimum(costs, costs.T)
+    np.fill_diagonal(closest, np.inf)
+    count = min(neighbours, len(costs)-1)
+
+    # Partition first so only the kept locations need sorting
+    near = np.argpartition(closest, count-1, axis=1)[:, :count]
+    order = np.take_along_axis(closest, near, axis=1).argsort(axis=1)
+    return np.take_along_axis(near, order, axis=1).tolist()
+
+def _improve(matrix, route, neighbours, max_iterations, time_limit, stop):
+    '''Apply improving 2-opt and Or-opt moves to a route in place, yielding
+    the cost of the route after each move
+
+    Parameters:
+    matrix             Distance matrix
+    route              The route to improve
+    neighbours         How many of the closest locations are tried for each
+    max_iterations     Most improving moves to make
+    time_limit         Most seconds to spend improving
+    stop               An event which stops the improvement once set
+    '''
+    size = len(route)
+    costs = _finite_costs(np.asarray(matrix, dtype=float))
+    dist = costs.tolist()
+    near = _candidates(costs, neighbours)
+    deadline = None if time_limit is None else time()+time_limit
+
+    # Positions of each location and running totals along the route
+    position = [0]*size
+    forward  = [0.0]*size
+    backward = [0.0]*size
+
+    def refresh():
+        for index, node in enumerate(route):
+            position[node] = index
+        for index in range(1, size):
+            forward[index]  = forward[index-1]+dist[route[index-1]][route[index]]
+            backward[index] = backward[index-1]+dist[route[index]][route[index-1]]
+
+    def two_opt(i, j):
+        # Cost change from reversing route[i:j+1]
+        delta = (backward[j]-backward[i])-(forward[j]-forward[i])
+        if i > 0:
+            delta += dist[route[i-1]][route[j]]-dist[route[i-1]][route[i]]
+        if j < size-1:
+            delta += dist[route[i]][route[j+1]]-dist[route[j]][route[j+1]]
+        return delta
+
+    def or_opt(i, length, after, reverse):
+        # Cost change from moving route[i:i+length] to after route[after]
+        start, end = route[i], route[i+length-1]
+        delta = 0
+        if i > 0:
+            delta -= dist[route[i-1]][start]
+        if i+length < size:
+            delta -= dist[end][route[i+length]]
+        if i > 0 and i+length < size:
+            delta += dist[route[i-1]][route[i+length]]
+        if after >= 0 and after+1 < size:
+            delta -= dist[route[after]][route[after+1]]
+        if reverse:
+            start, end = end, start
+            last = i+length-1
+            delta += (backward[last]-backward[i])-(forward[last]-forward[i])
+        if after >= 0:
+            delta += dist[route[after]][start]
+        if after+1 < size:
+            delta += dist[end][route[after+1]]
+        return delta
+
+    def moves(node):
+        # Every move which makes node adjacent to one of its neighbours
+        here = position[node]
+        for other in near[node]:
+            there = position[other]
+            low, high = min(here, there), max(here, there)
+            if high-low > 1:
+                yield two_opt(low+1, high), ("2-opt", low+1, high)
+                yield two_opt(low, high-1), ("2-opt", low, high-1)
+            for length in range(1, min(_OR_OPT_LENGTH, size-1)+1):
+                for i in (here, here-length+1):
+                    if i < 0 or i+length > size or i <= there < i+length:
+                        continue
+                    for after in (there, there-1):
+                        if i-1 <= after <= i+length-1:
+                            continue
+                        for reverse in (False, True):
+                            yield (or_opt(i, length, after, reverse),
+                                   ("or-opt", i, length, after, reverse))
+                    if length == 1:
+                        break
+
+    def apply(move):
+        # Change the route and return the locations next to changed edges
+        if move[0] == "2-opt":
+            _, i, j = move
+            touched = route[max(i-1, 0):i+1]+route[j:j+2]
+            route[i:j+1] = route[i:j+1][::-1]
+        else:
+            _, i, length, after, reverse = move
+            touched = route[max(i-1, 0):i+1]+route[i+length-1:i+length+1]
+            touched += route[max(after, 0):after+2]
+            segment = route[i:i+length]
+            if reverse:
+                segment.reverse()
+            del route[i:i+length]
+            insert = after+1 if after < i else after+1-length
+            route[insert:insert] = segment
+        refresh()
+        return touched
+
+    refresh()
+    threshold = -_EPSILON*max(1.0, abs(forward[-1]))
+    iterations = 0
+
+    # Locations with their don't-look bit cleared wait in the queue
+    queue = deque(route)
+    waiting = [True]*size
+
+    while queue:
+        if max_iterations is not None and iterations >= max_iterations:
+            break
+        if deadline is not None and time() > deadline:
+            break
+        if stop is not None and stop.is_set():
+            break
+
+        node = queue.popleft()
+        waiting[node] = False
+
+        best_delta, best_move = threshold, None
+        for delta, move in moves(node):
+            if delta < best_delta:
+                best_delta, best_move = delta, move
+
+        # Wake the locations around an improvement so they are tried again
+        if best_move is not None:
+            iterations += 1
+            for other in apply(best_move)+[node]:
+                if not waiting[other]:
+                    waiting[other] = True
+                    queue.append(other)
+            yield forward[-1]
+
+    metrics.count("search_moves", iterations)
+
+def branch_and_bound(matrix, time_limit=None, stop=None, max_gap=0.0):
+    '''Find the best route exactly by pruning routes that cannot win
+
+    The best known route starts as the improved nearest neighbour route.
+    Partial routes are explored depth first, and any whose cost plus a lower
+    bound on finishing it cannot beat the best known route is dropped.
+
+    The bound is the Held-Karp 1-tree bound. A route is a cycle once an
+    extra location, free to reach from anywhere, joins its two ends, and
+    any way of finishing it is a spanning tree over the last location and
+    those left plus two links to the extra location. Each location is given
+    a penalty added to every cost to or from it, which does not change
+    which route is best. The penalties are found by subgradient ascent so
+    that the trees are as close to routes as possible, which makes the
+    bound much tighter than a plain spanning tree. They are refined with a
+    few more rounds for each partial route, starting from those of the
+    route it grew from. Every next step is bounded before it is kept, so
+    hopeless ones are dropped at once.
+
+    The search can be stopped early by a time limit or by setting stop. The
+    best route found so far is returned along with the gap, the fraction by
+    which it may still be beaten. A gap of 0 means the route is optimal.
+    Allowing a larger gap lets more partial routes be dropped.
+
+    Parameters:
+    matrix             Distance matrix
+    time_limit         Most seconds to spend searching, no limit if not given
+    stop               An event which stops the search once set
+    max_gap            The gap which is good enough to stop searching
+    '''
+    shortest, route, gap = _last_step(
+        _branch_and_bound(matrix, time_limit, stop, max_gap)
+        )
+    return _matrix_cost(matrix, route), route, gap
+
+def _branch_and_bound(matrix, time_limit, stop, max_gap):
+    '''Search as branch_and_bound does, yielding the cost and route of each
+    better route found, then return the gap of the last
+
+    Parameters:
+    matrix             Distance matrix
+    time_limit         Most seconds to spend searching, no limit if None
+    stop               An event which stops the search once set
+    max_gap            The gap which is good enough to stop searching
+    '''
+    size = len(matrix)
+
+    # Trivial routes need no search
+    if size < 3:
+        yield held_karp(matrix)
+        return 0.0
+
+    costs = _finite_costs(np.asarray(matrix, dtype=float))
+    weights = np.minimum(costs, costs.T)
+    deadline = None if time_limit is None else time()+time_limit
+
+    # Seed the best known route from the greedy search
+    shortest, best_route = nearest_neighbour(matrix)
+    best_route = list(best_route)
+    yield shortest, best_route
+    for shortest in _improve(matrix, best_route, 8, None, None, None):
+        yield shortest, best_route
+    best_route = tuple(best_route)
+    shortest = _route_cost(costs, best_route)
+    yield shortest, best_route
+
+    # Lowest bound of any partial route dropped only because of max_gap
+    dropped = shortest
+
+    # Each entry is a bound, the cost so far, the path, the nodes left and
+    # the penalties its bound was found with
+    penalties, root_bound = _penalties(weights, shortest)
+    everything = frozenset(range(size))
+    stack = []
+    for node in reversed(range(size)):
+        left = everything-{node}
+        bound = _path_bound(weights, penalties, node, list(left))
+        stack.append((max(bound, root_bound), 0.0, (node,), left, penalties))
+
+    explored = 0
+    while stack:
+        if stop is not None and stop.is_set():
+            break
+        if deadline is not None and time() > deadline:
+            break
+
+        bound, so_far, path, left, penalties = stack.pop()
+        explored += 1
+        if bound >= shortest-abs(shortest)*_EPSILON:
+            continue
+        if bound >= shortest*(1-max_gap):
+            dropped = min(dropped, bound)
+            continue
+
+        # Penalties which suit the locations left give a tighter bound
+        last = path[-1]
+        remaining = list(left)
+        if len(left) > 2:
+            penalties, rest_bound = _penalties(
+                weights, shortest-so_far, last, remaining, penalties,
+                _REFINE_ROUNDS
+                )
+            bound = max(bound, so_far+rest_bound)
+            if bound >= shortest-abs(shortest)*_EPSILON:
+                continue
+            if bound >= shortest*(1-max_gap):
+                dropped = min(dropped, bound)
+                continue
+
+        # Routes one step from finishing are completed directly
+        if len(left) == 1:
+            total = so_far+costs[last, remaining[0]]
+            if total < shortest-abs(shortest)*_EPSILON:
+                shortest = total
+                best_route = path+(remaining[0],)
+                yield shortest, best_route
+            continue
+
+        # Each next step is bounded before it is kept, and those with lower
+        # bounds are pushed last so they are explored first
+        children = []
+        for node in _order(costs, last, remaining):
+            step = so_far+costs[last, node]
+            rest = left-{node}
+            child = step+_path_bound(weights, penalties, node, list(rest))
+            child = max(child, bound)
+            if child >= shortest-abs(shortest)*_EPSILON:
+                continue
+            if child >= shortest*(1-max_gap):
+                dropped = min(dropped, child)
+                continue
+            children.append((child, step, path+(node,), rest, penalties))
+        children.sort(key=lambda entry: entry[0], reverse=True)
+        stack.extend(children)
+
+    metrics.count("search_nodes", explored)
+
+    # The lowest bound still waiting to be explored limits the optimum
+    lower = min([entry[0] for entry in stack]+[shortest, dropped])
+    return 0.0 if shortest <= 0 else max(0.0, float((shortest-lower)/shortest))
+
+def _last_step(steps):
+    '''Run the steps of a search to the end and return the last cost and
+    route along with the gap the steps return
+
+    Parameters:
+    steps              The steps, such as from _branch_and_bound
+    '''
+    while True:
+        try:
+            shortest, route = next(steps)
+        except StopIteration as finished:
+            return shortest, route, finished.value
+
+def _matrix_cost(matrix, route):
+    '''Return the cost of following a route, summed from the original
+    matrix to keep its type
+
+    Parameters:
+    matrix             Distance matrix
+    route              The route to cost
+    '''
+    shortest = 0
+    for index in range(len(route)-1):
+        shortest += matrix[route[index]][route[index+1]]
+    return shortest
+
+def _route_cost(costs, route):
+    '''Return the cost of following a route through a matrix array
+
+    Parameters:
+    costs              Distance matrix as an array
+    route              The route to cost
+    '''
+    route = np.asarray(route, dtype=np.intp)
+    return float(costs[route[:-1], route[1:]].sum())
+
+def _finite_costs(costs):
+    '''Return a matrix array with the infinite costs, between locations with
+    no route, replaced by a cost above that of any route which avoids them
+
+    Searches then still build whole routes, and prefer those with the fewest
+    such steps, when a location cannot be reached. Routes are costed from
+    the original matrix, so their cost is still infinite.
+
+    Parameters:
+    costs              Distance matrix as an array
+    '''
+    finite = np.isfinite(costs)
+    if finite.all():
+        return costs
+    highest = costs[finite].max() if finite.any() else 0.0
+    return np.where(finite, costs, len(costs)*max(highest, 0.0)+1.0)
+
+def _order(costs, last, nodes):
+    '''Return nodes sorted by the cost of moving to them from last
+
+    Parameters:
+    costs              Distance matrix as an array
+    last               The node being moved from
+    nodes              The nodes to sort
+    '''
+    keys = costs[last, nodes].tolist()
+    return [node for _, node in sorted(zip(keys, nodes))]
+
+def _spanning_tree(weights, nodes, penalties):
+    '''Return the weight of the minimum spanning tree over nodes, with each
+    cost raised by the penalties of its ends, and the number of tree edges
+    at each node
+
+    Parameters:
+    weights            Symmetric distance matrix as an array
+    nodes              The nodes the tree must span
+    penalties          The penalty of every node
+    '''
+    degrees = np.zeros(len(nodes), dtype=np.intp)
+    if len(nodes) < 2:
+        return 0.0, degrees
+
+    # Prim's algorithm, growing the tree from the first node
+    sub = weights[np.ix_(nodes, nodes)]
+    sub = sub+penalties[nodes][:, None]+penalties[nodes][None, :]
+    linked = np.zeros(len(nodes), dtype=bool)
+    linked[0] = True
+    links = sub[0].copy()
+    parents = np.zeros(len(nodes), dtype=np.intp)
+    total = 0.0
+    for _ in range(len(nodes)-1):
+        links[linked] = np.inf
+        node = links.argmin()
+        total += links[node]
+        linked[node] = True
+        degrees[node] += 1
+        degrees[parents[node]] += 1
+        closer = sub[node] < links
+        links[closer] = sub[node][closer]
+        parents[closer] = node
+
+    return float(total), degrees
+
+def _path_bound(weights, penalties, last, nodes):
+    '''Return a lower bound on the cost of a route from last through every
+    one of nodes
+
+    The route with an extra location joining its ends is a cycle, which
+    holds a spanning tree over last and nodes, the link from the extra
+    location to last, and one more link to it from the node the route
+    finishes at.
+
+    Parameters:
+    weights            Symmetric distance matrix as an array
+    penalties          The penalty of every node
+    last               The node the route starts from
+    nodes              The nodes the route must visit
+    '''
+    if not nodes:
+        return 0.0
+    spanned = [last]+nodes
+    tree, _ = _spanning_tree(weights, spanned, penalties)
+    links = penalties[last]+penalties[nodes].min()
+    return tree+links-2*penalties[spanned].sum()
+
+def _penalties(weights, upper, last=None, nodes=None, penalties=None,
+               rounds=None):
+    '''Return penalties for each node which tighten the 1-tree bound on
+    the best route, along with the bound they give
+
+    Subgradient ascent raises the penalty of each node with more than two
+    tree edges and lowers it for those with one, so the tree is pushed
+    towards being a route. Given last, the bound is on finishing a route
+    from last, as _path_bound gives.
+
+    Parameters:
+    weights            Symmetric distance matrix as an array
+    upper              The cost of a known route, used to size the steps
+    last               The node the route starts from, free if not given
+    nodes              The nodes the route must visit, all if not given
+    penalties          The penalties to start from, all 0 if not given
+    rounds             Most rounds of ascent, chosen if not given
+    '''
+    if nodes is None:
+        nodes = list(range(len(weights)))
+    spanned = nodes if last is None else [last]+nodes
+    if penalties is None:
+        penalties = np.zeros(len(weights))
+    penalties = penalties.copy()
+    if rounds is None:
+        rounds = _PENALTY_ROUNDS*len(spanned)
+    best_penalties = penalties.copy()
+    best = None
+    scale = 2.0
+    stalled = 0
+
+    for _ in range(rounds):
+        # The extra location links to last, or to the two nodes cheapest
+        # to reach when the start is free, and to the node the route ends at
+        tree, degrees = _spanning_tree(weights, spanned, penalties)
+        weight = penalties[spanned]
+        if last is None:
+            ends = np.argpartition(weight, 1)[:2]
+        else:
+            ends = np.array([0, 1+int(weight[1:].argmin())])
+        degrees[ends] += 1
+        bound = tree+weight[ends].sum()-2*weight.sum()
+
+        if best is None or bound > best+abs(best)*_EPSILON:
+            best, best_penalties, stalled = bound, penalties.copy(), 0
+        else:
+            stalled += 1
+            if stalled >= _PENALTY_PATIENCE:
+                scale, stalled = scale/2, 0
+
+        # Stop once the tree is a route, or the bound has met the route
+        slope = degrees-2
+        norm = float((slope**2).sum())
+        if norm == 0 or bound >= upper-abs(upper)*_EPSILON:
+            break
+        penalties[spanned] += scale*(upper-bound)/norm*slope
+
+    return best_penalties, best
@@ -0,0 +1,417 @@
+'''A long running planning service which answers requests over HTTP
+
+Keeping one process running means the datums, the caches and the worker
+processes are all ready before a request arrives. A request is a job in
+the same form that planner.py reads, sent as JSON to POST /route, and the
+reply is the planned route in the same form that planner.py writes.
+
+GET /stats returns the number of replies of each status and percentiles of
+the time taken to plan, and GET /health returns whether the service is up.
+When started with --metrics, GET /metrics returns the timings and counts of
+metrics.py in the Prometheus text format.
+
+Usage:
+python service.py --port 8000 --workers 4
+python service.py --maps-url http://localhost:8765
+python service.py --metrics --profile profiles
+'''
+import argparse
+import asyncio
+import json
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from os import cpu_count
+from time import perf_counter
+
+import numpy as np
+
+import cache
+import location
+import metrics
+import planner
+import search
+import standardise
+
+# Largest request body accepted, in bytes
+MAX_BODY = 2**20
+
+# Seconds a client may take to send its request
+REQUEST_TIMEOUT = 30
+
+# Messages sent with each status
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    }
+
+
+class HTTPError(Exception):
+    '''Raised to reply to a request with an error status
+
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _solve(distance_matrix, time_budget):
+    # Search in a worker process, sending its metrics back to be merged
+    with metrics.profiling("search"):
+        solution = search.solve(distance_matrix, time_budget)
+    return solution, metrics.take()
+
+def _start_worker(keep_metrics, profile_path):
+    # Worker processes keep metrics and profiles only if this one does
+    if keep_metrics:
+        metrics.enable()
+    metrics.enable_profiling(profile_path)
+
+
+class PlanningService:
+    '''Plans routes for many clients at once from one warm process
+
+    Geocoding and fetching travel times wait on the network, so they run on
+    a pool of threads, while searching needs the processor, so it runs on a
+    pool of processes. Jobs are planned by planner.plan, so those with more
+    than planner.DECOMPOSE_SIZE stops are split into clusters rather than
+    given a full distance matrix. Requests over max_pending are turned away
+    at once rather than left to queue without limit, each client may only
+    have a few requests in progress, and no job may search for longer than
+    max_time_budget.
+
+    Attributes:
+    store              The DistanceMatrixStore shared by every request
+    workers            The number of search processes
+    time_budget        Seconds each search may take if the job gives none
+    max_time_budget    Most seconds any job may ask to search for
+    max_pending        Most requests in progress at once
+    per_client         Most requests in progress from one client
+    latencies          Seconds taken by the most recent plans
+    counts             Number of replies sent with each status
+
+    Methods:
+    warm               Load everything needed before the first request
+    time_budget_for    Return the seconds a job may search for
+    plan               Plan the route for one job
+    stats              Return the counts and latency percentiles
+    handle             Answer one HTTP connection
+    close              Stop the worker pools
+    '''
+    def __init__(self, store=None, workers=None, threads=16, time_budget=5,
+                 max_time_budget=60, max_pending=64, per_client=4,
+                 history=1000):
+        self.store = planner.make_store() if store is None else store
+        self.workers = workers or cpu_count() or 1
+        self.time_budget = time_budget
+        self.max_time_budget = max_time_budget
+        self.max_pending = max_pending
+        self.per_client = per_client
+        self.latencies = deque(maxlen=history)
+        self.counts = {}
+
+        # Requests in progress, in total and by client
+        self._pending = 0
+        self._clients = {}
+
+        self._threads = ThreadPoolExecutor(max_workers=threads)
+        self._processes = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_start_worker,
+            initargs=(metrics.enabled, metrics.profile_directory)
+            )
+
+    def warm(self):
+        '''Load the datums and start the search processes
+
+        '''
+        for datum in (location.datum, "WGS84"):
+            try:
+                standardise.get_datum(datum)
+            except OSError:
+                pass
+        futures = [
+            self._processes.submit(abs, worker)
+            for worker in range(self.workers)
+            ]
+        for future in futures:
+            future.result()
+
+    def time_budget_for(self, job):
+        '''Return the seconds a job may search for, no more than
+        max_time_budget
+
+        Parameters:
+        job                The job, which may give its own time budget
+        '''
+        time_budget = job.get("time_budget", self.time_budget)
+        if (isinstance(time_budget, bool)
+                or not isinstance(time_budget, (int, float))
+                or not time_budget > 0):
+            raise ValueError("time_budget must be a positive number")
+        return min(time_budget, self.max_time_budget)
+
+    def _search(self, distance_matrix, time_budget):
+        # Search on a worker process, waiting on one of the threads
+        solution, taken = self._processes.submit(
+            _solve, distance_matrix, time_budget
+            ).result()
+        metrics.merge(taken)
+        return solution
+
+    async def plan(self, job):
+        '''Plan the route for one job and return the result as a dictionary
+
+        Parameters:
+        job                The job, with its stops and optionally a mode, ID
+                           and time budget
+        '''
+        time_budget = self.time_budget_for(job)
+        loop = asyncio.get_running_loop()
+        locations, failed = await loop.run_in_executor(
+            self._threads, planner.stop_locations, job["stops"]
+            )
+        distance_matrix, (cost, route, details) = await loop.run_in_executor(
+            self._threads,
+            partial(
+                planner.plan,
+                locations,
+                job.get("mode", planner.DEFAULT_MODE).lower(),
+                self.store,
+                time_budget=time_budget,
+                workers=self.workers,
+                solve=self._search
+                )
+            )
+
+        result = {"id": job.get("id")}
+        result.update(planner.describe(locations, failed, cost, route, details))
+        return result
+
+    def stats(self):
+        '''Return the number of replies of each status, the requests in
+        progress and percentiles of the seconds taken to plan
+
+        '''
+        latency = None
+        if self.latencies:
+            values = np.percentile(list(self.latencies), [50, 90, 99])
+            latency = {
+                "count": len(self.latencies),
+                "p50": float(values[0]),
+                "p90": float(values[1]),
+                "p99": float(values[2]),
+                "max": max(self.latencies),
+                }
+        return {
+            "pending": self._pending,
+            "counts": {str(status): n for status, n in self.counts.items()},
+            "latency": latency,
+            }
+
+    async def _read_request(self, reader):
+        # Read the method, path and body of one request
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, path, _ = request_line
+
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    length = int(value)
+                except ValueError:
+                    raise HTTPError(400, "bad Content-Length")
+        if length > MAX_BODY:
+            raise HTTPError(413, "request body too large")
+
+        body = await reader.readexactly(length) if length > 0 else b""
+        return method, path.split("?")[0], body
+
+    async def _route(self, method, path, body, client):
+        # Answer one request, returning the status and reply
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/stats":
+            return 200, self.stats()
+        if path == "/metrics" and metrics.enabled:
+            return 200, metrics.to_prometheus()
+        if path != "/route":
+            raise HTTPError(404, "no such path")
+        if method != "POST":
+            raise HTTPError(405, "use POST")
+
+        # Turn work away rather than let it queue without limit
+        if self._pending >= self.max_pending:
+            raise HTTPError(503, "too many requests in progress")
+        if self._clients.get(client, 0) >= self.per_client:
+            raise HTTPError(429, "too many requests from this client")
+
+        try:
+            job = json.loads(body)
+        except ValueError as error:
+            raise HTTPError(400, "invalid JSON: "+str(error))
+        if not isinstance(job, dict) or not isinstance(job.get("stops"), list):
+            raise HTTPError(400, "a job must be an object with a stops list")
+
+        self._pending += 1
+        self._clients[client] = self._clients.get(client, 0)+1
+        start = perf_counter()
+        try:
+            result = await self.plan(job)
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        finally:
+            self._pending -= 1
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+        self.latencies.append(perf_counter()-start)
+        return 200, result
+
+    async def handle(self, reader, writer):
+        '''Answer one HTTP connection
+
+        Parameters:
+        reader             The stream the request is read from
+        writer             The stream the reply is written to
+        '''
+        peer = writer.get_extra_info("peername")
+        client = peer[0] if isinstance(peer, tuple) else peer
+        try:
+            try:
+                method, path, body = await asyncio.wait_for(
+                    self._read_request(reader), REQUEST_TIMEOUT
+                    )
+                status, reply = await self._route(method, path, body, client)
+            except HTTPError as error:
+                status, reply = error.status, {"error": str(error)}
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return
+            except Exception as error:
+                status = 500
+                reply = {"error": type(error).__name__+": "+str(error)}
+
+            # Metrics are sent as text, everything else as JSON
+            self.counts[status] = self.counts.get(status, 0)+1
+            if isinstance(reply, str):
+                data = reply.encode()
+                content_type = "text/plain; version=0.0.4"
+            else:
+                data = json.dumps(reply).encode()
+                content_type = "application/json"
+            headers = [
+                "HTTP/1.1 "+str(status)+" "+_REASONS[status],
+                "Content-Type: "+content_type,
+                "Content-Length: "+str(len(data)),
+                "Connection: close",
+                ]
+            if status in (429, 503):
+                headers.append("Retry-After: 1")
+            writer.write(("\r\n".join(headers)+"\r\n\r\n").encode()+data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        '''Stop the worker pools
+
+        '''
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        self._processes.shutdown(wait=False, cancel_futures=True)
+
+
+async def serve(service, host="127.0.0.1", port=8000, ready=None):
+    '''Answer requests with the service until cancelled or signalled
+
+    Parameters:
+    service            The PlanningService to answer with
+    host               The address to listen on
+    port               The port to listen on, any free port if 0
+    ready              Called with the address once listening
+    '''
+    server = await asyncio.start_server(service.handle, host, port)
+    if ready is not None:
+        ready(server.sockets[0].getsockname())
+
+    # Stop listening when asked to, so the worker pools can be shut down
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, server.close)
+        except NotImplementedError:
+            pass
+
+    async with server:
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--time-budget", type=float,
+                        default=planner.DEFAULT_TIME_BUDGET)
+    parser.add_argument("--max-time-budget", type=float, default=60,
+                        help="most seconds a job may ask to search for")
+    parser.add_argument("--max-pending", type=int, default=64)
+    parser.add_argument("--per-client", type=int, default=4)
+    parser.add_argument("--geocode-cache", default=planner.GEOCODE_CACHE)
+    parser.add_argument("--matrix-cache", default=planner.MATRIX_CACHE)
+    parser.add_argument("--offline", action="store_true",
+                        help="estimate travel times instead of fetching them")
+    parser.add_argument("--maps-url",
+                        help="server to geocode and fetch travel times from "
+                             "instead of Google Maps, such as maps_stub.py")
+    parser.add_argument("--metrics", action="store_true",
+                        help="keep timings and counts, served at /metrics")
+    parser.add_argument("--profile",
+                        help="folder to save a cProfile profile of each "
+                             "search in")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    metrics.enable_profiling(args.profile)
+    location.geocode_cache = cache.GeocodeCache(args.geocode_cache)
+    location.maps_url = args.maps_url
+    service = PlanningService(
+        planner.make_store(args.matrix_cache, args.offline, args.maps_url),
+        workers=args.workers,
+        time_budget=args.time_budget,
+        max_time_budget=args.max_time_budget,
+        max_pending=args.max_pending,
+        per_client=args.per_client
+        )
+    service.warm()
+    try:
+        asyncio.run(serve(
+            service, args.host, args.port,
+            ready=lambda address: print("Listening on %s:%d" % address[:2])
+            ))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
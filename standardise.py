@@ -3,31 +3,152 @@
 '''
 import math
 
+import numpy as np
+
+import metrics
+
+# Stopping rules for the meridian arc iteration. It reaches 0.01 mm of
+# northing within 5 steps anywhere on the grid, so the cap is never reached
+# by a valid point
+MERIDIAN_TOLERANCE = 0.00001   # Metres of northing
+MERIDIAN_MAX_ITERATIONS = 10
+
+# Steps taken when latitude is found by iteration rather than by Bowring's
+# method. Each step shrinks the error about two hundred times, leaving it
+# under 0.0001 mm after 4 steps
+LATITUDE_ITERATIONS = 4
+
+class Datum:
+    '''The constants of a datum, read once from its file
+
+    The first line of a datum's file holds its constants. Values which are
+    derived from them are worked out once here rather than on every
+    conversion.
+
+    Attributes:
+    name               The name of the datum
+    path               The file the datum was read from
+    semi_major         Semi-major axis of the ellipsoid
+    semi_minor         Semi-minor axis of the ellipsoid
+    scale_factor       Scale factor on the central meridian
+    lat_origin         Latitude  of the true origin in radians
+    lon_origin         Longitude of the true origin in radians
+    north_origin       Northing of the true origin
+    east_origin        Easting  of the true origin
+    dx, dy, dz         Translation to the standard datum
+    ds                 Scale change to the standard datum
+    rx, ry, rz         Rotations to the standard datum in radians
+    e2                 Eccentricity squared
+    ep2                Second eccentricity squared
+    n                  Ratio of the difference and sum of the axes
+    squares            Easting and Northing of each grid square's corner,
+                       keyed by its two lower case letters
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.path = name+".txt"
+
+        # Access data from database
+        with open(self.path, "r") as file:
+            db = [line.split(",") for line in file.readlines()]
+        datum_data = db[0] if db else []
+
+        def value(index, scale=1):
+            # Not every datum has a projection and shift to the standard
+            if index >= len(datum_data) or not datum_data[index].strip():
+                return None
+            return float(datum_data[index])*scale
+
+        # Load and configure database data
+        self.semi_major   = value(0)
+        self.semi_minor   = value(1)
+        self.scale_factor = value(2)
+        self.lat_origin   = value(3, math.pi/180)
+        self.lon_origin   = value(4, math.pi/180)
+        self.north_origin = value(5)
+        self.east_origin  = value(6)
+        self.dx = value(7)
+        self.dy = value(8)
+        self.dz = value(9)
+        self.ds = value(10, 10**-6)
+        self.rx = value(11, math.pi/(180*3600))
+        self.ry = value(12, math.pi/(180*3600))
+        self.rz = value(13, math.pi/(180*3600))
+
+        # Values derived from the ellipsoid
+        self.e2  = 1-(self.semi_minor**2)/(self.semi_major**2)
+        self.ep2 = (self.semi_major**2)/(self.semi_minor**2)-1
+        self.n  = (
+            (self.semi_major-self.semi_minor)
+            /(self.semi_major+self.semi_minor)
+            )
+
+        # The remaining lines give the offset of each grid square
+        self.squares = {}
+        for line in db[1:]:
+            letters = line[0].strip().lower()
+            if len(letters) == 2 and letters.isalpha():
+                self.squares[letters] = (
+                    int(line[2])*1000,
+                    int(line[1])*1000
+                    )
+
+    def __repr__(self):
+        return "Datum("+repr(self.name)+")"
+
+# Every datum loaded so far, by name
+_datums = {}
+
+def get_datum(datum):
+    '''Return the Datum with the given name, reading its file only once
+
+    Parameters:
+    datum              The name of the datum, or a Datum
+    '''
+    if isinstance(datum, Datum):
+        return datum
+    if datum not in _datums:
+        _datums[datum] = Datum(datum)
+    return _datums[datum]
+
 
 def grid_ref_to_northing_easting(coord, datum):
     '''Convert a Grid Reference into a Northing and Easting, and return as a string
 
     Parameters:
-    coord              The Grid Reference
-    datum              The datum from which to convert
+    coord              The Grid Reference, in lower case without spaces
+    datum              The datum from which to convert, by name or Datum
     '''
-    # Access data from database
-    with open(datum, "r") as file:
-        db = [line.split(",") for line in file.readlines()]
-        for line in db:
-            if line[0] == coord[:2]:
-                # Offset the values
-                northing = int(line[1])*1000
-                easting  = int(line[2])*1000
-
-    # Number component of the Grid Reference
-    grid_ref = coord[2:]
+    easting, northing = _grid_ref_offsets(coord, get_datum(datum))
+    return str(easting)+","+str(northing)
+
+def _grid_ref_offsets(coord, datum):
+    '''Return the Easting and Northing of a Grid Reference as numbers
+
+    Parameters:
+    coord              The Grid Reference, in lower case without spaces
+    datum              The Datum holding the grid squares
+    '''
+    # Offset of the corner of the grid square
+    try:
+        easting, northing = datum.squares[coord[:2]]
+    except KeyError:
+        raise ValueError(
+            "Unknown grid square "+repr(coord[:2])+" in datum "+datum.name
+            ) from None
+
+    # Number component of the Grid Reference, split into two equal halves
+    digits = coord[2:]
+    half, odd = divmod(len(digits), 2)
+    if odd or half == 0 or half > 5 or not digits.isdigit():
+        raise ValueError("Badly formed Grid Reference "+repr(coord))
+    scale = 10**(5-half)
 
     # Calculate the east and north postion of the point
-    easting  += int(grid_ref[:int(len(grid_ref)/2)])*10**(5-int(len(grid_ref)/2))
-    northing += int(grid_ref[int(len(grid_ref)/2):])*10**(5-int(len(grid_ref)/2))
+    easting  += int(digits[:half])*scale
+    northing += int(digits[half:])*scale
 
-    return str(easting)+","+str(northing)
+    return easting, northing
 
 def cartesian_shift(x, y, z, datum):
     '''Transform Cartesian coordinates to standard datum and return as list
@@ -36,21 +157,13 @@ def cartesian_shift(x, y, z, datum):
     x                  Intial X coordinate
     y                  Intial Y coordinate
     z                  Intial Z coordinate
-    datum              The datum from which to convert
+    datum              The datum from which to convert, by name or Datum
     '''
 
-    # Access data from database
-    with open(datum+".txt", "r") as file:
-        datum_data = [line.split(",") for line in file.readlines()][0]
-
-    # Load and configure database data
-    dx = float(datum_data[7])
-    dy = float(datum_data[8])
-    dz = float(datum_data[9])
-    ds = float(datum_data[10])*10**-6
-    rx = float(datum_data[11])*math.pi/(180*3600)
-    ry = float(datum_data[12])*math.pi/(180*3600)
-    rz = float(datum_data[13])*math.pi/(180*3600)
+    datum = get_datum(datum)
+    dx, dy, dz = datum.dx, datum.dy, datum.dz
+    ds = datum.ds
+    rx, ry, rz = datum.rx, datum.ry, datum.rz
 
     # Perform cartesian shift based off datum
     fx = dx+(1+ds)*x-rz*y+ry*z
@@ -59,35 +172,41 @@ def cartesian_shift(x, y, z, datum):
 
     return[fx,fy,fz]
 
-def cartesian_to_lat_lon(x, y, z, datum):
+def cartesian_to_lat_lon(x, y, z, datum, method="bowring"):
     '''Convert Cartesian coordinates to Latituide and Longitudie and reutrn as list
 
+    By default Bowring's closed form is used, which is within 0.001 mm of
+    the true latitude for heights between -500 m and 10 km. The iterative
+    method takes a fixed LATITUDE_ITERATIONS steps instead.
+
     Parameters:
     x                  Intial X coordinate
     y                  Intial Y coordinate
     z                  Intial Z coordinate
-    datum              The datum from which to convert
+    datum              The datum from which to convert, by name or Datum
+    method             Either "bowring" or "iterative"
     '''
 
-    # Access data from database
-    with open(datum+".txt", "r") as file:
-            datum_data = [line.split(",") for line in file.readlines()][0]
-
-    # Load and configure database data
-    semi_major = float(datum_data[0])
-    semi_minor = float(datum_data[1])
-    e2 = 1-(semi_minor**2)/(semi_major**2)
+    datum = get_datum(datum)
+    semi_major = datum.semi_major
+    e2 = datum.e2
     p = math.sqrt(x**2+y**2)
 
-    # Set intial values for latituide calculations
-    lat  = math.atan2(z, p*(1-e2))
-    lat1 = 2*math.pi
-
-    # Perform an interative calculation to get an approximate answer
-    while math.fabs(lat-lat1)>= 0.00000000000000001: # Very high level of accuracy
-        lat1 = lat
-        Rn  = semi_major/math.sqrt(1-e2*math.sin(lat)**2)
-        lat = math.atan2(z+e2*Rn*math.sin(lat), p)
+    if method == "bowring":
+        # Bowring's method, using the parametric latitude as the first guess
+        theta = math.atan2(z*semi_major, p*datum.semi_minor)
+        lat = math.atan2(
+            z+datum.ep2*datum.semi_minor*math.sin(theta)**3,
+            p-e2*semi_major*math.cos(theta)**3
+            )
+    elif method == "iterative":
+        # Perform an interative calculation a fixed number of times
+        lat = math.atan2(z, p*(1-e2))
+        for _ in range(LATITUDE_ITERATIONS):
+            Rn  = semi_major/math.sqrt(1-e2*math.sin(lat)**2)
+            lat = math.atan2(z+e2*Rn*math.sin(lat), p)
+    else:
+        raise ValueError("Unknown method "+repr(method))
 
     lon = math.atan2(y,x)
 
@@ -102,7 +221,7 @@ def degrees_min_to_degrees_dec(deg_min):
     # Calculate each componet of the Latitude
     degree_lat = int(deg_min[0:3])
     min_lat = int(deg_min[4:6])
-    (1/math.cos(lat)) = int(deg_min[7:9])
+    sec_lat = int(deg_min[7:9])
 
     # Calculate each componet of the Longitude
     degree_lon = int(deg_min[-11:-8])
@@ -110,7 +229,7 @@ def degrees_min_to_degrees_dec(deg_min):
     sec_lon = int(deg_min[-4:-2 ])
 
     # Combine all componets together
-    degree_lat += min_lat*(1/60)+(1/math.cos(lat))*(1/3600)
+    degree_lat += min_lat*(1/60)+sec_lat*(1/3600)
     degree_lon += min_lon*(1/60)+sec_lon*(1/3600)
 
     lat_lon = str(degree_lat)+","+str(degree_lon)
@@ -125,18 +244,13 @@ def lat_lon_to_cartesian(lat, lon, lat2, datum):
     lat                The Latitude from which to convert
     lon                The Longitude from which to convert 
     lat2               The offset produced by the Latitude
-    datum              The datum from which to convert
+    datum              The datum from which to convert, by name or Datum
     '''
 
-    # Access data from database
-    with open(datum+".txt", "r") as file:
-        datum_data = [line.split(",") for line in file.readlines()][0]
-
-    # Load and configure database data
-    semi_major = float(datum_data[0])
-    semi_minor = float(datum_data[1])
-    SF = float(datum_data[2])
-    e2 = 1 - (semi_minor**2)/(semi_major**2)
+    datum = get_datum(datum)
+    semi_major = datum.semi_major
+    SF = datum.scale_factor
+    e2 = datum.e2
     Rn = semi_major*SF/math.sqrt(1-e2*math.sin(lat2)**2)
     
     # Convert Latitude and Longitude to Cartesian using the datum
@@ -153,31 +267,30 @@ def NE_to_local_lat_lon(easting, northing, datum):
        Parameters:
        easting            The Easting from which to convert
        northing           The Northing from which ton convert
-       datum              The datum from which to convert
+       datum              The datum from which to convert, by name or Datum
        '''
 
-    # Access data from database
-    with open(datum+".txt", "r") as file:
-        datum_data = [line.split(",") for line in file.readlines()][0]
-
-    # Load and configure database data
-    semi_major = float(datum_data[0])
-    semi_minor = float(datum_data[1])
-    SF  = float(datum_data[2])
-    la = math.radians(float(datum_data[3]))
-    lo = math.radians(float(datum_data[4]))
-    north_origin  = float(datum_data[5])
-    east_origin   = float(datum_data[6])
-    e2 = 1-(semi_minor**2)/(semi_major**2)
-    n  = (semi_major-semi_minor)/(semi_major+semi_minor)
+    datum = get_datum(datum)
+    semi_major = datum.semi_major
+    semi_minor = datum.semi_minor
+    SF  = datum.scale_factor
+    la = datum.lat_origin
+    lo = datum.lon_origin
+    north_origin  = datum.north_origin
+    east_origin   = datum.east_origin
+    e2 = datum.e2
+    n  = datum.n
 
     # Intial points
     lat = la
     meridian = 0
 
-    # Perform an interative calculation to get an approximate answer
-    while (northing-north_origin-meridian) >= 0.00000000000000001: # Very high level of accuracy
-        lat = (northing-north_origin-meridian)/(semi_major*SF) + lat
+    # Perform an interative calculation until within MERIDIAN_TOLERANCE
+    for _ in range(MERIDIAN_MAX_ITERATIONS):
+        residual = northing-north_origin-meridian
+        if math.fabs(residual) < MERIDIAN_TOLERANCE:
+            break
+        lat = residual/(semi_major*SF) + lat
         M1  = (1+n+(5/4)*n**2+(5/4)*n**3)*(lat-la)
         M2  = (3*n+3*n**2+(21./8)*n**3)*math.sin(lat-la)*math.cos(lat+la)
         M3  = (
@@ -259,22 +372,26 @@ def northing_easting_to_degrees(no_ea, datum):
 
     Parameters:
     no_ea              The Northing and Easting to be converted
-    datum              The datum from which to convert
+    datum              The datum from which to convert, by name or Datum
     '''
     # Split the input into Easting and Northing
     E, N = no_ea.split(",")
 
     # Pass value to chain of functions to calualte Latitude and Longitude
-    local_ll = NE_to_local_lat_lon(int(E), int(N), datum)
-    local_cart = lat_lon_to_cartesian(
-        local_ll[0], local_ll[1], local_ll[2], datum
-        )
-    global_cart = cartesian_shift(
-        local_cart[0], local_cart[1], local_cart[2], datum
-        )
-    global_ll = cartesian_to_lat_lon(
-        global_cart[0], global_cart[1], global_cart[2], "WGS84"
-        )
+    with metrics.timer("standardise_stage", stage="local_lat_lon"):
+        local_ll = NE_to_local_lat_lon(int(E), int(N), datum)
+    with metrics.timer("standardise_stage", stage="to_cartesian"):
+        local_cart = lat_lon_to_cartesian(
+            local_ll[0], local_ll[1], local_ll[2], datum
+            )
+    with metrics.timer("standardise_stage", stage="shift"):
+        global_cart = cartesian_shift(
+            local_cart[0], local_cart[1], local_cart[2], datum
+            )
+    with metrics.timer("standardise_stage", stage="to_lat_lon"):
+        global_ll = cartesian_to_lat_lon(
+            global_cart[0], global_cart[1], global_cart[2], "WGS84"
+            )
     string = str(global_ll[0])+","+str(global_ll[1])
     return string
 
@@ -284,7 +401,197 @@ def map_ref_convert(grid_ref, datum):
 
     Parameters:
     grid_ref           The Grid Reference from which to convert
-    datum              The datum from which to convert
+    datum              The datum from which to convert, by name or Datum
     '''
-    no_ea = grid_ref_to_northing_easting(grid_ref.lower().replace(" ", ""), datum+".txt")
+    no_ea = grid_ref_to_northing_easting(
+        grid_ref.lower().replace(" ", ""), datum
+        )
     return northing_easting_to_degrees(no_ea, datum)
+
+
+########## Batch conversions
+# These take NumPy arrays and convert every point at once, following the
+# same chain of steps as the single point functions above
+
+
+def NE_to_local_lat_lon_batch(eastings, northings, datum):
+    '''Convert arrays of Northing and Easting to local Latitude and Longitude
+       and return a list of arrays with both and the required offset
+
+       Parameters:
+       eastings           Array of Eastings from which to convert
+       northings          Array of Northings from which to convert
+       datum              The datum from which to convert, by name or Datum
+       '''
+    datum = get_datum(datum)
+    semi_major = datum.semi_major
+    semi_minor = datum.semi_minor
+    SF = datum.scale_factor
+    la = datum.lat_origin
+    lo = datum.lon_origin
+    e2 = datum.e2
+    n  = datum.n
+
+    eastings  = np.asarray(eastings, dtype=float)
+    northings = np.asarray(northings, dtype=float)
+
+    # Intial points
+    lat = np.full(northings.shape, la)
+    meridian = np.zeros(northings.shape)
+
+    # Perform an interative calculation until every point has converged
+    for _ in range(MERIDIAN_MAX_ITERATIONS):
+        residual = northings-datum.north_origin-meridian
+        if np.all(np.abs(residual) < MERIDIAN_TOLERANCE):
+            break
+        lat = residual/(semi_major*SF)+lat
+        M1 = (1+n+(5/4)*n**2+(5/4)*n**3)*(lat-la)
+        M2 = (3*n+3*n**2+(21./8)*n**3)*np.sin(lat-la)*np.cos(lat+la)
+        M3 = ((15/8)*n**2+(15/8)*n**3)*np.sin(2*(lat-la))*np.cos(2*(lat+la))
+        M4 = (35/24)*n**3*np.sin(3*(lat-la))*np.cos(3*(lat+la))
+        meridian = semi_minor*SF*(M1-M2+M3-M4)
+
+    # Calculate location values
+    sin2 = np.sin(lat)**2
+    tan2 = np.tan(lat)**2
+    sec  = 1/np.cos(lat)
+    Rn   = semi_major*SF/np.sqrt(1-e2*sin2)
+    Rm   = semi_major*SF*(1-e2)*(1-e2*sin2)**(-1.5)
+    eta2 = Rn/Rm-1
+
+    # Calculate intermedate values
+    interm_1 = np.tan(lat)/(2*Rm*Rn)
+    interm_2 = np.tan(lat)/(24*Rm*Rn**3)*(5+3*tan2+eta2-9*tan2*eta2)
+    interm_3 = np.tan(lat)/(720*Rm*Rn**5)*(61+90*tan2+45*tan2**2)
+    interm_4 = sec/Rn
+    interm_5 = sec/(6*Rn**3)*(Rn/Rm+2*tan2)
+    interm_6 = sec/(120*Rn**5)*(5+28*tan2+24*tan2**2)
+    interm_7 = sec/(5040*Rn**7)*(61+662*tan2+1320*tan2**2+720*tan2**3)
+
+    # Change in easting
+    deltaE = eastings-datum.east_origin
+
+    # The local Latitude and Longitude
+    local_lat = lat-interm_1*deltaE**2+interm_2*deltaE**4-interm_3*deltaE**6
+    local_lon = (
+        lo
+        +interm_4*deltaE
+        -interm_5*deltaE**3
+        +interm_6*deltaE**5
+        -interm_7*deltaE**7
+        )
+
+    return [local_lat, local_lon, lat]
+
+def lat_lon_to_cartesian_batch(lat, lon, lat2, datum):
+    '''Convert arrays of Latitude and Longitude to Cartesian and return a list
+
+    Parameters:
+    lat                Array of Latitudes from which to convert
+    lon                Array of Longitudes from which to convert
+    lat2               Array of offsets produced by the Latitudes
+    datum              The datum from which to convert, by name or Datum
+    '''
+    datum = get_datum(datum)
+    e2 = datum.e2
+
+    # The scale factor cancels out, leaving the prime vertical radius
+    Rn = datum.semi_major/np.sqrt(1-e2*np.sin(lat2)**2)
+
+    # Convert Latitude and Longitude to Cartesian using the datum
+    x = Rn*np.cos(lat)*np.cos(lon)
+    y = Rn*np.cos(lat)*np.sin(lon)
+    z = (1-e2)*Rn*np.sin(lat)
+
+    return [x, y, z]
+
+def cartesian_shift_batch(x, y, z, datum):
+    '''Transform arrays of Cartesian coordinates to standard datum
+
+    Parameters:
+    x                  Array of intial X coordinates
+    y                  Array of intial Y coordinates
+    z                  Array of intial Z coordinates
+    datum              The datum from which to convert, by name or Datum
+    '''
+    datum = get_datum(datum)
+    scale = 1+datum.ds
+
+    # Perform cartesian shift based off datum
+    fx = datum.dx+scale*x-datum.rz*y+datum.ry*z
+    fy = datum.dy+scale*y+datum.rz*x-datum.rx*z
+    fz = datum.dz+scale*z-datum.ry*x+datum.rx*y
+
+    return [fx, fy, fz]
+
+def cartesian_to_lat_lon_batch(x, y, z, datum, method="bowring"):
+    '''Convert arrays of Cartesian coordinates to Latitude and Longitude in
+    degrees and return as a list, using the same methods as
+    cartesian_to_lat_lon
+
+    Parameters:
+    x                  Array of intial X coordinates
+    y                  Array of intial Y coordinates
+    z                  Array of intial Z coordinates
+    datum              The datum from which to convert, by name or Datum
+    method             Either "bowring" or "iterative"
+    '''
+    datum = get_datum(datum)
+    semi_major = datum.semi_major
+    e2 = datum.e2
+    p = np.hypot(x, y)
+
+    if method == "bowring":
+        theta = np.arctan2(z*semi_major, p*datum.semi_minor)
+        lat = np.arctan2(
+            z+datum.ep2*datum.semi_minor*np.sin(theta)**3,
+            p-e2*semi_major*np.cos(theta)**3
+            )
+    elif method == "iterative":
+        lat = np.arctan2(z, p*(1-e2))
+        for _ in range(LATITUDE_ITERATIONS):
+            Rn  = semi_major/np.sqrt(1-e2*np.sin(lat)**2)
+            lat = np.arctan2(z+e2*Rn*np.sin(lat), p)
+    else:
+        raise ValueError("Unknown method "+repr(method))
+
+    lon = np.arctan2(y, x)
+
+    return [np.degrees(lat), np.degrees(lon)]
+
+def northing_easting_to_degrees_batch(eastings, northings, datum):
+    '''Convert arrays of Eastings and Northings to Degrees and return
+    arrays of Latitude and Longitude
+
+    Parameters:
+    eastings           Array of Eastings to be converted
+    northings          Array of Northings to be converted
+    datum              The datum from which to convert, by name or Datum
+    '''
+    # Pass the arrays along the same chain as northing_easting_to_degrees
+    with metrics.timer("standardise_stage", stage="local_lat_lon", batch=True):
+        local_ll = NE_to_local_lat_lon_batch(eastings, northings, datum)
+    with metrics.timer("standardise_stage", stage="to_cartesian", batch=True):
+        local_cart = lat_lon_to_cartesian_batch(*local_ll, datum)
+    with metrics.timer("standardise_stage", stage="shift", batch=True):
+        global_cart = cartesian_shift_batch(*local_cart, datum)
+    with metrics.timer("standardise_stage", stage="to_lat_lon", batch=True):
+        return cartesian_to_lat_lon_batch(*global_cart, "WGS84")
+
+def map_ref_convert_batch(grid_refs, datum):
+    '''Convert Grid References to Degrees and return arrays of Latitude and
+    Longitude
+
+    Parameters:
+    grid_refs          The Grid References from which to convert
+    datum              The datum from which to convert, by name or Datum
+    '''
+    datum = get_datum(datum)
+    eastings  = np.empty(len(grid_refs))
+    northings = np.empty(len(grid_refs))
+    for index, grid_ref in enumerate(grid_refs):
+        eastings[index], northings[index] = _grid_ref_offsets(
+            str(grid_ref).lower().replace(" ", ""), datum
+            )
+
+    return northing_easting_to_degrees_batch(eastings, northings, datum)
@@ -0,0 +1,105 @@
+'''Tests for the caches which keep results from Google Maps between runs
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import pytest
+
+import cache
+
+
+class Clock:
+    '''A stand-in for time.time which only moves when told to
+
+    '''
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+def geocode_cache(tmp_path, **options):
+    return cache.GeocodeCache(str(tmp_path/"geocode.db"), **options)
+
+
+def test_lookups_ignore_case_and_spacing(tmp_path, clock):
+    geocodes = geocode_cache(tmp_path)
+    geocodes.put("Big Ben", 51.5007, -0.1246)
+    assert geocodes.get("  big   BEN ") == (51.5007, -0.1246)
+    assert geocodes.get("Kew Gardens") is None
+    assert geocodes.stats()["hits"] == 1
+    assert geocodes.stats()["misses"] == 1
+
+def test_least_recently_used_entry_is_removed(tmp_path, clock):
+    geocodes = geocode_cache(tmp_path, max_entries=3)
+    for index, place in enumerate(["depot", "a", "b"]):
+        clock.now += 1
+        geocodes.put(place, index, index)
+
+    # Lookups answered from memory still count as uses in the file
+    for _ in range(20):
+        clock.now += 1
+        assert geocodes.get("depot") == (0, 0)
+    for place in ["c", "d", "e"]:
+        clock.now += 1
+        geocodes.put(place, 0, 0)
+        assert geocodes.get("depot") == (0, 0)
+
+    assert geocodes.stats()["entries"] == 3
+    assert geocodes.get("a") is None
+    assert geocodes.get("b") is None
+
+    # A new process reading the same file sees the same entries
+    other = geocode_cache(tmp_path, max_entries=3)
+    assert other.get("depot") == (0, 0)
+    assert other.get("c") is None
+
+def test_memory_hits_are_written_back_in_time(tmp_path, clock):
+    geocodes = geocode_cache(tmp_path, write_interval=10)
+    geocodes.put("depot", 1, 2)
+    clock.now += 5
+    geocodes.get("depot")
+    connection = geocodes._connect()
+
+    def accessed():
+        return connection.execute(
+            "SELECT accessed FROM geocode WHERE key = 'depot'"
+            ).fetchone()[0]
+
+    assert accessed() == 1000.0
+    clock.now += 6
+    geocodes.get("depot")
+    assert accessed() == 1011.0
+
+def test_entries_expire_after_the_time_to_live(tmp_path, clock):
+    geocodes = geocode_cache(tmp_path, ttl=60)
+    geocodes.put("depot", 1, 2)
+    clock.now += 60
+    assert geocodes.get("depot") == (1, 2)
+    clock.now += 1
+    assert geocodes.get("depot") is None
+    assert geocodes.stats()["entries"] == 0
+
+    # Expiry is from when the entry was stored, not when it was last used
+    other = geocode_cache(tmp_path, ttl=60)
+    other.put("depot", 1, 2)
+    clock.now += 40
+    assert other.get("depot") == (1, 2)
+    clock.now += 40
+    assert other.get("depot") is None
+
+def test_travel_times_expire_after_the_time_to_live(tmp_path, clock):
+    matrices = cache.MatrixCache(str(tmp_path/"matrix.db"), ttl=60)
+    matrices.put("walking", ["a", "b"], ["a", "b"], [[0, 5], [6, 0]])
+    assert matrices.get("walking", ["a"], ["b"]) == {"a": {"b": 5.0}}
+    assert matrices.get("driving", ["a"], ["b"]) == {}
+    clock.now += 61
+    assert matrices.get("walking", ["a", "b"], ["a", "b"]) == {}
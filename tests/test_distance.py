@@ -0,0 +1,94 @@
+'''Tests for the store of travel times shared between searches
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import threading
+from time import monotonic, sleep
+
+import distance
+
+
+class SlowFetch:
+    '''Estimate travel times after a pause, counting the elements asked for
+
+    '''
+    def __init__(self, pause=0.3, error=None):
+        self.pause = pause
+        self.error = error
+        self.elements = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, origins, destinations, mode):
+        with self._lock:
+            self.elements += len(origins)*len(destinations)
+        sleep(self.pause)
+        if self.error is not None:
+            raise self.error
+        return distance.estimate_fetch(origins, destinations, mode)
+
+
+def places(count, offset=0):
+    return [str(51+0.01*(index+offset))+",-0.1" for index in range(count)]
+
+def run_at_once(store, jobs):
+    results = [None]*len(jobs)
+    errors = [None]*len(jobs)
+
+    def run(index):
+        try:
+            results[index] = store.matrix(jobs[index], "walking")
+        except Exception as error:
+            errors[index] = error
+
+    threads = [
+        threading.Thread(target=run, args=(index,))
+        for index in range(len(jobs))
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_fetches_for_different_searches_overlap():
+    fetch = SlowFetch()
+    store = distance.DistanceMatrixStore(fetch)
+    jobs = [places(5, 10*job) for job in range(4)]
+    start = monotonic()
+    results, errors = run_at_once(store, jobs)
+    assert monotonic()-start < 2*fetch.pause
+    assert errors == [None]*4
+    for job, result in zip(jobs, results):
+        assert result == distance.estimate_fetch(job, job, "walking").tolist()
+
+def test_travel_times_are_fetched_once():
+    fetch = SlowFetch()
+    store = distance.DistanceMatrixStore(fetch)
+    results, errors = run_at_once(store, [places(6)]*4)
+    assert errors == [None]*4
+    assert fetch.elements == 36
+    assert all(result == results[0] for result in results)
+
+def test_waiting_searches_see_the_failure():
+    fetch = SlowFetch(error=distance.MatrixFetchError("unreachable"))
+    store = distance.DistanceMatrixStore(fetch)
+    results, errors = run_at_once(store, [places(4)]*3)
+    assert all(isinstance(error, distance.MatrixFetchError)
+               for error in errors)
+
+    # Nothing is left waiting, so a later search fetches again
+    fetch.error = None
+    assert len(store.matrix(places(4), "walking")) == 4
+
+def test_only_new_travel_times_are_fetched():
+    fetch = SlowFetch(pause=0)
+    store = distance.DistanceMatrixStore(fetch)
+    store.matrix(places(4), "walking")
+    store.matrix(places(5), "walking")
+    assert fetch.elements == 16+9
+    store.discard(places(5)[0])
+    store.matrix(places(5), "walking")
+    assert fetch.elements == 16+9+9
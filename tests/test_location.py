@@ -0,0 +1,57 @@
+'''Tests for turning what a user types into Locations
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import pytest
+
+import location
+import standardise
+
+ROWS = ["051.5°,000.1°", "TQ 300 800", "530000,180000",
+        "051°30'00''+000°07'00''"]
+
+
+@pytest.fixture
+def no_datums(tmp_path, monkeypatch):
+    # Without datum files no Grid Reference or Easting can be converted
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(standardise, "_datums", {})
+
+def import_all(rows, **options):
+    errors = []
+    locations = list(location.import_locations(
+        rows, on_error=lambda user_input, error: errors.append(
+            (user_input, type(error))
+            ),
+        **options
+        ))
+    return locations, errors
+
+
+def test_rows_which_cannot_be_converted_are_reported(no_datums):
+    locations, errors = import_all(ROWS)
+    assert [l.user_input for l in locations] == [ROWS[0], ROWS[3]]
+    assert errors == [(ROWS[1], FileNotFoundError),
+                      (ROWS[2], FileNotFoundError)]
+
+def test_a_bad_row_fails_alone(monkeypatch):
+    convert = standardise.degrees_min_to_degrees_dec
+
+    def fussy(deg_min):
+        if deg_min.startswith("051"):
+            raise ValueError("not today")
+        return convert(deg_min)
+
+    monkeypatch.setattr(standardise, "degrees_min_to_degrees_dec", fussy)
+    rows = ["051°30'00''+000°07'00''", "052°00'00''+001°00'00''",
+            "051.5°,000.1°"]
+    locations, errors = import_all(rows, batch_size=2)
+    assert [l.user_input for l in locations] == rows[1:]
+    assert [(l.lat, l.lon) for l in locations] == [(52.0, 1.0), (51.5, 0.1)]
+    assert errors == [(rows[0], ValueError)]
+
+def test_errors_are_raised_without_on_error(no_datums):
+    with pytest.raises(OSError):
+        list(location.import_locations(ROWS))
@@ -0,0 +1,109 @@
+'''Tests which plan routes against the stand-in for Google Maps
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import asyncio
+import io
+import json
+
+import numpy as np
+import pytest
+
+import cache
+import distance
+import location
+import maps_stub
+import planner
+import service
+
+PLACES = {
+    "Buckingham Palace": (51.5014, -0.1419),
+    "Tower of London": (51.5081, -0.0759),
+    }
+JOB = {
+    "id": "van 1",
+    "stops": ["Buckingham Palace", "Tower of London", [51.5194, -0.1270],
+              [51.5033, -0.1195], "Somewhere Unlisted"],
+    "mode": "walking",
+    "time_budget": 1,
+    }
+
+
+@pytest.fixture
+def server():
+    server = maps_stub.StubServer(places=PLACES).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def maps(server, tmp_path, monkeypatch):
+    # Geocode through the stand-in into a cache of this test's own
+    monkeypatch.setattr(location, "maps_url", server.url)
+    monkeypatch.setattr(location, "geocode_cache",
+                        cache.GeocodeCache(str(tmp_path/"geocode.db")))
+    return server
+
+
+def check_result(result):
+    assert "error" not in result
+    assert not result["estimated"]
+    assert len(result["route"]) == len(JOB["stops"])
+    coordinates = dict(zip(result["route"], result["coordinates"]))
+    lat, lon = coordinates["Somewhere Unlisted"]
+    assert abs(lat-maps_stub.CENTRE[0]) <= maps_stub.SPREAD
+    assert abs(lon-maps_stub.CENTRE[1]) <= maps_stub.SPREAD
+    for place, lat_lon in PLACES.items():
+        assert tuple(coordinates[place]) == pytest.approx(lat_lon)
+    assert result["cost"] > 0
+
+
+def test_stub_refuses_requests_over_the_limits(server):
+    places = ["51.5,-0.1"]*11
+    reply = server.distance_matrix({
+        "origins": "|".join(places), "destinations": "|".join(places)
+        })
+    assert reply["status"] == "MAX_ELEMENTS_EXCEEDED"
+
+def test_fetcher_matches_the_stub_estimates(server):
+    fetch = distance.ChunkedFetcher(distance.http_request(server.url))
+    places = [str(51.5+0.01*index)+",-0.1" for index in range(12)]
+    durations = fetch(places, places, "walking")
+    expected = distance.estimate_fetch(places, places, "walking")
+    assert np.array_equal(durations, np.round(expected))
+    assert server.elements == 144
+    assert server.requests["distancematrix"] == len(
+        fetch.blocks(places, places)
+        )
+
+def test_geocode_uses_the_maps_url(maps):
+    assert location.geocode("Tower of London") == PLACES["Tower of London"]
+    assert location.geocode("tower of  london") == PLACES["Tower of London"]
+    assert maps.requests["geocode"] == 1
+
+def test_planner_runs_jobs_against_the_stub(maps, tmp_path):
+    output = io.StringIO()
+    failures = planner.run(
+        [JOB], output, workers=1,
+        geocode_path=str(tmp_path/"geocode.db"),
+        matrix_path=str(tmp_path/"matrix.db"), maps_url=maps.url
+        )
+    assert failures == 0
+    result = json.loads(output.getvalue())
+    assert result["id"] == "van 1"
+    check_result(result)
+    assert maps.requests["geocode"] == 3
+    assert maps.elements == len(JOB["stops"])**2
+
+def test_service_plans_against_the_stub(maps, tmp_path):
+    planning = service.PlanningService(
+        planner.make_store(str(tmp_path/"matrix.db"), maps_url=maps.url),
+        workers=1
+        )
+    try:
+        result = asyncio.run(planning.plan(JOB))
+    finally:
+        planning.close()
+    check_result(result)
+    assert maps.elements == len(JOB["stops"])**2
@@ -0,0 +1,116 @@
+'''Tests for the timers and counters and the formats they are exported in
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import json
+import re
+
+import pytest
+
+import metrics
+
+# A sample line of the Prometheus text format
+SAMPLE_RE = re.compile(
+    r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{([a-zA-Z_]\w*="([^"\\]|\\.)*",?)*\})? '
+    r'(\S+)$'
+    )
+
+
+@pytest.fixture
+def kept():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.disable()
+    metrics.reset()
+
+def families(text):
+    '''Return the type and samples of each family in Prometheus text,
+    failing if a sample is not under its own family's TYPE line
+
+    Parameters:
+    text               The text to parse
+    '''
+    found = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split()
+            assert name not in found, "family typed twice: "+name
+            current = name
+            found[name] = (kind, [])
+            continue
+        match = SAMPLE_RE.match(line)
+        assert match, "not a sample: "+line
+        name = match.group(1)
+        kind, samples = found[current]
+        if kind == "summary":
+            assert name in (current+"_count", current+"_sum"), line
+        else:
+            assert name == current, line
+        float(match.group(5))
+        samples.append(line)
+    return found
+
+
+def test_nothing_is_kept_until_enabled():
+    metrics.reset()
+    metrics.count("jobs")
+    with metrics.timer("search"):
+        pass
+    assert metrics.snapshot() == {"counters": [], "timers": []}
+
+def test_counters_and_timers_are_kept(kept):
+    metrics.count("jobs")
+    metrics.count("jobs", 2)
+    metrics.count("jobs", mode="walking")
+    metrics.observe("search", 1.5)
+    metrics.observe("search", 0.5)
+    snapshot = json.loads(metrics.to_json())
+    assert snapshot["counters"] == [
+        {"name": "jobs", "labels": {}, "value": 3},
+        {"name": "jobs", "labels": {"mode": "walking"}, "value": 1},
+        ]
+    assert snapshot["timers"] == [{
+        "name": "search", "labels": {}, "count": 2, "seconds": 2.0,
+        "min": 0.5, "max": 1.5,
+        }]
+
+def test_taken_metrics_merge_back(kept):
+    metrics.count("jobs")
+    metrics.observe("search", 2.0, algorithm="held_karp")
+    taken = metrics.take()
+    assert metrics.snapshot() == {"counters": [], "timers": []}
+    metrics.observe("search", 1.0, algorithm="held_karp")
+    metrics.merge(taken)
+    metrics.merge(taken)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"][0]["value"] == 2
+    timer = snapshot["timers"][0]
+    assert (timer["count"], timer["seconds"]) == (3, 5.0)
+    assert (timer["min"], timer["max"]) == (1.0, 2.0)
+
+def test_prometheus_families_are_grouped(kept):
+    for algorithm in ("held_karp", "branch_and_bound", "decompose"):
+        metrics.observe("search", 1.0, algorithm=algorithm)
+        metrics.observe("search", 3.0, algorithm=algorithm)
+    metrics.observe("matrix_fetch", 0.25, mode='say "hi"\\')
+    metrics.count("search_moves", 7)
+    metrics.count("geocode_cache", result="hit")
+    metrics.count("geocode_cache", result="miss")
+
+    found = families(metrics.to_prometheus())
+    search = metrics.PREFIX+"search_seconds"
+    assert found[search][0] == "summary"
+    assert len(found[search][1]) == 6
+    assert found[search+"_max"][0] == "gauge"
+    assert (search+'_max{algorithm="decompose"} 3.0'
+            in found[search+"_max"][1])
+    assert found[metrics.PREFIX+"geocode_cache_total"] == ("counter", [
+        metrics.PREFIX+'geocode_cache_total{result="hit"} 1.0',
+        metrics.PREFIX+'geocode_cache_total{result="miss"} 1.0',
+        ])
+    longest = metrics.PREFIX+"matrix_fetch_seconds_max"
+    assert longest+'{mode="say \\"hi\\"\\\\"} 0.25' in found[longest][1]
@@ -0,0 +1,78 @@
+'''Tests for planning jobs with the travel times fetched or estimated
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import numpy as np
+import pytest
+
+import distance
+import location
+import planner
+
+STOPS = [[51.5014, -0.1419], [51.5081, -0.0759], [51.5194, -0.1270],
+         [51.5033, -0.1195], [51.4994, -0.1273]]
+
+
+def test_offline_store_keeps_no_cache(tmp_path):
+    matrix_path = tmp_path/"matrix.db"
+    store = planner.make_store(str(matrix_path), offline=True)
+    assert store.cache is None
+    assert store.estimated
+
+    locations, failed = planner.stop_locations(STOPS)
+    _, (cost, route, details) = planner.plan(
+        locations, "walking", store, time_budget=1, workers=1
+        )
+    assert details["estimated"]
+    assert not matrix_path.exists()
+
+def test_fetched_travel_times_are_not_estimated():
+    store = distance.DistanceMatrixStore(distance.estimate_fetch)
+    places = [str(lat)+","+str(lon) for lat, lon in STOPS]
+    matrix, estimated = planner.travel_times(store, places, "walking")
+    assert not estimated
+    assert len(matrix) == len(STOPS)
+
+@pytest.mark.parametrize("error", [
+    ModuleNotFoundError("No module named 'key'"),
+    ValueError("Invalid API key provided."),
+    ])
+def test_client_errors_fall_back_to_estimates(error):
+    def request(origins, destinations, mode):
+        raise error
+
+    store = distance.DistanceMatrixStore(
+        distance.ChunkedFetcher(request, retries=0)
+        )
+    locations, failed = planner.stop_locations(STOPS)
+    _, (cost, route, details) = planner.plan(
+        locations, "walking", store, time_budget=1, workers=1
+        )
+    assert details["estimated"]
+    assert sorted(route) == list(range(len(STOPS)))
+
+def test_estimates_are_made_from_the_stored_coordinates():
+    locations, failed = planner.stop_locations(STOPS)
+    assert isinstance(locations, location.LocationStore)
+    places = [l.location for l in locations]
+    store = distance.DistanceMatrixStore(estimated=True)
+    matrix, estimated = planner.travel_times(
+        store, places, "walking", coordinates=locations.coordinates
+        )
+    assert estimated
+    assert np.allclose(matrix, store.estimate(places, "walking"))
+
+def test_clusters_are_planned_from_the_stored_coordinates(monkeypatch):
+    monkeypatch.setattr(planner, "DECOMPOSE_SIZE", 10)
+    rng = np.random.default_rng(0)
+    stops = (rng.uniform(-0.05, 0.05, (40, 2))+[51.5, -0.12]).tolist()
+    locations, failed = planner.stop_locations(stops)
+    distance_matrix, (cost, route, details) = planner.plan(
+        locations, "walking", planner.make_store(offline=True),
+        time_budget=2, workers=1
+        )
+    assert distance_matrix is None
+    assert details["estimated"]
+    assert sorted(route) == list(range(len(stops)))
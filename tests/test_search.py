@@ -0,0 +1,208 @@
+'''Regression tests for the search algorithms
+
+Each test runs on small seeded matrices, so failures can be repeated. Run
+from the top folder with:
+
+python -m pytest tests
+'''
+import threading
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+import search
+
+SEEDS = range(20)
+
+
+def integer_matrix(size, seed, symmetric=True):
+    '''Return a matrix of whole seconds, as Google Maps gives, where ties
+    between routes are common
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random travel times
+    symmetric          Whether each direction costs the same
+    '''
+    rng = np.random.default_rng(seed)
+    matrix = rng.integers(1, 60, (size, size))
+    if symmetric:
+        matrix = np.triu(matrix, 1)+np.triu(matrix, 1).T
+    np.fill_diagonal(matrix, 0)
+    return matrix.tolist()
+
+def float_matrix(size, seed, symmetric=True):
+    '''Return a matrix of distances between random points, which has no
+    ties between routes
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    symmetric          Whether each direction costs the same
+    '''
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 1000, (size, 2))
+    matrix = np.sqrt(((points[:, None]-points[None])**2).sum(axis=2))
+    if not symmetric:
+        matrix = matrix*rng.uniform(0.8, 1.5, (size, size))
+        np.fill_diagonal(matrix, 0)
+    return matrix.tolist()
+
+def unreachable_matrix(size, seed, stop=0):
+    '''Return a matrix of distances where one location has no route to or
+    from any other, as Google Maps gives for an island
+
+    Parameters:
+    size               The number of locations
+    seed               The seed for the random points
+    stop               The location which cannot be reached
+    '''
+    matrix = float_matrix(size, seed)
+    for other in range(size):
+        if other != stop:
+            matrix[stop][other] = float("inf")
+            matrix[other][stop] = float("inf")
+    return matrix
+
+def route_cost(matrix, route):
+    return sum(matrix[a][b] for a, b in zip(route, route[1:]))
+
+def original_nearest_neighbour(matrix):
+    '''The nearest neighbour search as it was before it was batched, which
+    the batched search must match exactly
+
+    Parameters:
+    matrix             Distance matrix
+    '''
+    shortest = float("inf")
+    best_route = None
+    for row_index in range(len(matrix)):
+        current_row = row_index
+        temp_matrix = deepcopy(matrix)
+        for row in range(len(temp_matrix)):
+            temp_matrix[row][row] = float("inf")
+        test_time = 0
+        route = [current_row]
+        while len(route) != len(matrix):
+            lowest = min(temp_matrix[current_row])
+            index = temp_matrix[current_row].index(lowest)
+            test_time += lowest
+            route.append(index)
+            for i in range(len(temp_matrix)):
+                temp_matrix[i][current_row] = float("inf")
+                temp_matrix[current_row][i] = float("inf")
+            current_row = index
+        if shortest > test_time:
+            shortest = test_time
+            best_route = route
+    return shortest, best_route
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("symmetric", [True, False])
+def test_nearest_neighbour_matches_original(seed, symmetric):
+    size = 3+seed % 15
+    matrix = integer_matrix(size, seed, symmetric)
+    assert search.nearest_neighbour(matrix) == (
+        original_nearest_neighbour(matrix)
+        )
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_nearest_neighbour_matches_original_on_floats(seed):
+    matrix = float_matrix(4+seed, seed, symmetric=seed % 2 == 0)
+    assert search.nearest_neighbour(matrix) == (
+        original_nearest_neighbour(matrix)
+        )
+
+@pytest.mark.parametrize("seed", range(6))
+def test_parallel_brute_force_matches_brute_force(seed):
+    matrix = integer_matrix(4+seed % 4, seed, symmetric=seed % 2 == 0)
+    assert search.parallel_brute_force(matrix, workers=2) == (
+        search.brute_force(matrix)
+        )
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("symmetric", [True, False])
+def test_held_karp_matches_brute_force(seed, symmetric):
+    matrix = float_matrix(2+seed % 7, seed, symmetric)
+    expected, _ = search.brute_force(matrix)
+    shortest, route = search.held_karp(matrix)
+    assert sorted(route) == list(range(len(matrix)))
+    assert shortest == pytest.approx(expected)
+    assert route_cost(matrix, route) == pytest.approx(expected)
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("symmetric", [True, False])
+def test_branch_and_bound_matches_held_karp(seed, symmetric):
+    matrix = float_matrix(5+seed % 8, seed, symmetric)
+    expected, _ = search.held_karp(matrix)
+    shortest, route, gap = search.branch_and_bound(matrix)
+    assert sorted(route) == list(range(len(matrix)))
+    assert shortest == pytest.approx(expected)
+    assert gap == 0.0
+
+@pytest.mark.parametrize("size", [2, 3, 6])
+def test_held_karp_without_a_finite_route(size):
+    matrix = unreachable_matrix(size, size, stop=size//2)
+    shortest, route = search.held_karp(matrix)
+    assert sorted(route) == list(range(size))
+    assert shortest == float("inf")
+
+@pytest.mark.parametrize("size", [5, 25, 60, 400])
+def test_solve_with_an_unreachable_stop(size):
+    matrix = unreachable_matrix(size, size, stop=size//3)
+    shortest, route, details = search.solve(matrix, time_budget=2)
+    assert sorted(route) == list(range(size))
+    assert shortest == float("inf")
+
+@pytest.mark.parametrize("size", [25, 60])
+def test_unreachable_stop_is_left_to_one_end(size):
+    matrix = unreachable_matrix(size, size, stop=size//3)
+    shortest, route, details = search.solve(matrix, time_budget=2)
+    assert size//3 in (route[0], route[-1])
+
+@pytest.mark.parametrize("size", [12, 25, 60])
+def test_solve_avoids_steps_without_a_route(size):
+    matrix = float_matrix(size, size, symmetric=False)
+    matrix[1][2] = matrix[3][4] = float("inf")
+    shortest, route, details = search.solve(matrix, time_budget=2)
+    assert sorted(route) == list(range(size))
+    assert shortest == pytest.approx(route_cost(matrix, route))
+    assert shortest < float("inf")
+
+def test_nearest_neighbour_visits_every_stop_once():
+    matrix = unreachable_matrix(8, 0, stop=3)
+    shortest, route = search.nearest_neighbour(matrix)
+    assert sorted(route) == list(range(8))
+    assert shortest == float("inf")
+
+@pytest.mark.parametrize("seed", range(4))
+def test_branch_and_bound_with_steps_without_a_route(seed):
+    matrix = float_matrix(9+seed, seed, symmetric=False)
+    matrix[1][2] = matrix[3][4] = float("inf")
+    expected, _ = search.held_karp(matrix)
+    shortest, route, gap = search.branch_and_bound(matrix)
+    assert sorted(route) == list(range(len(matrix)))
+    assert shortest == pytest.approx(expected)
+
+def test_exact_search_shows_a_route_and_can_be_stopped():
+    matrix = float_matrix(16, 0)
+    stop = threading.Event()
+    results = []
+    for cost, route, details in search.anytime(matrix, time_budget=60,
+                                               stop=stop):
+        results.append((cost, route, details))
+        stop.set()
+    assert len(results) == 2
+    first, last = results[0][2], results[1][2]
+    assert first["algorithm"] == "held_karp" and not first["final"]
+    assert last["final"] and last["gap"] is None
+    assert results[1][:2] == results[0][:2]
+
+def test_exact_search_yields_the_greedy_route_first():
+    matrix = float_matrix(12, 1)
+    results = list(search.anytime(matrix, interval=None))
+    assert results[0][:2] == search.nearest_neighbour(matrix)
+    assert results[-1][0] == pytest.approx(search.held_karp(matrix)[0])
+    assert results[-1][2]["gap"] == 0.0
@@ -0,0 +1,62 @@
+'''Tests for the long running planning service
+
+Run from the top folder with:
+
+python -m pytest tests
+'''
+import asyncio
+
+import numpy as np
+import pytest
+
+import planner
+import search
+import service
+
+
+@pytest.fixture
+def planning():
+    planning = service.PlanningService(
+        planner.make_store(offline=True), workers=1, time_budget=2,
+        max_time_budget=3
+        )
+    yield planning
+    planning.close()
+
+def stops(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(-0.05, 0.05, (count, 2))+[51.5, -0.12]).tolist()
+
+
+def test_time_budget_is_limited(planning):
+    assert planning.time_budget_for({}) == 2
+    assert planning.time_budget_for({"time_budget": 1}) == 1
+    assert planning.time_budget_for({"time_budget": 10**9}) == 3
+
+@pytest.mark.parametrize("time_budget", ["5", -1, 0, True, None])
+def test_time_budget_must_be_a_positive_number(planning, time_budget):
+    with pytest.raises(ValueError):
+        planning.time_budget_for({"time_budget": time_budget})
+
+def test_time_budget_reaches_the_search(planning, monkeypatch):
+    budgets = []
+
+    def search_here(distance_matrix, time_budget):
+        budgets.append(time_budget)
+        return search.solve(distance_matrix, time_budget)
+
+    monkeypatch.setattr(planning, "_search", search_here)
+    job = {"stops": stops(6), "time_budget": 600}
+    result = asyncio.run(planning.plan(job))
+    assert budgets == [3]
+    assert result["estimated"]
+    assert len(result["route"]) == 6
+
+def test_large_jobs_are_split_into_clusters(planning, monkeypatch):
+    monkeypatch.setattr(planner, "DECOMPOSE_SIZE", 20)
+    result = asyncio.run(planning.plan({"stops": stops(700), "id": 7}))
+    assert result["id"] == 7
+    assert result["algorithm"] == "decompose"
+    assert sorted(map(tuple, result["coordinates"])) == sorted(
+        map(tuple, stops(700))
+        )
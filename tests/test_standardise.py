@@ -0,0 +1,133 @@
+'''Regression tests for the conversions between grid references, eastings
+and northings, and latitude and longitude
+
+The datum files are written for each test from the published constants of
+the Ordnance Survey, so the tests do not depend on files in the working
+folder. Run from the top folder with:
+
+python -m pytest tests
+'''
+import math
+
+import numpy as np
+import pytest
+
+import standardise
+
+# Airy 1830 ellipsoid, National Grid projection and the Helmert shift to
+# WGS84, followed by the corner of each grid square in kilometres
+AIRY_1830 = """\
+6377563.396,6356256.909,0.9996012717,49,-2,-100000,400000,446.448,-125.157,\
+542.060,-20.4894,0.1502,0.2470,0.8421
+sv,0,0
+su,100,400
+tq,100,500
+tg,300,600
+nz,500,400
+hp,1200,400
+"""
+WGS84 = "6378137.0,6356752.3142\n"
+
+# The worked example of the Ordnance Survey's guide to coordinate systems
+# in Great Britain, with its latitude and longitude on the Airy 1830 datum
+EASTING, NORTHING = 651409.903, 313177.270
+LAT = 52+39/60+27.2531/3600
+LON = 1+43/60+4.5177/3600
+
+GRID_REFS = ["TG 51409 13177", "tq3008", "SU 123 456", "NZ2500067000",
+             "sv 9 9", "HP 61234 12345"]
+
+
+@pytest.fixture(autouse=True)
+def datums(tmp_path, monkeypatch):
+    (tmp_path/"Airy 1830.txt").write_text(AIRY_1830)
+    (tmp_path/"WGS84.txt").write_text(WGS84)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(standardise, "_datums", {})
+
+
+def test_datum_is_read_once():
+    datum = standardise.get_datum("Airy 1830")
+    assert standardise.get_datum("Airy 1830") is datum
+    assert standardise.get_datum(datum) is datum
+    assert datum.squares["tg"] == (600000, 300000)
+    assert datum.e2 == pytest.approx(0.0066705397616)
+
+@pytest.mark.parametrize("grid_ref, expected", [
+    ("tg5140913177", "651409,313177"),
+    ("tq3008", "530000,108000"),
+    ("su123456", "412300,145600"),
+    ("sv99", "90000,90000"),
+    ("hp6123412345", "461234,1212345"),
+    ])
+def test_grid_ref_to_northing_easting(grid_ref, expected):
+    assert standardise.grid_ref_to_northing_easting(
+        grid_ref, "Airy 1830"
+        ) == expected
+
+def test_published_easting_and_northing():
+    lat, lon, _ = standardise.NE_to_local_lat_lon(
+        EASTING, NORTHING, "Airy 1830"
+        )
+    assert math.degrees(lat) == pytest.approx(LAT, abs=1e-7)
+    assert math.degrees(lon) == pytest.approx(LON, abs=1e-7)
+
+def test_published_point_on_wgs84():
+    # The Helmert shift is good to a few metres, about 0.00005 degrees
+    lat, lon = map(float, standardise.map_ref_convert(
+        "TG 51409 13177", "Airy 1830"
+        ).split(","))
+    assert lat == pytest.approx(52.657976, abs=5e-5)
+    assert lon == pytest.approx(1.716038, abs=5e-5)
+
+def test_latitude_methods_agree():
+    lat, lon, lat2 = standardise.NE_to_local_lat_lon(
+        EASTING, NORTHING, "Airy 1830"
+        )
+    x, y, z = standardise.lat_lon_to_cartesian(lat, lon, lat2, "Airy 1830")
+    bowring = standardise.cartesian_to_lat_lon(x, y, z, "Airy 1830")
+    iterative = standardise.cartesian_to_lat_lon(
+        x, y, z, "Airy 1830", "iterative"
+        )
+    assert bowring == pytest.approx(iterative, abs=1e-9)
+
+    # The Cartesian step takes its radius of curvature at the footpoint
+    # latitude, which moves the point by a few centimetres
+    assert bowring == pytest.approx([LAT, LON], abs=1e-6)
+
+def test_unknown_latitude_method():
+    with pytest.raises(ValueError):
+        standardise.cartesian_to_lat_lon(1.0, 1.0, 1.0, "WGS84", "guess")
+
+def test_batch_conversion_matches_single_points():
+    lats, lons = standardise.map_ref_convert_batch(GRID_REFS, "Airy 1830")
+    for grid_ref, lat, lon in zip(GRID_REFS, lats, lons):
+        single = standardise.map_ref_convert(grid_ref, "Airy 1830")
+        expected = [float(value) for value in single.split(",")]
+        assert [lat, lon] == pytest.approx(expected, abs=1e-9)
+
+def test_batch_eastings_and_northings_match_single_points():
+    eastings = np.array([651409, 530000, 412300, 90000])
+    northings = np.array([313177, 180000, 145600, 90000])
+    lats, lons = standardise.northing_easting_to_degrees_batch(
+        eastings, northings, "Airy 1830"
+        )
+    for easting, northing, lat, lon in zip(eastings, northings, lats, lons):
+        single = standardise.northing_easting_to_degrees(
+            str(easting)+","+str(northing), "Airy 1830"
+            )
+        expected = [float(value) for value in single.split(",")]
+        assert [lat, lon] == pytest.approx(expected, abs=1e-9)
+
+@pytest.mark.parametrize("grid_ref", ["zz1234", "xy12345678"])
+def test_unknown_grid_square(grid_ref):
+    with pytest.raises(ValueError, match="Unknown grid square"):
+        standardise.map_ref_convert(grid_ref, "Airy 1830")
+    with pytest.raises(ValueError, match="Unknown grid square"):
+        standardise.map_ref_convert_batch([grid_ref], "Airy 1830")
+
+@pytest.mark.parametrize("grid_ref", ["tq", "tq123", "tq12a4",
+                                      "tq123456789012"])
+def test_badly_formed_grid_ref(grid_ref):
+    with pytest.raises(ValueError, match="Badly formed"):
+        standardise.grid_ref_to_northing_easting(grid_ref, "Airy 1830")
@@ -0,0 +1,318 @@
+'''Fetching, caching and drawing of map tiles
+
+The map is made from square tiles on the usual Web Mercator grid, so a tile
+is named by its zoom level, column, row and map type. Tiles are kept in
+memory and on disk, so an area which has been seen before is drawn
+straight away and without a connection.
+'''
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# Width and height of a tile in pixels
+TILE_SIZE = 256
+
+# The zoom levels which Google Maps provides
+MIN_ZOOM = 0
+MAX_ZOOM = 21
+
+# Rows fetched above and below each tile, cut off to hide the Google logo
+_LOGO_MARGIN = 25
+
+# Colour drawn where a tile has not been fetched yet
+_BLANK = (224, 224, 224)
+
+
+def lat_lon_to_tile(lat, lon, zoom):
+    '''Return the column and row of the tile holding a point, as floats
+    whose fractional parts give the position within the tile
+
+    Parameters:
+    lat                The latitude in degrees
+    lon                The longitude in degrees
+    zoom               The zoom level
+    '''
+    scale = 2**zoom
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon+180)/360*scale
+    y = (0.5-math.log((1+sin_lat)/(1-sin_lat))/(4*math.pi))*scale
+    return x, y
+
+def tile_to_lat_lon(x, y, zoom):
+    '''Return the latitude and longitude of a point on the tile grid
+
+    Parameters:
+    x                  The column, which may be fractional
+    y                  The row, which may be fractional
+    zoom               The zoom level
+    '''
+    scale = 2**zoom
+    lon = x/scale*360-180
+    lat = math.degrees(math.atan(math.sinh(math.pi*(1-2*y/scale))))
+    return lat, lon
+
+def static_map_request(key=None, base_url="https://maps.googleapis.com",
+                       timeout=10):
+    '''Return a function which fetches one tile from the Static Maps API and
+    returns it as image file data
+
+    Parameters:
+    key                The API key to send, from key.py if not given
+    base_url           The server to send requests to
+    timeout            Seconds to wait for each response
+    '''
+    def request(zoom, x, y, maptype):
+        api_key = key
+        if api_key is None:
+            from key import key as api_key
+        lat, lon = tile_to_lat_lon(x+0.5, y+0.5, zoom)
+        query = {
+            "center": str(lat)+","+str(lon),
+            "zoom": zoom,
+            "size": str(TILE_SIZE)+"x"+str(TILE_SIZE+2*_LOGO_MARGIN),
+            "maptype": maptype,
+            "key": api_key,
+            }
+        url = base_url.rstrip("/")+"/maps/api/staticmap?"
+        with urlopen(url+urlencode(query), timeout=timeout) as response:
+            return response.read()
+    return request
+
+
+class TileCache:
+    '''Map tiles kept in memory and on disk, fetched on background threads
+
+    Tiles are keyed by zoom, column, row and map type. The most recently
+    used tiles are held in memory, and every tile fetched is saved under
+    the directory so later runs can use it offline. A tile which could not
+    be fetched is not asked for again until the retry time has passed.
+
+    Attributes:
+    directory          The folder tiles are saved in
+    memory_size        Most tiles kept in memory
+    request            Function which fetches one tile as image file data
+    retry              Seconds before a failed tile is asked for again
+
+    Methods:
+    get                Return a tile if it is in memory or on disk
+    fetch              Return a tile, downloading it if needed
+    prefetch           Start downloading tiles in the background
+    shutdown           Stop the background downloads
+    '''
+    def __init__(self, directory="tile_cache", memory_size=256, request=None,
+                 workers=4, retry=60):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.request = static_map_request() if request is None else request
+        self.retry = retry
+
+        # Most recently used tiles last, and downloads which are under way
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _path(self, key):
+        zoom, x, y, maptype = key
+        return os.path.join(
+            self.directory, maptype, str(zoom), str(x), str(y)+".png"
+            )
+
+    def _remember(self, key, tile):
+        # Add to memory, dropping the least recently used tile
+        with self._lock:
+            self._memory[key] = tile
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def get(self, zoom, x, y, maptype):
+        '''Return a tile as an image if it is in memory or on disk, or None
+
+        Parameters:
+        zoom               The zoom level
+        x                  The column of the tile
+        y                  The row of the tile
+        maptype            The map type, such as "roadmap"
+        '''
+        from PIL import Image
+        key = (zoom, x, y, maptype)
+        with self._lock:
+            tile = self._memory.get(key)
+            if tile is not None:
+                self._memory.move_to_end(key)
+                return tile
+
+        try:
+            with Image.open(self._path(key)) as file:
+                tile = file.convert("RGB")
+        except OSError:
+            return None
+        self._remember(key, tile)
+        return tile
+
+    def fetch(self, zoom, x, y, maptype):
+        '''Return a tile as an image, downloading and saving it if needed
+
+        Parameters:
+        zoom               The zoom level
+        x                  The column of the tile
+        y                  The row of the tile
+        maptype            The map type, such as "roadmap"
+        '''
+        from PIL import Image
+        tile = self.get(zoom, x, y, maptype)
+        if tile is not None:
+            return tile
+
+        # Cut the logo margin off the downloaded image
+        data = self.request(zoom, x, y, maptype)
+        with Image.open(BytesIO(data)) as file:
+            tile = file.convert("RGB").crop(
+                (0, _LOGO_MARGIN, TILE_SIZE, _LOGO_MARGIN+TILE_SIZE)
+                )
+
+        # Save through a temporary file so a half written tile is never read
+        path = self._path((zoom, x, y, maptype))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tile.save(path+".tmp", "PNG")
+            os.replace(path+".tmp", path)
+        except OSError:
+            pass
+
+        self._remember((zoom, x, y, maptype), tile)
+        return tile
+
+    def _fetch_in_background(self, key):
+        try:
+            return self.fetch(*key)
+        except Exception:
+            with self._lock:
+                self._failed[key] = monotonic()
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def prefetch(self, keys):
+        '''Start downloading any of the tiles not already held, and return
+        the futures of those being downloaded
+
+        Parameters:
+        keys               The zoom, column, row and map type of each tile
+        '''
+        futures = []
+        for key in keys:
+            with self._lock:
+                if key in self._memory:
+                    continue
+                future = self._pending.get(key)
+                failed = self._failed.get(key)
+                if future is None:
+                    if failed is not None and monotonic()-failed < self.retry:
+                        continue
+                    future = self._pool.submit(self._fetch_in_background, key)
+                    self._pending[key] = future
+            futures.append(future)
+        return futures
+
+    def shutdown(self):
+        '''Stop the background downloads which have not started
+
+        '''
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class TileMap:
+    '''A view of the map centred on a point, drawn from cached tiles
+
+    Drawing never waits for the network. Tiles which are not held yet are
+    drawn blank and downloaded in the background, along with the tiles
+    around the view and those at the next zoom levels in, so moving or
+    zooming the map can usually be drawn straight from the cache.
+
+    Attributes:
+    width              The width of the view in pixels
+    height             The height of the view in pixels
+    lat                The latitude at the centre of the view
+    lon                The longitude at the centre of the view
+    zoom               The zoom level
+    maptype            The map type, such as "roadmap"
+    cache              The TileCache the tiles come from
+    prefetch_zoom      Number of zoom levels in to prefetch
+
+    Methods:
+    visible            Return the keys of the tiles in the view
+    render             Draw the view and return it as an image
+    '''
+    def __init__(self, width, height, lat, lon, zoom, maptype="roadmap",
+                 cache=None, prefetch_zoom=1):
+        self.width = width
+        self.height = height
+        self.lat = lat
+        self.lon = lon
+        self.zoom = zoom
+        self.maptype = maptype
+        self.cache = TileCache() if cache is None else cache
+        self.prefetch_zoom = prefetch_zoom
+
+    def _tiles(self, zoom, margin=0):
+        # The tiles covering the view at a zoom level with their positions
+        centre_x, centre_y = lat_lon_to_tile(self.lat, self.lon, zoom)
+        left = centre_x*TILE_SIZE-self.width/2
+        top = centre_y*TILE_SIZE-self.height/2
+        first_x = math.floor(left/TILE_SIZE)-margin
+        first_y = math.floor(top/TILE_SIZE)-margin
+        last_x = math.floor((left+self.width-1)/TILE_SIZE)+margin
+        last_y = math.floor((top+self.height-1)/TILE_SIZE)+margin
+
+        # Columns wrap around the world, rows stop at the poles
+        scale = 2**zoom
+        return [
+            ((zoom, x%scale, y, self.maptype),
+             (round(x*TILE_SIZE-left), round(y*TILE_SIZE-top)))
+            for y in range(max(first_y, 0), min(last_y, scale-1)+1)
+            for x in range(first_x, last_x+1)
+            ]
+
+    def visible(self):
+        '''Return the keys of the tiles in the view
+
+        '''
+        return [key for key, _ in self._tiles(self.zoom)]
+
+    def _nearby(self):
+        # Tiles around the view and those at the next zoom levels in
+        keys = [key for key, _ in self._tiles(self.zoom, margin=1)]
+        for zoom in range(self.zoom+1,
+                          min(self.zoom+self.prefetch_zoom, MAX_ZOOM)+1):
+            keys.extend(key for key, _ in self._tiles(zoom))
+        return keys
+
+    def render(self):
+        '''Draw the view and return the image, along with the futures of
+        the tiles in view still being downloaded
+
+        '''
+        from PIL import Image
+        image = Image.new("RGB", (self.width, self.height), _BLANK)
+        missing = []
+        for key, position in self._tiles(self.zoom):
+            tile = self.cache.get(*key)
+            if tile is None:
+                missing.append(key)
+            else:
+                image.paste(tile, position)
+
+        # Visible tiles are asked for before the ones nearby
+        loading = self.cache.prefetch(missing)
+        self.cache.prefetch(self._nearby())
+        return image, loading